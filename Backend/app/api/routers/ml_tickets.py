@@ -3,126 +3,125 @@ from datetime import datetime
 from fastapi import APIRouter, HTTPException, Body, Depends
 import logging
 
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from ...crud import base_crud
+from ...crud import async_crud
 from ...schemas import MLWorkerResult
-from ...db.models import Dialog
-from ...db.session import get_db
+from ...db.session import get_async_db
 
 
 logger = logging.getLogger("ml-callback")
 router = APIRouter(prefix="/api/ml", tags=["ML"])
-db = get_db()
 
 
-@router.post("/dialogs/result", summary="Callback от ML-воркера: результат обработки диалога")
-async def dialogs_result(payload: MLWorkerResult = Body(...), db: Session = Depends(get_db)):
+def _plan_ml_result(payload: MLWorkerResult) -> dict:
     """
-    Обработка callback'а от ML-воркера в формате, который присылает ML-команда.
-    1) Проверяем существование диалога.
-    2) Пишем raw-result в logs.
-    3) В зависимости от payload.status и payload.ml_result.action_type выполняем нужные действия:
-       - processed + answer: создаём message с summary, пытаемся закрыть диалог.
-       - processed + escalate: создаём message с summary, помечаем escalated.
-       - processed + call_tool: создаём/находим Tool и создаём ToolInvocation (не закрываем диалог).
-       - error: помечаем ticket.ml_error (если недоступно, fallback -> escalated) и записываем error_message.
+    Переводит результат ML-воркера в изменения для async_crud.apply_ml_results:
+    raw-result для logs, текст сообщения в диалог и новый статус/тип диалога.
+       - processed + answer: message с summary, диалог закрывается (closed + type).
+       - processed + escalate: message с summary и причиной, диалог помечается escalated.
+       - error: message с error_message, диалог помечается escalated.
+       - неизвестный action_type: только запись в logs, action = None.
     """
-    dialog_id = payload.dialog_id
-
-    dialog = db.query(Dialog).filter(Dialog.id == dialog_id).first()
-    if not dialog:
-        logger.warning("ML callback: ialog_id %s not found", dialog_id)
-        raise HTTPException(status_code=404, detail="Dialog not found")
-
-    try:
-        base_crud.create_log(db,
-                             event_type="ml_result",
-                             dialog_id=dialog_id,
-                             success=(payload.status == "processed"),
-                             details={
-                                 "ml_result": payload.ml_result,
-                                 "error_message": payload.error_message,
-                                 "received_at": datetime.now().isoformat()
-                             })
-    except Exception:
-        logger.exception("Failed to persist ml_result log for dialog %s", dialog_id)
+    item = {
+        "dialog_id": payload.dialog_id,
+        "success": payload.status == "processed",
+        "details": {
+            "ml_result": payload.ml_result,
+            "error_message": payload.error_message,
+            "received_at": datetime.now().isoformat()
+        },
+        "message": None,
+        "status": None,
+        "action": None,
+    }
 
     # Если ML сообщил об ошибке
     if payload.status == "error":
-        # Сохраним сообщение в dialog (для видимости на дашборде)
         if payload.error_message:
-            try:
-                base_crud.create_message(db, dialog_id=dialog_id, content=f"[ML ERROR] {payload.error_message}")
-            except Exception:
-                logger.exception("Failed to create error message for dialog %s", dialog_id)
-
-        dialog.status = "escalated"
-        db.add(dialog)
-        db.commit()
-        db.refresh(dialog)
-        logger.info("Dialog %s marked as escalated because of ML_ERROR", dialog_id)
-
-        return {"status": "ok", "action": "error_handled"}
+            item["message"] = f"[ML ERROR] {payload.error_message}"
+        item.update(status="escalated", action="error_handled")
+        return item
 
     # Далее — payload.status == "processed"
     ml_result = payload.ml_result if payload.ml_result else {}
     action_type = ml_result.get("action_type")
     ml_payload = ml_result.get("payload", {}) if isinstance(ml_result, dict) else {}
+    category = ml_payload.get("category")
+    summary = ml_payload.get("summary") or ""
 
-    # Branch: answer
     if action_type == "answer":
-        # Ожидаем: payload.category, payload.summary (предложенный ответ), payload.sources (опционально)
-        category = ml_payload.get("category")
-        summary = ml_payload.get("summary") or ""
-        # 1) Создаём сообщение с предложенным ответом (summary)
         if summary:
-            try:
-                base_crud.create_message(db, dialog_id=dialog_id, content=f"[Auto-answer by ML]\n{summary}")
-            except Exception:
-                logger.exception("Failed to create auto-answer message for dialog %s", dialog_id)
-        # 2)  Помечаем диалог как решённый: closed + status
-        dialog.status = "closed"
-        dialog.type = category
-        dialog.resolved_at = datetime.now()
-        db.add(dialog)
-        db.commit()
-        db.refresh(dialog)
-        logger.info("Dialog %s marked as solved by ML.", dialog_id)
-
-        # 3) лог дополнительной информации (category/sources) — уже записан в ml_result log выше
-        return {"status": "ok", "action": "answer"}
-
-    # Branch: escalate
+            item["message"] = f"[Auto-answer by ML]\n{summary}"
+        item.update(status="closed", type=category, resolved=True, action="answer")
+        return item
+
     if action_type == "escalate":
-        category = ml_payload.get("category")
-        summary = ml_payload.get("summary") or ""
         reason = ml_payload.get("reason")
-        # создаём сообщение-напоминание для оператора
+        # сообщение-напоминание для оператора
         msg = "[ML Эскалация]\n"
         if summary:
             msg += summary
         if reason:
             msg += f"\nReason: {reason}"
-        try:
-            base_crud.create_message(db, dialog_id=dialog_id, content=msg)
-        except Exception:
-            logger.exception("Failed to create escalation message for dialog %s", dialog_id)
-
-        # обновляем статус в БД
-        try:
-            dialog.status = "escalated"
-            dialog.type = category
-            db.add(dialog)
-            db.commit()
-            db.refresh(dialog)
-            logger.info("Dialog %s marked as escalated by ML.", dialog_id)
-        except Exception:
-            logger.exception("Failed to set dialog %s to escalated", dialog_id)
-
-        return {"status": "ok", "action": "escalate"}
-
-    # Если action_type не распознан или пуст
-    logger.warning("Unknown or missing action_type in ml_result for dialog %s: %s", dialog_id, action_type)
-    # Просто логируем (raw ml_result уже в логах) и возвращаем 400
-    raise HTTPException(status_code=400, detail="Unknown or missing action_type in ml_result")
+        item.update(message=msg, status="escalated", type=category, action="escalate")
+        return item
+
+    return item
+
+
+@router.post("/dialogs/result", summary="Callback от ML-воркера: результат обработки диалога")
+async def dialogs_result(payload: MLWorkerResult = Body(...), db: AsyncSession = Depends(get_async_db)):
+    """
+    Обработка callback'а от ML-воркера в формате, который присылает ML-команда.
+    Лог raw-result, сообщение в диалог и смена статуса записываются одной транзакцией.
+    """
+    dialog_id = payload.dialog_id
+    item = _plan_ml_result(payload)
+
+    not_found, duplicates = await async_crud.apply_ml_results(db, [item])
+    if dialog_id in not_found:
+        logger.warning("ML callback: dialog_id %s not found", dialog_id)
+        raise HTTPException(status_code=404, detail="Dialog not found")
+    if dialog_id in duplicates:
+        logger.info("ML callback: result for dialog %s was already applied, skipping", dialog_id)
+        return {"status": "ok", "action": "duplicate"}
+
+    if item["action"] is None:
+        logger.warning("Unknown or missing action_type in ml_result for dialog %s", dialog_id)
+        # raw ml_result уже в логах — возвращаем 400
+        raise HTTPException(status_code=400, detail="Unknown or missing action_type in ml_result")
+
+    logger.info("Dialog %s processed by ML callback: %s -> %s", dialog_id, item["action"], item["status"])
+    return {"status": "ok", "action": item["action"]}
+
+
+@router.post("/dialogs/result/batch", summary="Пакетный callback от ML-воркера")
+async def dialogs_result_batch(payloads: list[MLWorkerResult] = Body(...),
+                               db: AsyncSession = Depends(get_async_db)):
+    """
+    Пакетная версия /dialogs/result: все результаты применяются bulk-вставками и одним commit.
+    Ошибки отдельных элементов (нет диалога, неизвестный action_type) не отменяют остальные.
+    Повторная отправка уже применённых результатов безопасна: они возвращаются в duplicates.
+    """
+    items = [_plan_ml_result(payload) for payload in payloads]
+    not_found, duplicates = await async_crud.apply_ml_results(db, items)
+
+    applied = [item for item in items if item["dialog_id"] not in not_found | duplicates]
+    unknown_action = [item["dialog_id"] for item in applied if item["action"] is None]
+    processed = len(applied) - len(unknown_action)
+    if not_found:
+        logger.warning("ML batch callback: dialogs not found: %s", sorted(not_found))
+    if duplicates:
+        logger.info("ML batch callback: results already applied for dialogs %s", sorted(duplicates))
+    if unknown_action:
+        logger.warning("ML batch callback: unknown or missing action_type for dialogs %s", unknown_action)
+    logger.info("ML batch callback: applied %s results", processed)
+
+    return {
+        "status": "ok",
+        "processed": processed,
+        "not_found": sorted(not_found),
+        "unknown_action": unknown_action,
+        "duplicates": sorted(duplicates),
+    }
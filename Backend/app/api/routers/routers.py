@@ -1,26 +1,29 @@
 import os
 import httpx
 
-from fastapi import APIRouter, HTTPException, status, Body, Depends, BackgroundTasks
+from fastapi import APIRouter, HTTPException, status, Body, Depends, Query
 from dotenv import load_dotenv
-from sqlalchemy.orm import Session
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi.responses import JSONResponse
 
 from ...schemas import PromptRequest, SimpleAnswer, SupportRequest, SupportResponse
-from ...services import simulation_manager
-from ...crud import base_crud
-from ...crud.base_crud import get_all_tools, get_tool_invocations, get_dialogs_by_status
-from ...db.session import get_db
-from ...services.ml_client import send_ticket_to_ml
-from ...db.models import Log, Message
+from ...services import simulation_manager, http_pool
+from ...crud import async_crud
+from ...db.session import get_async_db
+from ...services.dispatcher import ticket_dispatcher
 
-from datetime import timedelta
+from datetime import datetime
+from typing import Literal
 
 # Загружаем переменные окружения
 load_dotenv()
 
 r = APIRouter(tags=["Support"])
 ML_API_URL = os.getenv("ML_API_URL")
+CARDS_PAGE_SIZE = int(os.getenv("CARDS_PAGE_SIZE", 100))
+CARDS_MAX_PAGE_SIZE = 1000
+INTAKE_BULK_MAX = int(os.getenv("INTAKE_BULK_MAX", 500))
 
 
 @r.post("/test-ml", response_model=SimpleAnswer, summary="Тестовый запрос к ML",
@@ -35,14 +38,13 @@ async def test_func(request: PromptRequest = Body(..., examples={
         "prompt": request.prompt
     }
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{ML_API_URL}/api/agent/test-prompt",
-                json=ml_request,
-                timeout=90.0
-            )
-            response.raise_for_status()
-            return response.json()
+        response = await http_pool.get_client("ml").post(
+            f"{ML_API_URL}/api/agent/test-prompt",
+            json=ml_request,
+            timeout=90.0
+        )
+        response.raise_for_status()
+        return response.json()
     except httpx.RequestError as e:
         raise HTTPException(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
@@ -50,38 +52,97 @@ async def test_func(request: PromptRequest = Body(..., examples={
         )
 
 
+def _check_intake_lag():
+    """429 с Retry-After, если очереди до ML и в ML уже дольше INTAKE_MAX_LAG_SEC."""
+    retry_after = ticket_dispatcher.intake_retry_after()
+    if retry_after is not None:
+        print(f"[support/process] Перегрузка: ожидаемая задержка {ticket_dispatcher.estimated_lag():.1f} с")
+        raise HTTPException(status_code=429, detail="ml queue is overloaded, retry later",
+                            headers={"Retry-After": str(retry_after)})
+
+
 @r.post(
     "/support/process",
     response_model=SupportResponse,
     summary="Принять обращение пользователя и поставить в обработку",
-    description="Создаёт Dialog и Message в БД и асинхронно отправляет тикет в ML."
+    description="Создаёт Dialog и Message в БД и ставит тикет в outbox для отправки в ML."
 )
 async def process_support_request(
         request: SupportRequest = Body(...),
-        background_tasks: BackgroundTasks = None,
-        db: Session = Depends(get_db),
+        db: AsyncSession = Depends(get_async_db),
 ):
     """
-    Создаёт dialog и message, возвращает dialog_id
-    и запускает BackgroundTask для отправки в ML.
+    Создаёт dialog, message и строку outbox в одной транзакции, возвращает dialog_id.
+    Отправкой в ML занимается ticket_dispatcher.
     """
     print(f"[support/process] Получено обращение от {request.user_id}: {request.user_message[:200]}...")
 
+    _check_intake_lag()
+
     try:
-        dialog = base_crud.create_dialog(db, session_id=f"{request.user_id}-{request.timestamp}")
-        base_crud.create_message(db, dialog_id=dialog.id, content=request.user_message)
+        dialog_id = await async_crud.create_dialog_with_message(
+            db, session_id=f"{request.user_id}-{request.timestamp}", content=request.user_message
+        )
+    except IntegrityError:
+        raise HTTPException(status_code=409, detail="dialog with this session_id already exists")
     except Exception as e:
         print(f"[support/process] Ошибка при создании диалога: {e}")
         raise HTTPException(status_code=500, detail="error creating ticket")
 
-    # запускаем фоновую задачу: передаем dialog.id
-    if background_tasks is not None:
-        background_tasks.add_task(send_ticket_to_ml, dialog.id)
-    else:
-        raise HTTPException(status_code=404, detail="Background tasks are not found.")
+    # тикет уже в outbox — будим диспетчер
+    ticket_dispatcher.notify(1)
 
     # Возвращаем ticket_id == dialog.id
-    return {"dialog_id": dialog.id, "status": "active"}
+    return {"dialog_id": dialog_id, "status": "active"}
+
+
+@r.post(
+    "/support/process/bulk",
+    response_model=list[SupportResponse],
+    summary="Принять пачку обращений",
+    description="Создаёт диалоги и первые сообщения для всех обращений в одной транзакции и отправляет их в ML."
+)
+async def process_support_requests_bulk(
+        requests: list[SupportRequest] = Body(...),
+        db: AsyncSession = Depends(get_async_db),
+):
+    if len(requests) > INTAKE_BULK_MAX:
+        raise HTTPException(status_code=413, detail=f"too many requests in batch (max {INTAKE_BULK_MAX})")
+
+    print(f"[support/process/bulk] Получено обращений: {len(requests)}")
+
+    items = [(f"{req.user_id}-{req.timestamp}", req.user_message) for req in requests]
+    # session_id уникален: повтор внутри пачки или уже принятое обращение отклоняются целиком, с указанием позиций
+    first_seen: dict[str, int] = {}
+    duplicates = []
+    for i, (session_id, _) in enumerate(items):
+        if session_id in first_seen:
+            duplicates.append({"index": i, "duplicate_of": first_seen[session_id], "session_id": session_id})
+        else:
+            first_seen[session_id] = i
+    if duplicates:
+        raise HTTPException(status_code=422, detail={"message": "duplicate session_id in batch",
+                                                     "duplicates": duplicates})
+
+    _check_intake_lag()
+
+    try:
+        dialog_ids = await async_crud.create_dialogs_with_messages(db, items)
+    except IntegrityError:
+        await db.rollback()
+        existing = await async_crud.get_existing_session_ids(db, list(first_seen))
+        raise HTTPException(status_code=409, detail={
+            "message": "dialogs with these session_id already exist",
+            "conflicts": [{"index": i, "session_id": session_id}
+                          for i, (session_id, _) in enumerate(items) if session_id in existing],
+        })
+    except Exception as e:
+        print(f"[support/process/bulk] Ошибка при создании диалогов: {e}")
+        raise HTTPException(status_code=500, detail="error creating tickets")
+
+    ticket_dispatcher.notify(len(dialog_ids))
+
+    return [{"dialog_id": dialog_id, "status": "active"} for dialog_id in dialog_ids]
 
 
 @r.post("/simulate/start", summary="Запустить симуляцию входящих обращений",
@@ -105,66 +166,143 @@ async def simulate_status():
     return simulation_manager.status()
 
 
+@r.get("/metrics/http_pool", summary="Метрики пулов исходящих HTTP-соединений")
+async def http_pool_metrics():
+    return http_pool.pool_stats()
+
+
+@r.get("/metrics/dispatcher", summary="Метрики диспетчера outbox тикетов")
+async def dispatcher_metrics():
+    return await ticket_dispatcher.stats()
+
+
 @r.get("/statistic/all_count/{status_t}")
-async def get_sum_of_dialogs(status_t: str, db: Session = Depends(get_db)):
-    return len(get_dialogs_by_status(db, status_t))
+async def get_sum_of_dialogs(status_t: str, db: AsyncSession = Depends(get_async_db)):
+    return await async_crud.count_dialogs(db, status_t)
 
 
 @r.get("/statistic/time_spending")
-async def spend_time(db: Session = Depends(get_db)):
-    time = []
-    dialogs = get_dialogs_by_status(db, "closed")
-    for i in range(len(dialogs)):
-        if dialogs[i].resolved_at:
-            time.append(dialogs[i].resolved_at - dialogs[i].created_at)
+async def spend_time(db: AsyncSession = Depends(get_async_db)):
+    return await async_crud.get_average_resolution_time(db)
 
-    if len(time) == 0:
-        return None
-    else:
-        return sum(time, timedelta()) / len(time)
+
+@r.get("/statistic/resolution_time", summary="Время решения: среднее и перцентили")
+async def resolution_time(since: datetime | None = None, db: AsyncSession = Depends(get_async_db)):
+    return (await async_crud.get_resolution_time_stats(db, since=since))[0]
+
+
+@r.get("/statistic/resolution_time/by_category", summary="Время решения по категориям")
+async def resolution_time_by_category(since: datetime | None = None,
+                                      db: AsyncSession = Depends(get_async_db)):
+    return await async_crud.get_resolution_time_stats(db, group_by="type", since=since)
+
+
+@r.get("/statistic/resolution_time/by_bucket", summary="Время решения по интервалам времени")
+async def resolution_time_by_bucket(
+        bucket: Literal[async_crud.TIME_BUCKETS] = "hour",
+        since: datetime | None = None,
+        db: AsyncSession = Depends(get_async_db),
+):
+    return await async_crud.get_resolution_time_stats(db, group_by="bucket", bucket=bucket, since=since)
+
+
+@r.get("/statistic/count/by_category/{status_t}", summary="Число диалогов по категориям")
+async def count_by_category(status_t: str, since: datetime | None = None,
+                            db: AsyncSession = Depends(get_async_db)):
+    return await async_crud.count_dialogs_grouped(db, "type", status=status_t, since=since)
+
+
+@r.get("/statistic/count/by_bucket/{status_t}", summary="Число диалогов по интервалам времени")
+async def count_by_bucket(
+        status_t: str,
+        bucket: Literal[async_crud.TIME_BUCKETS] = "hour",
+        since: datetime | None = None,
+        db: AsyncSession = Depends(get_async_db),
+):
+    return await async_crud.count_dialogs_grouped(db, "bucket", status=status_t, bucket=bucket, since=since)
+
+
+@r.get("/statistic/rollup/all_count/{status_t}", summary="Число диалогов (по rollup-таблице)")
+async def rollup_count(status_t: str, since: datetime | None = None, db: AsyncSession = Depends(get_async_db)):
+    return await async_crud.get_rollup_counts(db, status=status_t, since=since)
+
+
+@r.get("/statistic/rollup/count/by_category/{status_t}", summary="Число диалогов по категориям (rollup)")
+async def rollup_count_by_category(status_t: str, since: datetime | None = None,
+                                   db: AsyncSession = Depends(get_async_db)):
+    return await async_crud.get_rollup_counts(db, group_by="type", status=status_t, since=since)
+
+
+@r.get("/statistic/rollup/count/by_bucket/{status_t}", summary="Число диалогов по интервалам времени (rollup)")
+async def rollup_count_by_bucket(
+        status_t: str,
+        bucket: Literal[async_crud.TIME_BUCKETS] = "hour",
+        since: datetime | None = None,
+        db: AsyncSession = Depends(get_async_db),
+):
+    return await async_crud.get_rollup_counts(db, group_by="bucket", status=status_t, bucket=bucket, since=since)
+
+
+@r.get("/statistic/rollup/resolution_time", summary="Среднее время решения (rollup)")
+async def rollup_resolution_time(since: datetime | None = None, db: AsyncSession = Depends(get_async_db)):
+    stats = await async_crud.get_rollup_resolution_time(db, since=since)
+    return stats[0] if stats else {"count": 0, "avg_sec": None}
+
+
+@r.get("/statistic/rollup/resolution_time/by_category", summary="Среднее время решения по категориям (rollup)")
+async def rollup_resolution_time_by_category(since: datetime | None = None,
+                                             db: AsyncSession = Depends(get_async_db)):
+    return await async_crud.get_rollup_resolution_time(db, group_by="type", since=since)
+
+
+@r.get("/statistic/rollup/resolution_time/by_bucket", summary="Среднее время решения по интервалам (rollup)")
+async def rollup_resolution_time_by_bucket(
+        bucket: Literal[async_crud.TIME_BUCKETS] = "hour",
+        since: datetime | None = None,
+        db: AsyncSession = Depends(get_async_db),
+):
+    return await async_crud.get_rollup_resolution_time(db, group_by="bucket", bucket=bucket, since=since)
 
 
 @r.get("/statistic/cards/{status_t}")
-async def get_dialogs(status_t: str, db: Session = Depends(get_db)):
-    dialogs = get_dialogs_by_status(db, status_t)
-
-    results = []
-    for dialog in dialogs:
-        ml_log = db.query(Log).filter(
-            Log.dialog_id == dialog.id,
-            Log.event_type == "ml_result"
-        ).order_by(Log.created_at.desc()).first()
-
-        first_message = db.query(Message).filter(Message.dialog_id == dialog.id).order_by(
-            Message.timestamp.asc()).first()
-
-        dialog_data = {
-            "id": dialog.id,
-            "session_id": dialog.session_id,
-            "status": dialog.status,
-            "type": dialog.type,
-            "created_at": dialog.created_at.isoformat() if dialog.created_at else None,
-            "resolved_at": dialog.resolved_at.isoformat() if dialog.resolved_at else None,
-            "user_query": ml_log.details.get("ml_result", {}).get("user_query") if ml_log and ml_log.details else (
-                first_message.content if first_message else "Запрос не найден"),
-            "ml_result": ml_log.details.get("ml_result") if ml_log and ml_log.details else None
-        }
-        results.append(dialog_data)
-
-    return JSONResponse(content=results)
+async def get_dialogs(
+        status_t: str,
+        after_id: int | None = Query(None, description="id последней карточки предыдущей страницы"),
+        limit: int = Query(CARDS_PAGE_SIZE, ge=1, le=CARDS_MAX_PAGE_SIZE, description="Размер страницы"),
+        fields: str | None = Query(None, description="Список полей через запятую"),
+        db: AsyncSession = Depends(get_async_db),
+):
+    """
+    Страница карточек диалогов (новые сначала). Следующая страница запрашивается
+    с after_id из заголовка X-Next-After-Id.
+    """
+    selected = None
+    if fields:
+        selected = {f.strip() for f in fields.split(",") if f.strip()}
+        unknown = selected - set(async_crud.DIALOG_CARD_FIELDS)
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+        selected.add("id")
+
+    results = await async_crud.get_dialog_cards(db, status_t, after_id=after_id, limit=limit, fields=selected)
+
+    headers = {}
+    if len(results) == limit:
+        headers["X-Next-After-Id"] = str(results[-1]["id"])
+    return JSONResponse(content=results, headers=headers)
 
 
 @r.get("/statistic/tools")
-async def get_tools(db: Session = Depends(get_db)):
-    return get_all_tools(db)
+async def get_tools(db: AsyncSession = Depends(get_async_db)):
+    return await async_crud.get_all_tools(db)
 
 
 @r.get("/statistic/tools/{tool_id}/invocations")
-async def get_tool_invocations_count(tool_id: int, db: Session = Depends(get_db)):
+async def get_tool_invocations_count(tool_id: int, db: AsyncSession = Depends(get_async_db)):
     """
     Возвращает количество вызовов (invocations) для инструмента с id = tool_id.
     """
     # посчитаем invocations
-    count = get_tool_invocations(db, tool_id).count()
+    count = await async_crud.count_tool_invocations(db, tool_id)
 
     return {"tool_id": tool_id, "invocations_count": count}
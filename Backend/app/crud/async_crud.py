@@ -0,0 +1,354 @@
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select, func, insert, update, case
+from datetime import datetime, timedelta
+from ..db.models import (
+    Dialog, Message, Feedback, Tool, ToolInvocation, Log, TicketOutbox
+)
+from .base_crud import (
+    DIALOG_CARD_FIELDS, TIME_BUCKETS,
+    _dialog_cards_stmt, _format_dialog_cards,
+    _count_dialogs_stmt, _average_resolution_time_stmt,
+    _resolution_time_stats_stmt, _format_stats_rows,
+    _count_dialogs_grouped_stmt, _group_value,
+    _rollup_created_stmts, _rollup_transition_stmts,
+    _rollup_counts_stmt, _format_rollup_counts,
+    _rollup_resolution_time_stmt, _format_rollup_resolution_time,
+    _intake_stmt, _bulk_dialogs_stmt, _intake_rollup_stmt, _outbox_rows,
+    _rollup_transition_rows, _merge_rollup_rows, _rollup_upsert_many_stmt,
+)
+
+# Асинхронные версии функций base_crud (AsyncSession + asyncpg).
+# Запросы собираются теми же построителями, что и в base_crud, поэтому SQL в обеих версиях одинаковый.
+
+
+async def create_dialog(db: AsyncSession, session_id: str) -> Dialog:
+    dialog = Dialog(session_id=session_id, status="active", created_at=datetime.now())
+    db.add(dialog)
+    await record_dialog_created(db, dialog)
+    await db.commit()
+    await db.refresh(dialog)
+    return dialog
+
+
+async def create_dialog_with_message(db: AsyncSession, session_id: str, content: str) -> int:
+    """Приём обращения в одной транзакции: диалог, первое сообщение, outbox и rollup. Возвращает id диалога."""
+    now = datetime.now()
+    dialog_id = (await db.execute(_intake_stmt(session_id, content, now))).scalar_one()
+    await db.execute(_intake_rollup_stmt(now, 1))
+    await db.commit()
+    return dialog_id
+
+
+async def create_dialogs_with_messages(db: AsyncSession, items: list[tuple[str, str]]) -> list[int]:
+    """Пакетный приём обращений (session_id, content) в одной транзакции. id возвращаются в порядке items."""
+    if not items:
+        return []
+    now = datetime.now()
+    dialog_ids = (await db.scalars(
+        _bulk_dialogs_stmt(),
+        [{"session_id": session_id, "status": "active", "created_at": now} for session_id, _ in items],
+    )).all()
+    await db.execute(insert(Message), [
+        {"dialog_id": dialog_id, "content": content, "timestamp": now, "is_relevant": True}
+        for dialog_id, (_, content) in zip(dialog_ids, items)
+    ])
+    await db.execute(insert(TicketOutbox), _outbox_rows(dialog_ids, [content for _, content in items], now))
+    await db.execute(_intake_rollup_stmt(now, len(items)))
+    await db.commit()
+    return list(dialog_ids)
+
+
+async def get_existing_session_ids(db: AsyncSession, session_ids: list[str]) -> set[str]:
+    return set((await db.scalars(select(Dialog.session_id).where(Dialog.session_id.in_(session_ids)))).all())
+
+
+async def get_dialog(db: AsyncSession, dialog_id: int) -> Dialog | None:
+    return await db.get(Dialog, dialog_id)
+
+
+async def update_dialog_status(db: AsyncSession, dialog_id: int, status: str) -> Dialog | None:
+    dialog = await db.get(Dialog, dialog_id)
+    if dialog:
+        old_status, old_type = dialog.status, dialog.type
+        dialog.status = status
+        await record_dialog_transition(db, dialog, old_status, old_type)
+        await db.commit()
+        await db.refresh(dialog)
+    return dialog
+
+async def close_dialog(db: AsyncSession, dialog_id: int, type: str | None = None) -> Dialog | None:
+    dialog = await db.get(Dialog, dialog_id)
+    if dialog:
+        old_status, old_type = dialog.status, dialog.type
+        dialog.status = "closed"
+        dialog.type = type
+        dialog.resolved_at = datetime.now()
+        await record_dialog_transition(db, dialog, old_status, old_type)
+        await db.commit()
+        await db.refresh(dialog)
+    return dialog
+
+async def get_dialogs_by_status(db: AsyncSession, status: str | None = None) -> list[Dialog]:
+    stmt = select(Dialog)
+    if status and status.lower() != "all":
+        stmt = stmt.where(Dialog.status == status)
+    return list((await db.scalars(stmt.order_by(Dialog.created_at.desc()))).all())
+
+
+async def get_dialog_cards(db: AsyncSession, status: str | None = None, after_id: int | None = None,
+                           limit: int = 100, fields: set[str] | None = None) -> list[dict]:
+    fields = set(fields or DIALOG_CARD_FIELDS)
+    result = await db.execute(_dialog_cards_stmt(status, after_id, limit, fields))
+    return _format_dialog_cards(result, fields)
+
+
+async def count_dialogs(db: AsyncSession, status: str | None = None) -> int:
+    return (await db.execute(_count_dialogs_stmt(status))).scalar_one()
+
+
+async def get_average_resolution_time(db: AsyncSession) -> timedelta | None:
+    return (await db.execute(_average_resolution_time_stmt())).scalar_one()
+
+
+async def get_resolution_time_stats(db: AsyncSession, group_by: str | None = None, bucket: str = "hour",
+                                    since: datetime | None = None) -> list[dict]:
+    result = await db.execute(_resolution_time_stats_stmt(group_by, bucket, since))
+    return _format_stats_rows(result.mappings(), group_by)
+
+
+async def count_dialogs_grouped(db: AsyncSession, group_by: str, status: str | None = None, bucket: str = "hour",
+                                since: datetime | None = None) -> list[dict]:
+    rows = await db.execute(_count_dialogs_grouped_stmt(group_by, status, bucket, since))
+    return [{group_by: _group_value(row.key), "count": row.count} for row in rows]
+
+
+async def record_dialog_created(db: AsyncSession, dialog: Dialog):
+    for stmt in _rollup_created_stmts(dialog):
+        await db.execute(stmt)
+
+
+async def record_dialog_transition(db: AsyncSession, dialog: Dialog, old_status: str, old_type: str | None):
+    for stmt in _rollup_transition_stmts(dialog, old_status, old_type):
+        await db.execute(stmt)
+
+
+async def get_rollup_counts(db: AsyncSession, group_by: str | None = None, status: str | None = None,
+                            bucket: str = "hour", since: datetime | None = None) -> int | list[dict]:
+    result = await db.execute(_rollup_counts_stmt(group_by, status, bucket, since))
+    if group_by is None:
+        return result.scalar_one()
+    return _format_rollup_counts(result, group_by)
+
+
+async def get_rollup_resolution_time(db: AsyncSession, group_by: str | None = None, bucket: str = "hour",
+                                     since: datetime | None = None) -> list[dict]:
+    rows = await db.execute(_rollup_resolution_time_stmt(group_by, bucket, since))
+    return _format_rollup_resolution_time(rows, group_by)
+
+
+async def create_message(db: AsyncSession, dialog_id: int, content: str) -> Message:
+    message = Message(dialog_id=dialog_id, content=content)
+    db.add(message)
+    await db.commit()
+    await db.refresh(message)
+    return message
+
+async def get_messages_by_dialog(db: AsyncSession, dialog_id: int) -> list[Message]:
+    stmt = select(Message).where(Message.dialog_id == dialog_id).order_by(Message.timestamp)
+    return list((await db.scalars(stmt)).all())
+
+async def get_first_message(db: AsyncSession, dialog_id: int) -> Message | None:
+    stmt = select(Message).where(Message.dialog_id == dialog_id).order_by(Message.timestamp).limit(1)
+    return (await db.scalars(stmt)).first()
+
+async def create_feedback(db: AsyncSession, dialog_id: int, rating: int, comment: str | None = None) -> Feedback:
+    feedback = Feedback(dialog_id=dialog_id, rating=rating, comment=comment)
+    db.add(feedback)
+    await db.commit()
+    await db.refresh(feedback)
+    return feedback
+
+
+async def get_all_tools(db: AsyncSession) -> list[Tool]:
+    return list((await db.scalars(select(Tool).order_by(Tool.created_at))).all())
+
+
+async def count_tool_invocations(db: AsyncSession, tool_id: int) -> int:
+    stmt = select(func.count(ToolInvocation.id)).where(ToolInvocation.tool_id == tool_id)
+    return (await db.execute(stmt)).scalar_one()
+
+
+async def create_log(db: AsyncSession, event_type: str, dialog_id: int | None = None, success: bool = True,
+                     details: dict | None = None) -> Log:
+    log = Log(
+        event_type=event_type,
+        dialog_id=dialog_id,
+        success=success,
+        details=details or {}
+    )
+    db.add(log)
+    await db.commit()
+    return log
+
+
+async def apply_ml_results(db: AsyncSession, results: list[dict]) -> tuple[set[int], set[int]]:
+    """
+    Применяет пачку результатов ML в одной транзакции: bulk INSERT логов и сообщений,
+    обновление диалогов и один upsert rollup-таблицы. Элемент results:
+    {"dialog_id", "success", "details", "message" | None, "status" | None, "type", "resolved", "action"}.
+    Идемпотентна: результат для диалога, у которого уже есть ml_result-лог, пропускается, поэтому
+    повторная отправка той же пачки (таймаут после commit, повторная выдача тикета) не создаёт дублей.
+    Результаты без action (неизвестный action_type) пишутся как ml_result_rejected и диалог не меняют,
+    поэтому последующий корректный результат для диалога применяется.
+    Возвращает (id диалогов, которых нет в базе; id диалогов, результат для которых уже применён).
+    """
+    dialog_ids = {item["dialog_id"] for item in results}
+    # Блокировка диалогов в порядке id: параллельные callback'и с одним диалогом выполняются по очереди
+    dialogs = {
+        dialog.id: dialog
+        for dialog in (await db.scalars(
+            select(Dialog).where(Dialog.id.in_(dialog_ids)).order_by(Dialog.id).with_for_update()
+        )).all()
+    }
+    already_applied = set((await db.scalars(
+        select(Log.dialog_id).where(Log.dialog_id.in_(dialogs.keys()), Log.event_type == "ml_result").distinct()
+    )).all())
+
+    logs, messages, rollup_rows = [], [], []
+    # Повтор диалога внутри одной пачки применяется один раз
+    seen: set[int] = set()
+    now = datetime.now()
+    for item in results:
+        dialog = dialogs.get(item["dialog_id"])
+        if dialog is None or dialog.id in already_applied or dialog.id in seen:
+            continue
+        if item.get("action") is None:
+            # Отклонённый результат (неизвестный action_type) сохраняется отдельно и не блокирует следующий
+            logs.append({"event_type": "ml_result_rejected", "dialog_id": dialog.id, "success": False,
+                         "details": item["details"], "created_at": now})
+            continue
+        seen.add(dialog.id)
+        logs.append({"event_type": "ml_result", "dialog_id": dialog.id, "success": item["success"],
+                     "details": item["details"], "created_at": now})
+        if item.get("message"):
+            messages.append({"dialog_id": dialog.id, "content": item["message"], "timestamp": now,
+                             "is_relevant": True})
+        if item.get("status"):
+            old_status, old_type = dialog.status, dialog.type
+            dialog.status = item["status"]
+            if "type" in item:
+                dialog.type = item["type"]
+            if item.get("resolved"):
+                dialog.resolved_at = now
+            rollup_rows.extend(_rollup_transition_rows(dialog, old_status, old_type))
+
+    if logs:
+        await db.execute(insert(Log), logs)
+    if messages:
+        await db.execute(insert(Message), messages)
+    if rollup_rows:
+        await db.execute(_rollup_upsert_many_stmt(_merge_rollup_rows(rollup_rows)))
+    await db.commit()
+
+    return dialog_ids - dialogs.keys(), already_applied
+
+
+async def claim_outbox_batch(db: AsyncSession, limit: int, visibility_timeout: float) -> list[TicketOutbox]:
+    """
+    Забирает до limit готовых к отправке тикетов: FOR UPDATE SKIP LOCKED не даёт двум диспетчерам
+    взять одну строку. Взятые строки переходят в in_flight и невидимы visibility_timeout секунд.
+    """
+    now = datetime.now()
+    claimable = (
+        select(TicketOutbox.id)
+        .where(TicketOutbox.status == "pending", TicketOutbox.available_at <= now)
+        .order_by(TicketOutbox.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    stmt = (
+        update(TicketOutbox)
+        .where(TicketOutbox.id.in_(claimable.scalar_subquery()))
+        .values(status="in_flight", attempts=TicketOutbox.attempts + 1,
+                available_at=now + timedelta(seconds=visibility_timeout))
+        .returning(TicketOutbox)
+        .execution_options(synchronize_session=False)
+    )
+    claimed = list((await db.scalars(stmt)).all())
+    await db.commit()
+    return claimed
+
+
+async def mark_outbox_sent(db: AsyncSession, outbox_ids: list[int]):
+    await db.execute(
+        update(TicketOutbox)
+        .where(TicketOutbox.id.in_(outbox_ids), TicketOutbox.status == "in_flight")
+        .values(status="sent", sent_at=datetime.now(), last_error=None)
+        .execution_options(synchronize_session=False)
+    )
+    await db.commit()
+
+
+async def release_outbox(db: AsyncSession, outbox_ids: list[int], error: str, retry_delay: float,
+                         max_attempts: int) -> list[int]:
+    """
+    Возвращает тикеты в pending с задержкой retry_delay; исчерпавшие max_attempts помечаются failed.
+    Их диалоги в той же транзакции эскалируются оператору (сообщение + запись в logs), чтобы тикет
+    не остался висеть в active без ответа; уже закрытые или эскалированные диалоги не трогаются.
+    Возвращает id диалогов, переведённых в escalated.
+    """
+    released = (await db.execute(
+        update(TicketOutbox)
+        .where(TicketOutbox.id.in_(outbox_ids), TicketOutbox.status == "in_flight")
+        .values(
+            status=case((TicketOutbox.attempts >= max_attempts, "failed"), else_="pending"),
+            available_at=datetime.now() + timedelta(seconds=retry_delay),
+            last_error=error[:1000],
+        )
+        .returning(TicketOutbox.dialog_id, TicketOutbox.status)
+        .execution_options(synchronize_session=False)
+    )).all()
+    failed_dialog_ids = {dialog_id for dialog_id, status in released if status == "failed"}
+
+    escalated = []
+    if failed_dialog_ids:
+        now = datetime.now()
+        dialogs = (await db.scalars(
+            select(Dialog).where(Dialog.id.in_(failed_dialog_ids)).order_by(Dialog.id).with_for_update()
+        )).all()
+        logs, messages, rollup_rows = [], [], []
+        for dialog in dialogs:
+            # Диалог уже закрыт или эскалирован (например, результат ML пришёл, пока отправка падала)
+            if dialog.status != "active":
+                continue
+            dialog.status = "escalated"
+            rollup_rows.extend(_rollup_transition_rows(dialog, "active", dialog.type))
+            escalated.append(dialog.id)
+            logs.append({"event_type": "dispatch_failed", "dialog_id": dialog.id, "success": False,
+                         "details": {"attempts": max_attempts, "error": error[:1000]}, "created_at": now})
+            messages.append({"dialog_id": dialog.id, "timestamp": now, "is_relevant": True,
+                             "content": f"[ML ERROR] Тикет не передан в ML после {max_attempts} попыток: {error[:200]}"})
+        if logs:
+            await db.execute(insert(Log), logs)
+            await db.execute(insert(Message), messages)
+        if rollup_rows:
+            await db.execute(_rollup_upsert_many_stmt(_merge_rollup_rows(rollup_rows)))
+    await db.commit()
+    return escalated
+
+
+async def requeue_expired_outbox(db: AsyncSession) -> int:
+    """Возвращает в pending тикеты, застрявшие в in_flight дольше visibility timeout (например, после рестарта)."""
+    result = await db.execute(
+        update(TicketOutbox)
+        .where(TicketOutbox.status == "in_flight", TicketOutbox.available_at <= datetime.now())
+        .values(status="pending")
+        .execution_options(synchronize_session=False)
+    )
+    await db.commit()
+    return result.rowcount
+
+
+async def count_outbox_by_status(db: AsyncSession) -> dict[str, int]:
+    rows = await db.execute(select(TicketOutbox.status, func.count(TicketOutbox.id)).group_by(TicketOutbox.status))
+    return {status: count for status, count in rows}
@@ -1,18 +1,75 @@
+import os
+import random
+
 from sqlalchemy.orm import Session
-from sqlalchemy import select
-from datetime import datetime
+from sqlalchemy import select, true, func, delete, insert, literal
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from datetime import datetime, timedelta
 from ..db.models import (
-    Dialog, Message, Feedback, Tool, ToolInvocation, Log
+    Dialog, Message, Feedback, Tool, ToolInvocation, Log, DialogStatsRollup, TicketOutbox
 )
 
+# Число строк rollup-таблицы на один ключ (bucket, status, type), см. DialogStatsRollup
+ROLLUP_SHARDS = max(1, int(os.getenv("ROLLUP_SHARDS", 8)))
+
+
 def create_dialog(db: Session, session_id: str) -> Dialog:
-    dialog = Dialog(session_id=session_id)
+    dialog = Dialog(session_id=session_id, status="active", created_at=datetime.now())
     db.add(dialog)
+    record_dialog_created(db, dialog)
     db.commit()
     db.refresh(dialog)
     return dialog
 
 
+def _intake_stmt(session_id: str, content: str, created_at: datetime):
+    """
+    INSERT диалога, его первого сообщения и строки outbox одним выражением:
+    WITH d AS (INSERT INTO dialogs ... RETURNING id), m AS (INSERT INTO messages SELECT ... RETURNING dialog_id)
+    INSERT INTO ticket_outbox SELECT ... RETURNING dialog_id.
+    """
+    new_dialog = (
+        insert(Dialog)
+        .values(session_id=session_id, status="active", created_at=created_at)
+        .returning(Dialog.id)
+        .cte("new_dialog")
+    )
+    new_message = (
+        insert(Message)
+        .from_select(
+            ["dialog_id", "content", "timestamp", "is_relevant"],
+            select(new_dialog.c.id, literal(content), literal(created_at), literal(True)),
+        )
+        .returning(Message.dialog_id, Message.content)
+        .cte("new_message")
+    )
+    return (
+        insert(TicketOutbox)
+        .from_select(
+            ["dialog_id", "user_query", "status", "attempts", "available_at", "created_at"],
+            select(new_message.c.dialog_id, new_message.c.content, literal("pending"), literal(0),
+                   literal(created_at), literal(created_at)),
+        )
+        .returning(TicketOutbox.dialog_id)
+    )
+
+
+def _outbox_rows(dialog_ids: list[int], contents: list[str], created_at: datetime) -> list[dict]:
+    return [
+        {"dialog_id": dialog_id, "user_query": content, "status": "pending", "attempts": 0,
+         "available_at": created_at, "created_at": created_at}
+        for dialog_id, content in zip(dialog_ids, contents)
+    ]
+
+
+def _bulk_dialogs_stmt():
+    return insert(Dialog).returning(Dialog.id, sort_by_parameter_order=True)
+
+
+def _intake_rollup_stmt(created_at: datetime, count: int):
+    return _rollup_upsert_stmt(_minute_bucket(created_at), "active", None, dialogs=count)
+
+
 def get_dialog(db: Session, dialog_id: int) -> Dialog | None:
     return db.query(Dialog).filter(Dialog.id == dialog_id).first()
 
@@ -20,7 +77,9 @@ def get_dialog(db: Session, dialog_id: int) -> Dialog | None:
 def update_dialog_status(db: Session, dialog_id: int, status: str) -> Dialog | None:
     dialog = db.query(Dialog).filter(Dialog.id == dialog_id).first()
     if dialog:
+        old_status, old_type = dialog.status, dialog.type
         dialog.status = status
+        record_dialog_transition(db, dialog, old_status, old_type)
         db.commit()
         db.refresh(dialog)
     return dialog
@@ -28,9 +87,11 @@ def update_dialog_status(db: Session, dialog_id: int, status: str) -> Dialog | N
 def close_dialog(db: Session, dialog_id: int, type: str | None = None) -> Dialog | None:
     dialog = db.query(Dialog).filter(Dialog.id == dialog_id).first()
     if dialog:
+        old_status, old_type = dialog.status, dialog.type
         dialog.status = "closed"
         dialog.type = type
         dialog.resolved_at = datetime.now()
+        record_dialog_transition(db, dialog, old_status, old_type)
         db.commit()
         db.refresh(dialog)
     return dialog
@@ -41,6 +102,356 @@ def get_dialogs_by_status(db: Session, status: str | None = None) -> list[Dialog
         query = query.filter(Dialog.status == status)
     return query.order_by(Dialog.created_at.desc()).all()
 
+DIALOG_CARD_FIELDS = ("id", "session_id", "status", "type", "created_at", "resolved_at", "user_query", "ml_result")
+
+
+def _dialog_cards_stmt(status: str | None, after_id: int | None, limit: int, fields: set[str]):
+    need_log = bool(fields & {"user_query", "ml_result"})
+    need_message = "user_query" in fields
+
+    columns = [Dialog.id, Dialog.session_id, Dialog.status, Dialog.type, Dialog.created_at, Dialog.resolved_at]
+    stmt = select(*columns)
+
+    if need_log:
+        ml_log = (
+            select(Log.details)
+            .where(Log.dialog_id == Dialog.id, Log.event_type == "ml_result")
+            .order_by(Log.created_at.desc())
+            .limit(1)
+            .lateral("ml_log")
+        )
+        stmt = stmt.add_columns(ml_log.c.details.label("ml_details")).outerjoin(ml_log, true())
+    if need_message:
+        first_message = (
+            select(Message.content)
+            .where(Message.dialog_id == Dialog.id)
+            .order_by(Message.timestamp.asc())
+            .limit(1)
+            .lateral("first_message")
+        )
+        stmt = stmt.add_columns(first_message.c.content.label("first_message")).outerjoin(first_message, true())
+
+    stmt = _filter_status(stmt, status)
+    if after_id is not None:
+        stmt = stmt.where(Dialog.id < after_id)
+    return stmt.order_by(Dialog.id.desc()).limit(limit)
+
+
+def _format_dialog_cards(rows, fields: set[str]) -> list[dict]:
+    need_log = bool(fields & {"user_query", "ml_result"})
+    need_message = "user_query" in fields
+
+    cards = []
+    for row in rows:
+        details = row.ml_details if need_log else None
+        card = {
+            "id": row.id,
+            "session_id": row.session_id,
+            "status": row.status,
+            "type": row.type,
+            "created_at": row.created_at.isoformat() if row.created_at else None,
+            "resolved_at": row.resolved_at.isoformat() if row.resolved_at else None,
+        }
+        if "ml_result" in fields:
+            card["ml_result"] = details.get("ml_result") if details else None
+        if need_message:
+            card["user_query"] = (details.get("ml_result") or {}).get("user_query") if details else (
+                row.first_message if row.first_message else "Запрос не найден")
+        cards.append({key: value for key, value in card.items() if key in fields})
+    return cards
+
+
+def get_dialog_cards(db: Session, status: str | None = None, after_id: int | None = None, limit: int = 100,
+                     fields: set[str] | None = None) -> list[dict]:
+    """
+    Карточки диалогов для дашборда одним запросом: последний ml_result-лог и первое сообщение
+    подтягиваются через LATERAL-подзапросы. Keyset-пагинация по убыванию id (after_id — последний id
+    предыдущей страницы). fields ограничивает набор полей; лишние подзапросы при этом не выполняются.
+    """
+    fields = set(fields or DIALOG_CARD_FIELDS)
+    return _format_dialog_cards(db.execute(_dialog_cards_stmt(status, after_id, limit, fields)), fields)
+
+TIME_BUCKETS = ("minute", "hour", "day", "week", "month")
+
+_resolution_seconds = func.extract("epoch", Dialog.resolved_at - Dialog.created_at)
+
+
+def _filter_status(stmt, status: str | None):
+    if status and status.lower() != "all":
+        stmt = stmt.where(Dialog.status == status)
+    return stmt
+
+
+def _group_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def _count_dialogs_stmt(status: str | None):
+    return _filter_status(select(func.count(Dialog.id)), status)
+
+
+def count_dialogs(db: Session, status: str | None = None) -> int:
+    return db.execute(_count_dialogs_stmt(status)).scalar_one()
+
+
+def _average_resolution_time_stmt():
+    return select(func.avg(Dialog.resolved_at - Dialog.created_at)).where(
+        Dialog.status == "closed", Dialog.resolved_at.is_not(None)
+    )
+
+
+def get_average_resolution_time(db: Session) -> timedelta | None:
+    return db.execute(_average_resolution_time_stmt()).scalar_one()
+
+
+def _resolution_time_stats_stmt(group_by: str | None, bucket: str, since: datetime | None):
+    key = None
+    if group_by == "type":
+        key = Dialog.type
+    elif group_by == "bucket":
+        key = func.date_trunc(bucket, Dialog.resolved_at)
+
+    columns = [
+        func.count(Dialog.id).label("count"),
+        func.avg(_resolution_seconds).label("avg_sec"),
+        func.percentile_cont(0.5).within_group(_resolution_seconds).label("p50_sec"),
+        func.percentile_cont(0.9).within_group(_resolution_seconds).label("p90_sec"),
+        func.percentile_cont(0.99).within_group(_resolution_seconds).label("p99_sec"),
+    ]
+    if key is not None:
+        columns.insert(0, key.label("key"))
+
+    stmt = select(*columns).where(Dialog.status == "closed", Dialog.resolved_at.is_not(None))
+    if since is not None:
+        stmt = stmt.where(Dialog.resolved_at >= since)
+    if key is not None:
+        stmt = stmt.group_by(key).order_by(key)
+    return stmt
+
+
+def _format_stats_rows(rows, group_by: str | None) -> list[dict]:
+    stats = []
+    for row in rows:
+        item = {name: (float(value) if value is not None and name != "count" else value)
+                for name, value in row.items() if name != "key"}
+        if group_by is not None:
+            item[group_by] = _group_value(row["key"])
+        stats.append(item)
+    return stats
+
+
+def get_resolution_time_stats(db: Session, group_by: str | None = None, bucket: str = "hour",
+                              since: datetime | None = None) -> list[dict]:
+    """
+    Число закрытых диалогов, среднее и перцентили p50/p90/p99 времени решения (в секундах).
+    group_by: None — одна строка на всё, "type" — по категории, "bucket" — по интервалу времени закрытия.
+    """
+    rows = db.execute(_resolution_time_stats_stmt(group_by, bucket, since)).mappings()
+    return _format_stats_rows(rows, group_by)
+
+
+def _count_dialogs_grouped_stmt(group_by: str, status: str | None, bucket: str, since: datetime | None):
+    key = Dialog.type if group_by == "type" else func.date_trunc(bucket, Dialog.created_at)
+
+    stmt = _filter_status(select(key.label("key"), func.count(Dialog.id).label("count")), status)
+    if since is not None:
+        stmt = stmt.where(Dialog.created_at >= since)
+    return stmt.group_by(key).order_by(key)
+
+
+def count_dialogs_grouped(db: Session, group_by: str, status: str | None = None, bucket: str = "hour",
+                          since: datetime | None = None) -> list[dict]:
+    """Число диалогов по категории (group_by="type") или по интервалу создания (group_by="bucket")."""
+    rows = db.execute(_count_dialogs_grouped_stmt(group_by, status, bucket, since))
+    return [{group_by: _group_value(row.key), "count": row.count} for row in rows]
+
+
+def _minute_bucket(ts: datetime) -> datetime:
+    return ts.replace(second=0, microsecond=0)
+
+
+def _rollup_row(bucket: datetime, status: str, dialog_type: str | None,
+                dialogs: int = 0, resolved: int = 0, resolution_sec: float = 0.0) -> dict:
+    return {"bucket": bucket, "status": status, "type": dialog_type or "",
+            "dialogs": dialogs, "resolved": resolved, "resolution_sec_sum": resolution_sec}
+
+
+def _rollup_upsert_many_stmt(rows: list[dict]):
+    """
+    Многострочный upsert приращений; ключи (bucket, status, type) в rows должны быть уникальны.
+    Все строки выражения пишутся в один случайный shard, поэтому порядок блокировок остаётся порядком rows.
+    """
+    shard = random.randrange(ROLLUP_SHARDS)
+    stmt = pg_insert(DialogStatsRollup).values([{**row, "shard": shard} for row in rows])
+    return stmt.on_conflict_do_update(
+        index_elements=[DialogStatsRollup.bucket, DialogStatsRollup.status, DialogStatsRollup.type,
+                        DialogStatsRollup.shard],
+        set_={
+            "dialogs": DialogStatsRollup.dialogs + stmt.excluded.dialogs,
+            "resolved": DialogStatsRollup.resolved + stmt.excluded.resolved,
+            "resolution_sec_sum": DialogStatsRollup.resolution_sec_sum + stmt.excluded.resolution_sec_sum,
+        },
+    )
+
+
+def _rollup_upsert_stmt(bucket: datetime, status: str, dialog_type: str | None,
+                        dialogs: int = 0, resolved: int = 0, resolution_sec: float = 0.0):
+    return _rollup_upsert_many_stmt([_rollup_row(bucket, status, dialog_type, dialogs, resolved, resolution_sec)])
+
+
+def _merge_rollup_rows(rows: list[dict]) -> list[dict]:
+    """
+    Складывает приращения с одинаковым ключом (bucket, status, type). Строки возвращаются отсортированными
+    по ключу: все upsert'ы блокируют строки rollup в одном порядке и не взаимоблокируются.
+    """
+    merged: dict[tuple, dict] = {}
+    for row in rows:
+        key = (row["bucket"], row["status"], row["type"])
+        if key not in merged:
+            merged[key] = dict(row)
+            continue
+        for field in ("dialogs", "resolved", "resolution_sec_sum"):
+            merged[key][field] += row[field]
+    return sorted(merged.values(), key=lambda r: (r["bucket"], r["status"], r["type"]))
+
+
+def _rollup_created_stmts(dialog: Dialog) -> list:
+    return [_rollup_upsert_stmt(_minute_bucket(dialog.created_at), dialog.status, dialog.type, dialogs=1)]
+
+
+def _rollup_transition_rows(dialog: Dialog, old_status: str, old_type: str | None) -> list[dict]:
+    rows = []
+    created_bucket = _minute_bucket(dialog.created_at)
+    if (old_status, old_type or "") != (dialog.status, dialog.type or ""):
+        rows.append(_rollup_row(created_bucket, old_status, old_type, dialogs=-1))
+        rows.append(_rollup_row(created_bucket, dialog.status, dialog.type, dialogs=1))
+    if dialog.status == "closed" and old_status != "closed" and dialog.resolved_at:
+        rows.append(_rollup_row(
+            _minute_bucket(dialog.resolved_at), "closed", dialog.type, resolved=1,
+            resolution_sec=(dialog.resolved_at - dialog.created_at).total_seconds(),
+        ))
+    return rows
+
+
+def _rollup_transition_stmts(dialog: Dialog, old_status: str, old_type: str | None) -> list:
+    rows = _rollup_transition_rows(dialog, old_status, old_type)
+    return [_rollup_upsert_many_stmt(_merge_rollup_rows(rows))] if rows else []
+
+
+def record_dialog_created(db: Session, dialog: Dialog):
+    """Учитывает новый диалог в rollup-таблице. Коммит — на вызывающей стороне, вместе с самим диалогом."""
+    for stmt in _rollup_created_stmts(dialog):
+        db.execute(stmt)
+
+
+def record_dialog_transition(db: Session, dialog: Dialog, old_status: str, old_type: str | None):
+    """
+    Переносит диалог между (status, type) в rollup-таблице и учитывает закрытие.
+    Вызывается после изменения полей диалога и до commit().
+    """
+    for stmt in _rollup_transition_stmts(dialog, old_status, old_type):
+        db.execute(stmt)
+
+
+def rebuild_rollups(db: Session):
+    """Полный пересчёт rollup-таблицы по dialogs (для существующих баз)."""
+    db.execute(delete(DialogStatsRollup))
+    created = (
+        select(
+            func.date_trunc("minute", Dialog.created_at).label("bucket"),
+            Dialog.status.label("status"),
+            func.coalesce(Dialog.type, "").label("type"),
+            func.count(Dialog.id).label("dialogs"),
+        )
+        .group_by("bucket", "status", "type")
+    )
+    for row in db.execute(created):
+        db.execute(_rollup_upsert_stmt(row.bucket, row.status, row.type, dialogs=row.dialogs))
+    resolved = (
+        select(
+            func.date_trunc("minute", Dialog.resolved_at).label("bucket"),
+            func.coalesce(Dialog.type, "").label("type"),
+            func.count(Dialog.id).label("resolved"),
+            func.sum(_resolution_seconds).label("resolution_sec"),
+        )
+        .where(Dialog.status == "closed", Dialog.resolved_at.is_not(None))
+        .group_by("bucket", "type")
+    )
+    for row in db.execute(resolved):
+        db.execute(_rollup_upsert_stmt(row.bucket, "closed", row.type, resolved=row.resolved,
+                                       resolution_sec=float(row.resolution_sec or 0.0)))
+    db.commit()
+
+
+def _rollup_key(group_by: str | None, bucket: str):
+    if group_by == "type":
+        return func.nullif(DialogStatsRollup.type, "")
+    if group_by == "bucket":
+        return func.date_trunc(bucket, DialogStatsRollup.bucket)
+    return None
+
+
+def _rollup_counts_stmt(group_by: str | None, status: str | None, bucket: str, since: datetime | None):
+    key = _rollup_key(group_by, bucket)
+    total = func.coalesce(func.sum(DialogStatsRollup.dialogs), 0)
+
+    stmt = select(total.label("count")) if key is None else select(key.label("key"), total.label("count"))
+    if status and status.lower() != "all":
+        stmt = stmt.where(DialogStatsRollup.status == status)
+    if since is not None:
+        stmt = stmt.where(DialogStatsRollup.bucket >= _minute_bucket(since))
+    if key is not None:
+        stmt = stmt.group_by(key).order_by(key)
+    return stmt
+
+
+def _format_rollup_counts(rows, group_by: str) -> list[dict]:
+    return [{group_by: _group_value(row.key), "count": row.count} for row in rows if row.count]
+
+
+def get_rollup_counts(db: Session, group_by: str | None = None, status: str | None = None,
+                      bucket: str = "hour", since: datetime | None = None) -> int | list[dict]:
+    """Число диалогов только по rollup-таблице: всего, по категории или по интервалу создания."""
+    result = db.execute(_rollup_counts_stmt(group_by, status, bucket, since))
+    if group_by is None:
+        return result.scalar_one()
+    return _format_rollup_counts(result, group_by)
+
+
+def _rollup_resolution_time_stmt(group_by: str | None, bucket: str, since: datetime | None):
+    key = _rollup_key(group_by, bucket)
+    resolved = func.sum(DialogStatsRollup.resolved)
+    columns = [
+        resolved.label("count"),
+        (func.sum(DialogStatsRollup.resolution_sec_sum) / func.nullif(resolved, 0)).label("avg_sec"),
+    ]
+    if key is not None:
+        columns.insert(0, key.label("key"))
+
+    stmt = select(*columns).where(DialogStatsRollup.resolved > 0)
+    if since is not None:
+        stmt = stmt.where(DialogStatsRollup.bucket >= _minute_bucket(since))
+    if key is not None:
+        stmt = stmt.group_by(key).order_by(key)
+    return stmt
+
+
+def _format_rollup_resolution_time(rows, group_by: str | None) -> list[dict]:
+    stats = []
+    for row in rows:
+        item = {"count": row.count or 0, "avg_sec": float(row.avg_sec) if row.avg_sec is not None else None}
+        if group_by is not None:
+            item[group_by] = _group_value(row.key)
+        stats.append(item)
+    return stats
+
+
+def get_rollup_resolution_time(db: Session, group_by: str | None = None, bucket: str = "hour",
+                               since: datetime | None = None) -> list[dict]:
+    """Число закрытий и среднее время решения (сек) только по rollup-таблице."""
+    rows = db.execute(_rollup_resolution_time_stmt(group_by, bucket, since))
+    return _format_rollup_resolution_time(rows, group_by)
+
 def get_dialogs_by_type(db: Session, dialog_type: str) -> list[Dialog]:
     return db.query(Dialog).filter(Dialog.type == dialog_type).all()
 
@@ -1,6 +1,25 @@
+from pathlib import Path
+
+from alembic import command
+from alembic.config import Config
+
 from .models import *
-from .session import engine
+from .session import engine, SessionLocal
+from ..crud.base_crud import rebuild_rollups
+
+ALEMBIC_INI = Path(__file__).resolve().parents[2] / "alembic.ini"
 
 print("Инициализация базы данных...")
 Base.metadata.create_all(bind=engine)
 print("Таблицы успешно созданы!")
+
+# Миграции докатывают изменения схемы (индексы и т.п.) до баз, созданных старыми версиями
+print("Применение миграций...")
+command.upgrade(Config(str(ALEMBIC_INI)), "head")
+print("Миграции применены.")
+
+with SessionLocal() as db:
+    if db.query(DialogStatsRollup).first() is None and db.query(Dialog).first() is not None:
+        print("Пересчёт rollup-статистики по существующим диалогам...")
+        rebuild_rollups(db)
+        print("Rollup-статистика пересчитана.")
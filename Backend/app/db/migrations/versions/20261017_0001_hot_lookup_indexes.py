@@ -0,0 +1,42 @@
+"""hot lookup indexes
+
+Индексы под фактические запросы base_crud и /statistic. Создаются CONCURRENTLY и с IF NOT EXISTS:
+на существующей базе таблицы не блокируются на запись, а на новой (где индексы уже
+созданы через create_all) миграция ничего не делает.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ("ix_dialogs_status_id", "dialogs", ["status", "id"], {}),
+    ("ix_dialogs_status_created_at", "dialogs", ["status", "created_at"], {}),
+    ("ix_dialogs_type", "dialogs", ["type"], {}),
+    ("ix_dialogs_closed_resolved_at", "dialogs", ["resolved_at"],
+     {"postgresql_where": sa.text("status = 'closed'")}),
+    ("ix_messages_dialog_id_timestamp", "messages", ["dialog_id", "timestamp"], {}),
+    ("ix_logs_dialog_id_event_type_created_at", "logs", ["dialog_id", "event_type", "created_at"], {}),
+    ("ix_tool_invocations_tool_id", "tool_invocations", ["tool_id"], {}),
+    ("ix_tool_invocations_dialog_id", "tool_invocations", ["dialog_id"], {}),
+]
+
+
+def upgrade():
+    with op.get_context().autocommit_block():
+        for name, table, columns, kwargs in INDEXES:
+            op.create_index(name, table, columns, if_not_exists=True, postgresql_concurrently=True, **kwargs)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, _, _ in reversed(INDEXES):
+            op.drop_index(name, table_name=table, if_exists=True, postgresql_concurrently=True)
@@ -0,0 +1,65 @@
+"""outbox and rollup tables
+
+Таблицы ticket_outbox (очередь отправки тикетов в ML) и dialog_stats_rollup (агрегаты дашборда).
+На новой базе их уже создал create_all, и миграция только проверяет схему. На базе, где rollup-таблица
+создана до появления shard, она пересоздаётся: это производные данные, init_db пересчитает их по dialogs.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+
+def _create_rollup_table():
+    op.create_table(
+        "dialog_stats_rollup",
+        sa.Column("bucket", sa.DateTime(), nullable=False),
+        sa.Column("status", sa.String(), nullable=False),
+        sa.Column("type", sa.String(), nullable=False, server_default=""),
+        sa.Column("shard", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("dialogs", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("resolved", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("resolution_sec_sum", sa.Float(), nullable=False, server_default="0"),
+        sa.PrimaryKeyConstraint("bucket", "status", "type", "shard"),
+    )
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    tables = inspector.get_table_names()
+
+    if "ticket_outbox" not in tables:
+        op.create_table(
+            "ticket_outbox",
+            sa.Column("id", sa.Integer(), primary_key=True),
+            sa.Column("dialog_id", sa.Integer(), sa.ForeignKey("dialogs.id"), nullable=False, unique=True),
+            sa.Column("user_query", sa.String(), nullable=False),
+            sa.Column("status", sa.String(), nullable=False, server_default="pending"),
+            sa.Column("attempts", sa.Integer(), nullable=False, server_default="0"),
+            sa.Column("available_at", sa.DateTime(), nullable=False, server_default=sa.func.now()),
+            sa.Column("created_at", sa.DateTime(), nullable=True),
+            sa.Column("sent_at", sa.DateTime(), nullable=True),
+            sa.Column("last_error", sa.String(), nullable=True),
+        )
+    op.create_index("ix_ticket_outbox_status_available_at", "ticket_outbox", ["status", "available_at"],
+                    if_not_exists=True, postgresql_where=sa.text("status IN ('pending', 'in_flight')"))
+
+    if "dialog_stats_rollup" not in tables:
+        _create_rollup_table()
+    elif "shard" not in {column["name"] for column in inspector.get_columns("dialog_stats_rollup")}:
+        op.drop_table("dialog_stats_rollup")
+        _create_rollup_table()
+
+
+def downgrade():
+    op.drop_table("dialog_stats_rollup", if_exists=True)
+    op.drop_index("ix_ticket_outbox_status_available_at", table_name="ticket_outbox", if_exists=True)
+    op.drop_table("ticket_outbox", if_exists=True)
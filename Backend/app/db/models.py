@@ -1,5 +1,5 @@
 from sqlalchemy import (
-    Column, Integer, String, DateTime, ForeignKey, Enum, JSON, Boolean
+    Column, Integer, String, DateTime, ForeignKey, Enum, JSON, Boolean, Float, Index, text
 )
 from datetime import datetime
 from sqlalchemy.orm import relationship
@@ -20,6 +20,16 @@ class Dialog(Base):
     feedback = relationship("Feedback", back_populates="dialog", uselist=False)
     tool_invocations = relationship("ToolInvocation", back_populates="dialog")
 
+    __table_args__ = (
+        # карточки дашборда: фильтр по статусу + keyset-пагинация по id
+        Index("ix_dialogs_status_id", "status", "id"),
+        # выборки и счётчики по статусу с сортировкой/группировкой по времени создания
+        Index("ix_dialogs_status_created_at", "status", "created_at"),
+        Index("ix_dialogs_type", "type"),
+        # статистика времени решения: только закрытые диалоги, фильтр по resolved_at
+        Index("ix_dialogs_closed_resolved_at", "resolved_at", postgresql_where=text("status = 'closed'")),
+    )
+
 class Message(Base):
     __tablename__ = "messages"
 
@@ -31,6 +41,11 @@ class Message(Base):
 
     dialog = relationship("Dialog", back_populates="messages")
 
+    __table_args__ = (
+        # первое сообщение диалога и история сообщений по времени
+        Index("ix_messages_dialog_id_timestamp", "dialog_id", "timestamp"),
+    )
+
 class Feedback(Base):
     __tablename__ = "feedback"
 
@@ -65,6 +80,11 @@ class ToolInvocation(Base):
     tool = relationship("Tool", back_populates="invocations")
     dialog = relationship("Dialog", back_populates="tool_invocations")
 
+    __table_args__ = (
+        Index("ix_tool_invocations_tool_id", "tool_id"),
+        Index("ix_tool_invocations_dialog_id", "dialog_id"),
+    )
+
 class Log(Base):
     __tablename__ = "logs"
 
@@ -74,3 +94,50 @@ class Log(Base):
     success = Column(Boolean, default=True)
     details = Column(JSON)
     created_at = Column(DateTime, default=datetime.now)
+
+    __table_args__ = (
+        # последний ml_result-лог диалога
+        Index("ix_logs_dialog_id_event_type_created_at", "dialog_id", "event_type", "created_at"),
+    )
+
+class DialogStatsRollup(Base):
+    """
+    Поминутные агрегаты для дашборда, обновляются в тех же транзакциях, что и диалоги.
+    dialogs — число диалогов, созданных в bucket и находящихся сейчас в (status, type);
+    resolved/resolution_sec_sum — закрытия, пришедшиеся на bucket, и суммарное время решения.
+    Каждый ключ разбит на ROLLUP_SHARDS строк (shard): транзакция пишет в случайную, чтение суммирует все,
+    поэтому параллельный приём не упирается в блокировку одной строки текущей минуты.
+    """
+    __tablename__ = "dialog_stats_rollup"
+
+    bucket = Column(DateTime, primary_key=True)
+    status = Column(String, primary_key=True)
+    type = Column(String, primary_key=True, default="")
+    shard = Column(Integer, primary_key=True, default=0)
+    dialogs = Column(Integer, nullable=False, default=0)
+    resolved = Column(Integer, nullable=False, default=0)
+    resolution_sec_sum = Column(Float, nullable=False, default=0.0)
+
+class TicketOutbox(Base):
+    """
+    Outbox тикетов для отправки в ML. Строка создаётся в одной транзакции с диалогом,
+    диспетчер забирает строки через SELECT ... FOR UPDATE SKIP LOCKED.
+    pending -> in_flight (до available_at = visibility timeout) -> sent | failed.
+    """
+    __tablename__ = "ticket_outbox"
+
+    id = Column(Integer, primary_key=True)
+    dialog_id = Column(Integer, ForeignKey("dialogs.id"), nullable=False, unique=True)
+    user_query = Column(String, nullable=False)
+    status = Column(String, nullable=False, default="pending")
+    attempts = Column(Integer, nullable=False, default=0)
+    available_at = Column(DateTime, nullable=False, default=datetime.now)
+    created_at = Column(DateTime, default=datetime.now)
+    sent_at = Column(DateTime, nullable=True)
+    last_error = Column(String, nullable=True)
+
+    __table_args__ = (
+        # выборка готовых к отправке и просроченных in_flight строк
+        Index("ix_ticket_outbox_status_available_at", "status", "available_at",
+              postgresql_where=text("status IN ('pending', 'in_flight')")),
+    )
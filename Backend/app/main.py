@@ -1,10 +1,23 @@
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from .api.routers.routers import r as test_router
 from .api.routers.ml_tickets import router as ticket_router
+from .services.http_pool import start_http_clients, close_http_clients
+from .services.dispatcher import ticket_dispatcher
 from fastapi.middleware.cors import CORSMiddleware
 
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await start_http_clients("ml", "simulator")
+    await ticket_dispatcher.start()
+    yield
+    await ticket_dispatcher.stop()
+    await close_http_clients()
+
+
+app = FastAPI(lifespan=lifespan)
 
 origins = [
     "http://localhost:5173",
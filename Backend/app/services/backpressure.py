@@ -0,0 +1,109 @@
+# app/services/backpressure.py
+import logging
+import os
+import time
+
+from dotenv import load_dotenv
+
+from .http_pool import get_client
+
+load_dotenv()
+
+logger = logging.getLogger("backpressure")
+
+ML_API_URL = os.getenv("ML_API_URL", "http://ml-api:8001")
+ML_STATS_POLL_PERIOD = float(os.getenv("ML_STATS_POLL_PERIOD", 2.0))
+ML_TARGET_LAG_SEC = float(os.getenv("ML_TARGET_LAG_SEC", 30.0))
+DISPATCH_RATE_INITIAL = float(os.getenv("DISPATCH_RATE_INITIAL", 10.0))
+DISPATCH_RATE_MIN = float(os.getenv("DISPATCH_RATE_MIN", 1.0))
+DISPATCH_RATE_MAX = float(os.getenv("DISPATCH_RATE_MAX", 500.0))
+DISPATCH_RATE_INCREASE = float(os.getenv("DISPATCH_RATE_INCREASE", 2.0))
+DISPATCH_RATE_DECREASE = float(os.getenv("DISPATCH_RATE_DECREASE", 0.5))
+# 0 — приём обращений не ограничивается
+INTAKE_MAX_LAG_SEC = float(os.getenv("INTAKE_MAX_LAG_SEC", 120.0))
+
+
+class AimdRateLimiter:
+    """
+    Token bucket, скорость пополнения которого подстраивается по AIMD:
+    пока ML успевает — скорость растёт на increase тикетов/с за шаг, при перегрузке умножается на decrease.
+    Снижение не чаще раза в cooldown секунд, чтобы одна волна ошибок не обнуляла скорость.
+    """
+
+    def __init__(self, rate: float, min_rate: float, max_rate: float, increase: float, decrease: float,
+                 burst: float, cooldown: float):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.burst = burst
+        self.cooldown = cooldown
+        self._tokens = burst
+        self._updated_at = time.monotonic()
+        self._decreased_at = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def available(self) -> int:
+        self._refill()
+        return int(self._tokens)
+
+    def consume(self, count: int):
+        self._refill()
+        self._tokens -= count
+
+    def wait_time(self) -> float:
+        """Через сколько секунд появится хотя бы один токен."""
+        self._refill()
+        return max(0.0, (1 - self._tokens) / self.rate)
+
+    def on_healthy(self):
+        self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_congestion(self):
+        now = time.monotonic()
+        if now - self._decreased_at < self.cooldown:
+            return
+        self._decreased_at = now
+        self.rate = max(self.min_rate, self.rate * self.decrease)
+        logger.warning("ML overloaded, dispatch rate decreased to %.2f tickets/s", self.rate)
+
+
+class MLLoadMonitor:
+    """Последние показатели очереди ML (GET /api/v1/agent/queue/stats)."""
+
+    def __init__(self):
+        self.queue_depth = 0
+        self.lag_sec = 0.0
+        self.service_time_sec = 0.0
+        self.updated_at: float | None = None
+        self.errors_total = 0
+
+    async def poll(self) -> bool:
+        """Обновляет показатели; False, если ML не ответил."""
+        try:
+            resp = await get_client("ml").get(f"{ML_API_URL}/api/v1/agent/queue/stats", timeout=5.0)
+            resp.raise_for_status()
+            data = resp.json()
+        except Exception as e:
+            self.errors_total += 1
+            logger.warning("Failed to fetch ML queue stats: %s", e)
+            return False
+        self.queue_depth = data["queue_depth"]
+        self.lag_sec = data["estimated_lag_sec"]
+        self.service_time_sec = data["service_time_avg_sec"]
+        self.updated_at = time.monotonic()
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue_depth,
+            "lag_sec": self.lag_sec,
+            "service_time_sec": self.service_time_sec,
+            "age_sec": round(time.monotonic() - self.updated_at, 3) if self.updated_at else None,
+            "errors_total": self.errors_total,
+        }
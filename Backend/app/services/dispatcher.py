@@ -0,0 +1,250 @@
+# app/services/dispatcher.py
+import asyncio
+import logging
+import math
+import os
+
+import httpx
+
+from dotenv import load_dotenv
+
+from ..crud import async_crud
+from ..db.session import AsyncSessionLocal
+from .ml_client import submit_tickets
+from .backpressure import (
+    AimdRateLimiter, MLLoadMonitor, ML_STATS_POLL_PERIOD, ML_TARGET_LAG_SEC, INTAKE_MAX_LAG_SEC,
+    DISPATCH_RATE_INITIAL, DISPATCH_RATE_MIN, DISPATCH_RATE_MAX, DISPATCH_RATE_INCREASE, DISPATCH_RATE_DECREASE,
+)
+
+load_dotenv()
+
+logger = logging.getLogger("ticket-dispatcher")
+
+DISPATCHER_MAX_CONCURRENCY = int(os.getenv("DISPATCHER_MAX_CONCURRENCY", 5))
+DISPATCHER_BATCH_SIZE = int(os.getenv("DISPATCHER_BATCH_SIZE", 50))
+TICKET_VISIBILITY_TIMEOUT = float(os.getenv("TICKET_VISIBILITY_TIMEOUT", 60))
+TICKET_REQUEUE_CHECK_PERIOD = float(os.getenv("TICKET_REQUEUE_CHECK_PERIOD", 5.0))
+WORKER_POLL_SLEEP = float(os.getenv("WORKER_POLL_SLEEP", 0.5))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 10))
+OUTBOX_RETRY_BASE_DELAY = float(os.getenv("OUTBOX_RETRY_BASE_DELAY", 1.0))
+OUTBOX_RETRY_MAX_DELAY = float(os.getenv("OUTBOX_RETRY_MAX_DELAY", 300.0))
+
+
+class TicketDispatcher:
+    """
+    Отправляет тикеты из таблицы ticket_outbox в ML.
+    Строки забираются пачками (FOR UPDATE SKIP LOCKED), поэтому несколько экземпляров бэкенда
+    могут работать с одной таблицей. Одновременно в полёте не больше DISPATCHER_MAX_CONCURRENCY пачек,
+    в памяти — не больше DISPATCHER_MAX_CONCURRENCY * DISPATCHER_BATCH_SIZE тикетов.
+    Тикеты, не подтверждённые за TICKET_VISIBILITY_TIMEOUT (например, после рестарта), возвращаются в очередь.
+    Скорость отправки ограничена AIMD token bucket'ом по задержке очереди ML (см. backpressure.py).
+    """
+
+    def __init__(self):
+        self._wakeup = asyncio.Event()
+        self._slots = asyncio.Semaphore(DISPATCHER_MAX_CONCURRENCY)
+        self._tasks: list[asyncio.Task] = []
+        self._in_flight: set[asyncio.Task] = set()
+        self.is_running = False
+        self.sent_total = 0
+        self.failed_batches = 0
+        self.requeued_total = 0
+        self.limiter = AimdRateLimiter(
+            DISPATCH_RATE_INITIAL, DISPATCH_RATE_MIN, DISPATCH_RATE_MAX, DISPATCH_RATE_INCREASE,
+            DISPATCH_RATE_DECREASE, burst=DISPATCHER_BATCH_SIZE, cooldown=ML_STATS_POLL_PERIOD,
+        )
+        self.ml_load = MLLoadMonitor()
+        self.outbox_pending = 0
+        self._throttled = False
+        self._limited_since_poll = False
+
+    def notify(self, count: int = 1):
+        """Будит цикл диспетчера сразу после приёма count новых обращений, не дожидаясь WORKER_POLL_SLEEP."""
+        self.outbox_pending += count
+        self._wakeup.set()
+
+    def estimated_lag(self) -> float:
+        """Сколько секунд новый тикет проведёт в очередях: outbox при текущей скорости отправки + очередь ML."""
+        return self.outbox_pending / self.limiter.rate + self.ml_load.lag_sec
+
+    def intake_retry_after(self) -> int | None:
+        """Секунды для Retry-After, если задержка выше INTAKE_MAX_LAG_SEC, иначе None."""
+        if INTAKE_MAX_LAG_SEC <= 0:
+            return None
+        excess = self.estimated_lag() - INTAKE_MAX_LAG_SEC
+        if excess <= 0:
+            return None
+        return min(300, max(1, math.ceil(excess)))
+
+    async def start(self):
+        if self.is_running:
+            return
+        self.is_running = True
+        self._tasks = [
+            asyncio.create_task(self._dispatch_loop()),
+            asyncio.create_task(self._requeue_loop()),
+            asyncio.create_task(self._load_loop()),
+        ]
+        logger.info("Dispatcher started (concurrency=%s batch=%s visibility=%ss)",
+                    DISPATCHER_MAX_CONCURRENCY, DISPATCHER_BATCH_SIZE, TICKET_VISIBILITY_TIMEOUT)
+
+    async def stop(self):
+        self.is_running = False
+        self._wakeup.set()
+        for task in self._tasks:
+            task.cancel()
+        # Пачки в полёте дожидаемся: неподтверждённые всё равно вернутся по visibility timeout
+        await asyncio.gather(*self._tasks, *self._in_flight, return_exceptions=True)
+        self._tasks = []
+        logger.info("Dispatcher stopped")
+
+    async def _dispatch_loop(self):
+        while self.is_running:
+            try:
+                claimed = await self._claim()
+            except Exception as e:
+                logger.exception("Dispatcher: failed to claim tickets: %s", e)
+                claimed = 0
+            if claimed:
+                continue
+
+            if self._throttled:
+                # новые обращения не помогут, ждём токенов
+                await asyncio.sleep(min(WORKER_POLL_SLEEP, max(self.limiter.wait_time(), 0.01)))
+                continue
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=WORKER_POLL_SLEEP)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _claim(self) -> int:
+        """
+        Забирает столько тикетов, сколько позволяют свободные слоты и token bucket, и запускает их отправку.
+        Возвращает число тикетов.
+        """
+        self._throttled = self.limiter.available() < 1
+        if self._throttled:
+            self._limited_since_poll = True
+            return 0
+
+        await self._slots.acquire()
+        free = 1
+        while free < DISPATCHER_MAX_CONCURRENCY and not self._slots.locked():
+            await self._slots.acquire()
+            free += 1
+
+        try:
+            async with AsyncSessionLocal() as db:
+                limit = min(free * DISPATCHER_BATCH_SIZE, self.limiter.available())
+                rows = await async_crud.claim_outbox_batch(db, limit, TICKET_VISIBILITY_TIMEOUT)
+        except Exception:
+            for _ in range(free):
+                self._slots.release()
+            raise
+
+        self.limiter.consume(len(rows))
+        self.outbox_pending = max(0, self.outbox_pending - len(rows))
+        if len(rows) == limit and limit < free * DISPATCHER_BATCH_SIZE:
+            self._throttled = self._limited_since_poll = True
+
+        batches = [rows[i:i + DISPATCHER_BATCH_SIZE] for i in range(0, len(rows), DISPATCHER_BATCH_SIZE)]
+        for _ in range(free - len(batches)):
+            self._slots.release()
+        for batch in batches:
+            task = asyncio.create_task(self._send(batch))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+        return len(rows)
+
+    async def _send(self, rows: list):
+        ids = [row.id for row in rows]
+        try:
+            await submit_tickets([{"dialog_id": row.dialog_id, "user_query": row.user_query} for row in rows])
+            async with AsyncSessionLocal() as db:
+                await async_crud.mark_outbox_sent(db, ids)
+            self.sent_total += len(rows)
+        except Exception as e:
+            self.failed_batches += 1
+            if isinstance(e, httpx.TimeoutException) or (
+                    isinstance(e, httpx.HTTPStatusError) and e.response.status_code in (429, 503)):
+                self.limiter.on_congestion()
+            attempts = max(row.attempts for row in rows)
+            delay = min(OUTBOX_RETRY_BASE_DELAY * (2 ** (attempts - 1)), OUTBOX_RETRY_MAX_DELAY)
+            logger.warning("Dispatcher: batch of %s tickets failed (attempt %s), retry in %.1fs: %s",
+                           len(rows), attempts, delay, e)
+            try:
+                async with AsyncSessionLocal() as db:
+                    escalated = await async_crud.release_outbox(db, ids, str(e), delay, OUTBOX_MAX_ATTEMPTS)
+                if escalated:
+                    logger.error("Dispatcher: tickets for dialogs %s exhausted %s attempts, dialogs escalated",
+                                 escalated, OUTBOX_MAX_ATTEMPTS)
+            except Exception as release_error:
+                # Строки останутся in_flight и вернутся в очередь по visibility timeout
+                logger.exception("Dispatcher: failed to release tickets %s: %s", ids, release_error)
+        finally:
+            self._slots.release()
+            self._wakeup.set()
+
+    async def _requeue_loop(self):
+        while self.is_running:
+            await asyncio.sleep(TICKET_REQUEUE_CHECK_PERIOD)
+            try:
+                async with AsyncSessionLocal() as db:
+                    requeued = await async_crud.requeue_expired_outbox(db)
+            except Exception as e:
+                logger.exception("Dispatcher: requeue check failed: %s", e)
+                continue
+            if requeued:
+                self.requeued_total += requeued
+                logger.warning("Dispatcher: %s tickets exceeded visibility timeout and were requeued", requeued)
+                self._wakeup.set()
+
+    async def _load_loop(self):
+        """Раз в ML_STATS_POLL_PERIOD опрашивает нагрузку ML и размер outbox и подстраивает скорость отправки."""
+        while self.is_running:
+            await asyncio.sleep(ML_STATS_POLL_PERIOD)
+            try:
+                async with AsyncSessionLocal() as db:
+                    self.outbox_pending = (await async_crud.count_outbox_by_status(db)).get("pending", 0)
+            except Exception as e:
+                logger.exception("Dispatcher: failed to count outbox: %s", e)
+
+            if not await self.ml_load.poll():
+                continue
+            if self.ml_load.lag_sec > ML_TARGET_LAG_SEC:
+                self.limiter.on_congestion()
+            elif self._limited_since_poll:
+                # увеличиваем скорость, только если в неё действительно упирались
+                self.limiter.on_healthy()
+            self._limited_since_poll = False
+
+    async def stats(self) -> dict:
+        async with AsyncSessionLocal() as db:
+            outbox = await async_crud.count_outbox_by_status(db)
+        return {
+            "is_running": self.is_running,
+            "batches_in_flight": len(self._in_flight),
+            "sent_total": self.sent_total,
+            "failed_batches": self.failed_batches,
+            "requeued_total": self.requeued_total,
+            "outbox": outbox,
+            "dispatch_rate": round(self.limiter.rate, 3),
+            "throttled": self._throttled,
+            "estimated_lag_sec": round(self.estimated_lag(), 3),
+            "ml": self.ml_load.stats(),
+            "settings": {
+                "max_concurrency": DISPATCHER_MAX_CONCURRENCY,
+                "batch_size": DISPATCHER_BATCH_SIZE,
+                "visibility_timeout": TICKET_VISIBILITY_TIMEOUT,
+                "requeue_check_period": TICKET_REQUEUE_CHECK_PERIOD,
+                "poll_sleep": WORKER_POLL_SLEEP,
+                "max_attempts": OUTBOX_MAX_ATTEMPTS,
+                "target_ml_lag_sec": ML_TARGET_LAG_SEC,
+                "intake_max_lag_sec": INTAKE_MAX_LAG_SEC,
+            },
+        }
+
+
+ticket_dispatcher = TicketDispatcher()
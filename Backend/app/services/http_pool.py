@@ -0,0 +1,108 @@
+# app/services/http_pool.py
+import os
+import logging
+from importlib.util import find_spec
+
+import httpx
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger("http-pool")
+
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", 100))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", 20))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", 30.0))
+HTTP_POOL_TIMEOUT = float(os.getenv("HTTP_POOL_TIMEOUT", 5.0))
+# HTTP/2 включается, только если установлен пакет h2
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "true").lower() in ("1", "true", "yes") and find_spec("h2") is not None
+
+
+class _InstrumentedTransport(httpx.AsyncBaseTransport):
+    """Транспорт httpx со счётчиками запросов для метрик пула."""
+
+    def __init__(self, transport: httpx.AsyncHTTPTransport):
+        self._transport = transport
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.requests_total = 0
+        self.errors_total = 0
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.in_flight += 1
+        self.requests_total += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            return await self._transport.handle_async_request(request)
+        except Exception:
+            self.errors_total += 1
+            raise
+        finally:
+            self.in_flight -= 1
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+    def stats(self) -> dict:
+        connections = getattr(getattr(self._transport, "_pool", None), "connections", [])
+        idle = sum(1 for conn in connections if conn.is_idle())
+        return {
+            "in_flight": self.in_flight,
+            "peak_in_flight": self.peak_in_flight,
+            "requests_total": self.requests_total,
+            "errors_total": self.errors_total,
+            "connections_open": len(connections),
+            "connections_idle": idle,
+        }
+
+
+_clients: dict[str, httpx.AsyncClient] = {}
+_transports: dict[str, _InstrumentedTransport] = {}
+
+
+def get_client(name: str) -> httpx.AsyncClient:
+    """
+    Возвращает общий keep-alive клиент для направления name ("ml", "simulator", ...).
+    Клиенты живут всё время работы приложения и закрываются в close_http_clients().
+    """
+    client = _clients.get(name)
+    if client is None or client.is_closed:
+        transport = _InstrumentedTransport(httpx.AsyncHTTPTransport(
+            http2=HTTP2_ENABLED,
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ),
+        ))
+        client = httpx.AsyncClient(transport=transport, timeout=httpx.Timeout(30.0, pool=HTTP_POOL_TIMEOUT))
+        _clients[name] = client
+        _transports[name] = transport
+        logger.info("HTTP client '%s' created (max_connections=%s keepalive=%s http2=%s)",
+                    name, HTTP_MAX_CONNECTIONS, HTTP_MAX_KEEPALIVE_CONNECTIONS, HTTP2_ENABLED)
+    return client
+
+
+async def start_http_clients(*names: str):
+    for name in names:
+        get_client(name)
+
+
+async def close_http_clients():
+    for name, client in list(_clients.items()):
+        await client.aclose()
+        logger.info("HTTP client '%s' closed", name)
+    _clients.clear()
+    _transports.clear()
+
+
+def pool_stats() -> dict:
+    return {
+        "limits": {
+            "max_connections": HTTP_MAX_CONNECTIONS,
+            "max_keepalive_connections": HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            "keepalive_expiry": HTTP_KEEPALIVE_EXPIRY,
+            "http2": HTTP2_ENABLED,
+        },
+        "clients": {name: transport.stats() for name, transport in _transports.items()},
+    }
@@ -1,71 +1,31 @@
 import os
-import asyncio
 import logging
-from typing import Any, Dict
 
-import httpx
-from ..db.models import Dialog
-from ..crud import base_crud
-from ..db.session import SessionLocal
+from .http_pool import get_client
 
 from dotenv import load_dotenv
 
 load_dotenv()
 
 ML_API_URL = os.getenv("ML_API_URL", "http://ml-api:8001")
-ML_API_TICKET_ENDPOINT = os.getenv("ML_API_TICKET_ENDPOINT", "/submit-task")
+ML_API_TICKET_BATCH_ENDPOINT = os.getenv("ML_API_TICKET_BATCH_ENDPOINT", "submit-tasks")
 ML_SEND_TIMEOUT = float(os.getenv("ML_SEND_TIMEOUT", "10.0"))
-ML_MAX_RETRIES = int(os.getenv("ML_MAX_RETRIES", "2"))
-ML_RETRY_BASE_DELAY = float(os.getenv("ML_RETRY_BASE_DELAY", "1.0"))
 
 logger = logging.getLogger("ml-client")
 
-async def _build_payload_for_dialog(dialog_id: int) -> Dict[str, Any]:
-    db = SessionLocal()
-    try:
-        dialog = db.query(Dialog).filter(Dialog.id == dialog_id).first()
-        if not dialog:
-            return {}
-        try:
-            msg = base_crud.get_messages_by_dialog(db, dialog_id)[0].content
-        except Exception:
-            msg = "ERROR"
-        payload = {
-            "user_query": msg,
-            "dialog_id": str(dialog_id)
-        }
-        return payload
-    finally:
-        db.close()
 
-
-async def send_ticket_to_ml(dialog_id: int) -> None:
+async def submit_tickets(tickets: list[dict]) -> None:
     """
-    Асинхронно отправляет dialog в ML.
+    Отправляет пачку тикетов {"dialog_id", "user_query"} в ML одним запросом.
+    Повторы не делаются здесь: при ошибке исключение пробрасывается диспетчеру,
+    который вернёт тикеты в outbox с задержкой.
     """
-    payload = await _build_payload_for_dialog(dialog_id)
-    if not payload:
-        logger.error("send_ticket_to_ml: dialog %s not found or payload empty", dialog_id)
-        return
-
     if not ML_API_URL:
-        logger.error("send_ticket_to_ml: ML_API_URL not configured; dialog %s not sent", dialog_id)
-        return
+        raise RuntimeError("ML_API_URL not configured")
 
-    url = f"{ML_API_URL}/api/v1/agent/{ML_API_TICKET_ENDPOINT}"
+    url = f"{ML_API_URL}/api/v1/agent/{ML_API_TICKET_BATCH_ENDPOINT}"
+    payload = [{"user_query": t["user_query"], "dialog_id": str(t["dialog_id"])} for t in tickets]
 
-    attempt = 0
-    while attempt <= ML_MAX_RETRIES:
-        attempt += 1
-        try:
-            async with httpx.AsyncClient(timeout=ML_SEND_TIMEOUT) as client:
-                resp = await client.post(url, json=payload)
-                resp.raise_for_status()
-                logger.info("send_ticket_to_ml: dialog=%s sent to ML (status=%s)", dialog_id, resp.status_code)
-                return
-        except Exception as e:
-            logger.exception("send_ticket_to_ml: attempt %s failed for dialog %s: %s", attempt, dialog_id, e)
-            if attempt > ML_MAX_RETRIES:
-                logger.error("send_ticket_to_ml: giving up after %s attempts for dialog %s", attempt, dialog_id)
-                return
-            await asyncio.sleep(ML_RETRY_BASE_DELAY * (2 ** (attempt - 1)))
+    resp = await get_client("ml").post(url, json=payload, timeout=ML_SEND_TIMEOUT)
+    resp.raise_for_status()
+    logger.info("submit_tickets: %s tickets sent to ML (status=%s)", len(tickets), resp.status_code)
@@ -10,6 +10,8 @@ import logging
 
 from dotenv import load_dotenv
 
+from .http_pool import get_client
+
 # Загружаем переменные окружения
 load_dotenv()
 
@@ -101,15 +103,19 @@ class UserSimulator:
         logger.debug("Sending request #%s to %s: %s", seq_no, url, trimmed)
 
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(url, json=payload, timeout=30.0)
-                status = response.status_code
-                if status == 200 or status == 201:
-                    logger.info("Sent request #%s OK (status=%s) payload_preview=%s", seq_no, status, trimmed)
-                else:
-                    # логируем тело ответа (обрезанное) для диагностики
-                    content = (response.text[:500] + '...') if response.text and len(response.text) > 500 else response.text
-                    logger.warning("Send failed (seq=%s) status=%s response=%s", seq_no, status, content)
+            response = await get_client("simulator").post(url, json=payload, timeout=30.0)
+            status = response.status_code
+            if status == 200 or status == 201:
+                logger.info("Sent request #%s OK (status=%s) payload_preview=%s", seq_no, status, trimmed)
+            elif status == 429:
+                # бэкенд перегружен — ждём, сколько он попросил
+                retry_after = float(response.headers.get("Retry-After", self.max_interval))
+                logger.warning("Backend overloaded (seq=%s), pausing for %.1fs", seq_no, retry_after)
+                await asyncio.sleep(retry_after)
+            else:
+                # логируем тело ответа (обрезанное) для диагностики
+                content = (response.text[:500] + '...') if response.text and len(response.text) > 500 else response.text
+                logger.warning("Send failed (seq=%s) status=%s response=%s", seq_no, status, content)
         except httpx.RequestError as e:
             logger.warning("HTTP error while sending request #%s to %s: %s", seq_no, url, e)
         except Exception as e:
@@ -1,52 +1,166 @@
-from fastapi import APIRouter, HTTPException
+import json
+import time
+from typing import AsyncIterator, Dict, List
+
+from fastapi import APIRouter, HTTPException, Response
+from fastapi.responses import StreamingResponse
 
 from app.core import settings
 
 from ...schemas.agent_schemas import (
     PromptRequest, SimpleAnswer,
     RAGQueryRequest, RAGQueryResponse,
-    AgentQueryRequest, AgentQueryResponse
+    AgentQueryRequest, AgentQueryResponse,
+    CacheStatsResponse, InferenceStatsResponse, MicroBatchStatsResponse,
+    LLMStatsResponse, RerankStatsResponse
 )
 
-from ...schemas.task_schemas import TaskSubmitRequest, TaskSubmitResponse
+from ...schemas.task_schemas import TaskSubmitRequest, TaskSubmitResponse, QueueStatsResponse
+
+from ...services.inference_executor import inference_executor, InferenceSaturated, InferenceDeadlineExceeded
 
-from ...tasks import process_ticket_query
+from ...tasks import enqueue_ticket, enqueue_tickets, get_queue_stats
 
 router = APIRouter()
 
 
+async def _run_inference(response: Response, fn, *args):
+    """
+    Выполняет fn в ограниченном пуле инференса. Время ожидания в очереди и выполнения
+    возвращается в заголовке Server-Timing; переполнение пула — 503, дедлайн — 504.
+    """
+    try:
+        result, timing = await inference_executor.run(fn, *args)
+    except InferenceSaturated:
+        raise HTTPException(status_code=503, detail="Inference queue is full",
+                            headers={"Retry-After": str(inference_executor.retry_after())})
+    except InferenceDeadlineExceeded:
+        raise HTTPException(status_code=504, detail="Inference deadline exceeded")
+
+    response.headers["Server-Timing"] = timing.server_timing()
+    return result
+
+
 @router.post("/test-prompt", response_model=SimpleAnswer)
-def test_simple_prompt(request: PromptRequest):
+async def test_simple_prompt(request: PromptRequest, response: Response):
     if settings.llm_service_instance is None:
         raise HTTPException(status_code=503, detail="LLM service is not initialized yet")
 
-    answer = settings.llm_service_instance.get_simple_response(request.prompt)
+    # Запрос к Ollama — сетевой ввод-вывод, пул инференса для него не нужен
+    answer = await settings.llm_service_instance.aget_simple_response(request.prompt)
     return SimpleAnswer(answer=answer)
 
 
+async def _sse_events(tokens: AsyncIterator[str]) -> AsyncIterator[str]:
+    """
+    Server-Sent Events: каждый фрагмент — событие token, в конце — done с временем до первого
+    фрагмента и полным временем генерации; ошибка посреди генерации — событие error.
+    """
+    started = time.monotonic()
+    first_token_at = None
+    try:
+        async for token in tokens:
+            if first_token_at is None:
+                first_token_at = time.monotonic()
+            yield f"event: token\ndata: {json.dumps({'token': token}, ensure_ascii=False)}\n\n"
+    except Exception as e:
+        yield f"event: error\ndata: {json.dumps({'detail': str(e)}, ensure_ascii=False)}\n\n"
+        return
+    timings = {
+        "ttft_ms": round((first_token_at - started) * 1000, 1) if first_token_at else None,
+        "total_ms": round((time.monotonic() - started) * 1000, 1),
+    }
+    yield f"event: done\ndata: {json.dumps(timings)}\n\n"
+
+
+@router.post("/test-prompt/stream")
+async def test_simple_prompt_stream(request: PromptRequest):
+    if settings.llm_service_instance is None:
+        raise HTTPException(status_code=503, detail="LLM service is not initialized yet")
+    if not settings.llm_service_instance.is_available():
+        raise HTTPException(status_code=503, detail="LLM service is not configured")
+
+    tokens = settings.llm_service_instance.astream_simple_response(request.prompt)
+    return StreamingResponse(_sse_events(tokens), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
 @router.post("/rag-query", response_model=RAGQueryResponse)
-def test_rag_query(request: RAGQueryRequest):
+async def test_rag_query(request: RAGQueryRequest, response: Response):
     if settings.rag_service_instance is None:
         raise HTTPException(status_code=503, detail="RAG service is not initialized yet")
 
-    sources = settings.rag_service_instance.query(request.query)
+    query = settings.rag_batcher.submit if settings.rag_batcher is not None else settings.rag_service_instance.query
+    sources = await _run_inference(response, query, request.query)
     return RAGQueryResponse(sources=sources)
 
 
+@router.get("/rag-cache/stats", response_model=CacheStatsResponse)
+def rag_cache_stats():
+    if settings.rag_service_instance is None:
+        raise HTTPException(status_code=503, detail="RAG service is not initialized yet")
+    if settings.rag_service_instance.cache is None:
+        raise HTTPException(status_code=404, detail="RAG cache is disabled")
+
+    return settings.rag_service_instance.cache.stats()
+
+
 @router.post("/process-query", response_model=AgentQueryResponse)
-def process_user_query(request: AgentQueryRequest):
+async def process_user_query(request: AgentQueryRequest, response: Response):
     if settings.agent_service_instance is None:
         raise HTTPException(status_code=503, detail="Agent service is not initialized yet")
 
-    result = settings.agent_service_instance.process_query(request.user_query)
+    process = settings.agent_batcher.submit if settings.agent_batcher is not None \
+        else settings.agent_service_instance.process_query
+    result = await _run_inference(response, process, request.user_query)
     return result
 
 
+@router.get("/inference/stats", response_model=InferenceStatsResponse)
+async def inference_stats():
+    return inference_executor.stats()
+
+
 @router.post("/submit-task", response_model=TaskSubmitResponse)
 def submit_task(request: TaskSubmitRequest):
-    task = process_ticket_query.delay(
+    task_id = enqueue_ticket(
         user_query=request.user_query,
         dialog_id=request.dialog_id
     )
 
-    return TaskSubmitResponse(dialog_id=task.id, status="accepted")
+    return TaskSubmitResponse(dialog_id=task_id, status="accepted")
+
+
+@router.post("/submit-tasks", response_model=List[TaskSubmitResponse])
+def submit_tasks(requests: List[TaskSubmitRequest]):
+    task_ids = enqueue_tickets([request.model_dump() for request in requests])
+
+    return [TaskSubmitResponse(dialog_id=task_id, status="accepted") for task_id in task_ids]
+
+
+@router.get("/queue/stats", response_model=QueueStatsResponse)
+def queue_stats():
+    try:
+        return get_queue_stats()
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=f"queue stats are unavailable: {e}")
+
+
+@router.get("/micro-batch/stats", response_model=Dict[str, MicroBatchStatsResponse])
+async def micro_batch_stats():
+    batchers = [settings.agent_batcher, settings.rag_batcher]
+    return {batcher.name: batcher.stats() for batcher in batchers if batcher is not None}
+
+
+@router.get("/llm/stats", response_model=LLMStatsResponse)
+async def llm_stats():
+    if settings.llm_service_instance is None:
+        raise HTTPException(status_code=503, detail="LLM service is not initialized yet")
+    return settings.llm_service_instance.stats()
+
+
+@router.get("/rerank/stats", response_model=RerankStatsResponse)
+async def rerank_stats():
+    if settings.reranker_instance is None:
+        raise HTTPException(status_code=404, detail="Reranker is disabled")
+    return settings.reranker_instance.stats()
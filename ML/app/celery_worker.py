@@ -1,4 +1,11 @@
+from .core.worker_runtime import apply_thread_budget, ML_PRELOAD_MODELS, ML_WORKER_CONCURRENCY
+
+apply_thread_budget()
+
+import gc
+import logging
 from celery import Celery
+from celery.signals import worker_init
 import os
 from dotenv import load_dotenv
 
@@ -16,3 +23,25 @@ celery_app = Celery(
 celery_app.conf.update(
     task_track_started=True,
 )
+
+
+@worker_init.connect
+def preload_models(**kwargs):
+    """
+    Загружает embedding-модель и классификатор в родительском процессе до fork пула:
+    дочерние процессы получают их copy-on-write, а не по копии на процесс.
+    ONNX-модель (EMBED_BACKEND=onnx*) загружается уже в дочерних процессах.
+    Chroma и прочие соединения открываются уже в дочерних процессах (worker_process_init).
+    """
+    if not ML_PRELOAD_MODELS:
+        return
+    from .core import settings
+
+    try:
+        settings.preload_models(before_fork=True)
+    except Exception as e:
+        logging.error(f"Не удалось загрузить модели до fork, процессы загрузят их сами: {e}", exc_info=True)
+        return
+    # Объекты моделей больше не трогаются сборщиком мусора, страницы памяти остаются общими
+    gc.freeze()
+    logging.info(f"Модели загружены до fork, процессов пула: {ML_WORKER_CONCURRENCY}.")
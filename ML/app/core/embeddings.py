@@ -0,0 +1,165 @@
+import logging
+import os
+import re
+from typing import List, Optional
+
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from pydantic import PrivateAttr
+
+from ..services.embedding_cache import CachedEmbedding
+
+EMBED_CACHE_ENABLED = os.getenv("EMBED_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+EMBED_CACHE_DIR = os.getenv("EMBED_CACHE_DIR", "/app/db/embed_cache")
+# Сколько векторов хранит одно поколение кэша (0 — без ограничения); запросы кэшируются только по флагу
+EMBED_CACHE_MAX_ROWS = int(os.getenv("EMBED_CACHE_MAX_ROWS", 200000))
+EMBED_CACHE_QUERIES = os.getenv("EMBED_CACHE_QUERIES", "false").lower() in ("1", "true", "yes")
+# torch | onnx | onnx-int8
+EMBED_BACKEND = os.getenv("EMBED_BACKEND", "torch").lower()
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", "/app/db/onnx")
+# Набор инструкций для динамической int8-квантизации: arm64 | avx2 | avx512 | avx512_vnni
+ONNX_QUANT_CONFIG = os.getenv("ONNX_QUANT_CONFIG", "avx2")
+# Локальный снимок весов модели (общий том ml-rag-db); пусто — загрузка из кэша HF Hub
+EMBED_MODEL_SNAPSHOT_DIR = os.getenv("EMBED_MODEL_SNAPSHOT_DIR", "/app/db/models")
+
+QUERY_INSTRUCTION = "query: "
+TEXT_INSTRUCTION = "passage: "
+EMBED_BACKENDS = ("torch", "onnx", "onnx-int8")
+
+
+def _safe_name(model_name: str) -> str:
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", model_name)
+
+
+def ensure_model_snapshot(model_name: str) -> str:
+    """
+    Возвращает путь к локальному снимку модели, при первом вызове скачивая его в EMBED_MODEL_SNAPSHOT_DIR.
+    Загрузка из локального каталога не обращается к HF Hub, поэтому рестарт не зависит от сети.
+    """
+    if not EMBED_MODEL_SNAPSHOT_DIR or os.path.isdir(model_name):
+        return model_name
+    path = os.path.join(EMBED_MODEL_SNAPSHOT_DIR, _safe_name(model_name))
+    # Маркер пишется после полной загрузки, недокачанный снимок будет докачан
+    marker = os.path.join(path, ".snapshot_complete")
+    if os.path.exists(marker):
+        return path
+
+    from huggingface_hub import snapshot_download
+
+    logging.info(f"Сохранение снимка модели {model_name} в {path}")
+    snapshot_download(repo_id=model_name, local_dir=path)
+    open(marker, "w").close()
+    return path
+
+
+class OnnxEmbedding(BaseEmbedding):
+    """
+    Embedding-модель на onnxruntime (CPU) через SentenceTransformer(backend="onnx").
+    Модель экспортируется в ONNX при первом запуске и сохраняется в ONNX_MODEL_DIR;
+    при quantize=True дополнительно создаётся динамически квантизованная int8-версия.
+    Интерфейс повторяет HuggingFaceEmbedding: instruction-префиксы, _embed(..., prompt_name=...).
+    Число потоков сессии ограничено worker_thread_budget(), как у torch в процессах воркера.
+    """
+
+    query_instruction: Optional[str] = None
+    text_instruction: Optional[str] = None
+
+    _model = PrivateAttr()
+
+    def __init__(self, model_name: str, quantize: bool = False, query_instruction: Optional[str] = None,
+                 text_instruction: Optional[str] = None, model_path: Optional[str] = None, **kwargs):
+        backend = "onnx-int8" if quantize else "onnx"
+        super().__init__(model_name=f"{model_name}@{backend}", query_instruction=query_instruction,
+                         text_instruction=text_instruction, **kwargs)
+        self._model = self._load(model_name, model_path or model_name, quantize)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "OnnxEmbedding"
+
+    @staticmethod
+    def _session_kwargs(file_name: Optional[str] = None) -> dict:
+        import onnxruntime
+
+        from .worker_runtime import worker_thread_budget
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = worker_thread_budget()
+        options.inter_op_num_threads = 1
+        kwargs = {"session_options": options}
+        if file_name:
+            kwargs["file_name"] = file_name
+        return kwargs
+
+    @classmethod
+    def _load(cls, model_name: str, model_path: str, quantize: bool):
+        from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+
+        export_dir = os.path.join(ONNX_MODEL_DIR, _safe_name(model_name))
+        if not os.path.exists(os.path.join(export_dir, "onnx", "model.onnx")):
+            logging.info(f"Экспорт {model_name} в ONNX: {export_dir}")
+            SentenceTransformer(model_path, backend="onnx").save_pretrained(export_dir)
+
+        if not quantize:
+            return SentenceTransformer(export_dir, backend="onnx", model_kwargs=cls._session_kwargs())
+
+        quantized_file = f"model_qint8_{ONNX_QUANT_CONFIG}.onnx"
+        if not os.path.exists(os.path.join(export_dir, "onnx", quantized_file)):
+            logging.info(f"Динамическая int8-квантизация ({ONNX_QUANT_CONFIG}): {export_dir}")
+            export_dynamic_quantized_onnx_model(
+                SentenceTransformer(export_dir, backend="onnx"), ONNX_QUANT_CONFIG, export_dir
+            )
+        return SentenceTransformer(export_dir, backend="onnx",
+                                   model_kwargs=cls._session_kwargs(file_name=f"onnx/{quantized_file}"))
+
+    def _embed(self, sentences: List[str], prompt_name: Optional[str] = None) -> List[List[float]]:
+        instruction = self.query_instruction if prompt_name == "query" else self.text_instruction
+        texts = [f"{instruction or ''}{sentence}" for sentence in sentences]
+        embeddings = self._model.encode(texts, batch_size=self.embed_batch_size, normalize_embeddings=True)
+        return embeddings.tolist()
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._embed([query], prompt_name="query")[0]
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return self._get_query_embedding(query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._embed([text], prompt_name="text")[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return self._embed(texts, prompt_name="text")
+
+
+def build_embed_model(model_name: str, backend: Optional[str] = None, use_cache: Optional[bool] = None) -> BaseEmbedding:
+    """Единая точка создания embedding-модели для индексатора и сервисов запроса."""
+    backend = (backend or EMBED_BACKEND).lower()
+    if backend not in EMBED_BACKENDS:
+        raise ValueError(f"Неизвестный EMBED_BACKEND '{backend}', допустимо: {', '.join(EMBED_BACKENDS)}")
+
+    model_path = ensure_model_snapshot(model_name)
+    if backend == "torch":
+        from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+
+        embed_model = HuggingFaceEmbedding(
+            model_name=model_path,
+            query_instruction=QUERY_INSTRUCTION,
+            text_instruction=TEXT_INSTRUCTION
+        )
+        # Имя модели, а не путь к снимку: по нему ключуется кэш эмбеддингов
+        embed_model.model_name = model_name
+    else:
+        logging.info(f"Embedding-модель {model_name} на onnxruntime ({backend}).")
+        embed_model = OnnxEmbedding(
+            model_name=model_name,
+            quantize=backend == "onnx-int8",
+            query_instruction=QUERY_INSTRUCTION,
+            text_instruction=TEXT_INSTRUCTION,
+            model_path=model_path
+        )
+
+    if not (EMBED_CACHE_ENABLED if use_cache is None else use_cache):
+        return embed_model
+
+    logging.info(f"Включён дисковый кэш эмбеддингов: {EMBED_CACHE_DIR}")
+    return CachedEmbedding(embed_model, cache_dir=EMBED_CACHE_DIR, max_rows=EMBED_CACHE_MAX_ROWS,
+                           cache_queries=EMBED_CACHE_QUERIES)
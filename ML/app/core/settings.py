@@ -1,18 +1,90 @@
+import asyncio
 import logging
 import os
+import time
+from contextlib import contextmanager
+from typing import TYPE_CHECKING
+
 from dotenv import load_dotenv
-from llama_index.embeddings.huggingface import HuggingFaceEmbedding
-from llama_index.llms.openai import OpenAI
-from ..services.rag_service import RAGService
-from ..services.llm_service import LLMService
-from ..services.agent_service import AgentService
-import asyncio
-from ..services.classifier_service import ClassifierService
 
-llm_service_instance: LLMService | None = None
-rag_service_instance: RAGService | None = None
-agent_service_instance: AgentService | None = None
-classifier_service_instance: ClassifierService | None = None
+# Тяжёлые модули (llama_index, torch, chromadb) импортируются внутри функций:
+# ML API начинает отвечать на /health сразу, а сервисы поднимаются в фоне (start_services).
+if TYPE_CHECKING:
+    from llama_index.core.base.embeddings.base import BaseEmbedding
+    from ..services.rag_service import RAGService
+    from ..services.llm_service import LLMService
+    from ..services.agent_service import AgentService
+    from ..services.classifier_service import ClassifierService
+    from ..services.micro_batcher import MicroBatcher
+    from ..services.reranker import CrossEncoderReranker
+
+llm_service_instance: "LLMService | None" = None
+rag_service_instance: "RAGService | None" = None
+agent_service_instance: "AgentService | None" = None
+classifier_service_instance: "ClassifierService | None" = None
+embed_model_instance: "BaseEmbedding | None" = None
+reranker_instance: "CrossEncoderReranker | None" = None
+agent_batcher: "MicroBatcher | None" = None
+rag_batcher: "MicroBatcher | None" = None
+
+MICROBATCH_ENABLED = os.getenv("MICROBATCH_ENABLED", "true").lower() in ("1", "true", "yes")
+MICROBATCH_MAX_SIZE = int(os.getenv("MICROBATCH_MAX_SIZE", 16))
+MICROBATCH_MAX_WAIT_MS = float(os.getenv("MICROBATCH_MAX_WAIT_MS", 5))
+RERANK_ENABLED = os.getenv("RERANK_ENABLED", "false").lower() in ("1", "true", "yes")
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "true").lower() in ("1", "true", "yes")
+WARMUP_QUERY = "Не могу войти в личный кабинет"
+
+# Состояние запуска для /health и /ready: starting -> ready | failed
+startup_status = "starting"
+startup_error: str | None = None
+startup_phases: dict[str, float] = {}
+
+
+@contextmanager
+def _phase(name: str):
+    started = time.perf_counter()
+    yield
+    startup_phases[name] = round(time.perf_counter() - started, 3)
+    logging.info(f"Запуск: этап '{name}' занял {startup_phases[name]:.2f} с.")
+
+
+def preload_models(before_fork: bool = False):
+    """
+    Загружает только модели (embedding, классификатор, cross-encoder), без Chroma и сетевых клиентов.
+    Воркер вызывает её в родительском процессе до fork (before_fork=True), setup_services переиспользует загруженное.
+    Сессию onnxruntime до fork не создаём: её пул потоков не переживает fork, поэтому ONNX-модель
+    каждый процесс пула загружает сам, с бюджетом потоков процесса.
+    """
+    global embed_model_instance, classifier_service_instance, reranker_instance
+    load_dotenv()
+
+    from .embeddings import build_embed_model, EMBED_BACKEND
+    if embed_model_instance is None and not (before_fork and EMBED_BACKEND != "torch"):
+        with _phase("embed_model"):
+            embed_model_instance = build_embed_model(os.getenv("EMBED_MODEL_NAME"))
+    if classifier_service_instance is None:
+        with _phase("classifier"):
+            from ..services.classifier_service import ClassifierService
+            classifier_service_instance = ClassifierService()
+    if RERANK_ENABLED and reranker_instance is None:
+        with _phase("reranker"):
+            from ..services.reranker import CrossEncoderReranker
+            reranker_instance = CrossEncoderReranker()
+
+
+def _warmup(rag_service: "RAGService"):
+    """Первый прогон модели после загрузки заметно медленнее следующих — делаем его до готовности."""
+    from ..services.embedding_cache import CachedEmbedding
+
+    embed_model = embed_model_instance
+    # Дисковый кэш вернул бы вектор без прогона модели
+    if isinstance(embed_model, CachedEmbedding):
+        embed_model = embed_model.inner
+    embedding = embed_model.get_query_embedding(WARMUP_QUERY)
+    classifier_service_instance.predict_batch([WARMUP_QUERY])
+    candidates = rag_service._search_by_embeddings([embedding])
+    if reranker_instance is not None:
+        reranker_instance.rerank_batch([WARMUP_QUERY], candidates, top_k=1)
 
 
 async def setup_services():
@@ -21,32 +93,28 @@ async def setup_services():
 
     load_dotenv()
 
-    embed_model = HuggingFaceEmbedding(
-        model_name=os.getenv("EMBED_MODEL_NAME"),
-        query_instruction="query: ",
-        text_instruction="passage: "
-    )
+    with _phase("imports"):
+        from ..services.rag_service import RAGService
+        from ..services.llm_service import LLMService
+        from ..services.agent_service import AgentService
+
+    preload_models()
+
+    with _phase("llm_client"):
+        llm_service = LLMService()
+        if not llm_service.is_available():
+            logging.warning("Переменная OLLAMA_URL не задана. LLM-сервисы будут недоступны.")
+
+    with _phase("rag_index"):
+        rag_service = RAGService(embed_model=embed_model_instance, reranker=reranker_instance)
 
-    ollama_url = os.getenv("OLLAMA_URL", "http://ollama:11434")
-    llm = None
-    if ollama_url:
-        try:
-            llm = OpenAI(
-                model="gpt-3.5-turbo",
-
-                api_base=ollama_url + "/v1",
-                api_key="dummy_key",
-                request_timeout=120.0,
-            )
-        except Exception as e:
-            logging.warning(f"Не удалось настроить LLM-клиент: {e}")
-    else:
-        logging.warning("Переменная OLLAMA_URL не задана. LLM-сервисы будут недоступны.")
-
-    llm_service_instance = LLMService(llm=llm)
-    rag_service_instance = RAGService(embed_model=embed_model)
-    classifier_service_instance = ClassifierService()
+    if WARMUP_ENABLED:
+        with _phase("warmup"):
+            _warmup(rag_service)
 
+    # agent_service_instance выставляется последним: по нему эндпоинты и воркер судят о готовности
+    llm_service_instance = llm_service
+    rag_service_instance = rag_service
     agent_service_instance = AgentService(
         llm_service=llm_service_instance,
         rag_service=rag_service_instance,
@@ -55,6 +123,48 @@ async def setup_services():
     logging.info("Все сервисы успешно инициализированы.")
 
 
+async def start_services():
+    """Фоновый запуск сервисов ML API: модели грузятся в отдельном потоке, event loop продолжает отвечать."""
+    global startup_status, startup_error
+    started = time.perf_counter()
+    try:
+        await asyncio.to_thread(asyncio.run, setup_services())
+        setup_micro_batchers()
+    except Exception as e:
+        startup_status, startup_error = "failed", f"{type(e).__name__}: {e}"
+        logging.error(f"Ошибка инициализации сервисов: {e}", exc_info=True)
+        return
+    startup_phases["total"] = round(time.perf_counter() - started, 3)
+    startup_status = "ready"
+    logging.info(f"ML API готов к работе за {startup_phases['total']:.2f} с.")
+
+
+def is_ready() -> bool:
+    return startup_status == "ready" and agent_service_instance is not None
+
+
+def setup_micro_batchers():
+    """
+    Micro-batching для синхронных эндпоинтов ML API: одновременные /process-query и /rag-query
+    объединяются в process_queries / query_batch — один батч классификатора и эмбеддингов на пачку.
+    Celery-воркеру не нужен, он и так обрабатывает тикеты пачками.
+    """
+    global agent_batcher, rag_batcher
+    if not MICROBATCH_ENABLED or agent_service_instance is None:
+        return
+    from ..services.micro_batcher import MicroBatcher
+    from ..services.inference_executor import inference_executor
+
+    # Запрос ждёт свою пачку в потоке пула инференса: пул меньше пачки не даст ей набраться
+    inference_executor.ensure_workers(MICROBATCH_MAX_SIZE)
+
+    agent_batcher = MicroBatcher(agent_service_instance.process_queries, MICROBATCH_MAX_SIZE,
+                                 MICROBATCH_MAX_WAIT_MS, name="process-query")
+    rag_batcher = MicroBatcher(rag_service_instance.query_batch, MICROBATCH_MAX_SIZE,
+                               MICROBATCH_MAX_WAIT_MS, name="rag-query")
+    logging.info(f"Micro-batching включён: до {MICROBATCH_MAX_SIZE} запросов, ожидание {MICROBATCH_MAX_WAIT_MS} мс.")
+
+
 def ensure_services_ready():
     global agent_service_instance
     if agent_service_instance is not None:
@@ -64,4 +174,6 @@ def ensure_services_ready():
 
 
 async def shutdown_services():
+    if llm_service_instance is not None:
+        llm_service_instance.close()
     logging.info("Сервисы остановлены.")
@@ -0,0 +1,37 @@
+import logging
+import os
+
+# Модуль импортируется первым в процессе воркера (из celery_worker.py), до numpy/torch:
+# переменные окружения OpenMP/BLAS читаются библиотеками только при загрузке.
+
+ML_WORKER_CONCURRENCY = int(os.getenv("ML_WORKER_CONCURRENCY", 1))
+ML_PRELOAD_MODELS = os.getenv("ML_PRELOAD_MODELS", "true").lower() in ("1", "true", "yes")
+
+_THREAD_ENV_VARS = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "NUMEXPR_NUM_THREADS")
+
+
+def worker_thread_budget() -> int:
+    """Число потоков torch/BLAS на один процесс пула: ML_WORKER_THREADS или ядра поровну на процессы."""
+    configured = int(os.getenv("ML_WORKER_THREADS", 0))
+    if configured > 0:
+        return configured
+    return max(1, (os.cpu_count() or 1) // max(ML_WORKER_CONCURRENCY, 1))
+
+
+def apply_thread_budget():
+    threads = str(worker_thread_budget())
+    for name in _THREAD_ENV_VARS:
+        os.environ.setdefault(name, threads)
+    # Пул потоков HF tokenizers не переживает fork
+    os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+
+
+def configure_child_threads():
+    """Вызывается в дочернем процессе пула после fork."""
+    threads = worker_thread_budget()
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+    logging.info(f"Процесс воркера {os.getpid()}: бюджет потоков torch/BLAS = {threads}.")
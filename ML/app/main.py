@@ -1,23 +1,42 @@
+import asyncio
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI
+from fastapi.responses import JSONResponse
 from .api.routers import agent
-from .core.settings import setup_services, shutdown_services
+from .core import settings
+from .services.inference_executor import inference_executor
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    await setup_services()
+    # Сервисы поднимаются в фоне: liveness отвечает сразу, readiness — после прогрева моделей
+    startup = asyncio.create_task(settings.start_services())
     yield
-    await shutdown_services()
+    startup.cancel()
+    inference_executor.shutdown()
+    await settings.shutdown_services()
 
 
 app = FastAPI(title="ML Service API", lifespan=lifespan)
 
 
+# async: health check не зависит от загрузки пула потоков
 @app.get("/health")
-def health_check():
-    return {"status": "ok"}
+async def health_check():
+    """Liveness: процесс жив и обслуживает event loop, даже пока модели загружаются."""
+    return {"status": "ok", "startup": settings.startup_status}
+
+
+@app.get("/ready")
+async def readiness_check():
+    """Readiness: модели загружены и прогреты. Пока нет — 503 с текущими длительностями этапов запуска."""
+    body = {
+        "status": settings.startup_status,
+        "phases_sec": settings.startup_phases,
+        "error": settings.startup_error,
+    }
+    return JSONResponse(body, status_code=200 if settings.is_ready() else 503)
 
 
 app.include_router(agent.router, prefix="/api/v1/agent", tags=["Agent"])
@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import List, Union
+from typing import List, Optional, Union
 
 
 class PromptRequest(BaseModel):
@@ -48,3 +48,57 @@ class AgentQueryResponse(BaseModel):
     action_type: str
     payload: Union[AnswerPayload, EscalatePayload]
     metadata: MetaData
+
+
+class CacheStatsResponse(BaseModel):
+    exact_hits: int
+    semantic_hits: int
+    misses: int
+    hit_rate: float
+    invalidations: int
+    exact_size: int
+    semantic_size: int
+
+
+class InferenceStatsResponse(BaseModel):
+    workers: int
+    queue_size: int
+    deadline_sec: float
+    running: int
+    queued: int
+    completed: int
+    rejected: int
+    timed_out: int
+    avg_queue_wait_ms: float
+    avg_exec_ms: float
+
+
+class MicroBatchStatsResponse(BaseModel):
+    max_batch_size: int
+    max_wait_ms: float
+    batches: int
+    items: int
+    avg_batch_size: float
+    max_seen_batch: int
+    queued: int
+
+
+class LLMStatsResponse(BaseModel):
+    model: Optional[str]
+    requests_total: int
+    coalesced: int
+    cache_hits: int
+    errors: int
+    in_flight: int
+    cache_size: int
+    max_connections: int
+    max_concurrency_per_model: int
+
+
+class RerankStatsResponse(BaseModel):
+    model: str
+    queries: int
+    pairs_scored: int
+    early_exits: int
+    avg_pairs_per_query: float
+    avg_ms_per_query: float
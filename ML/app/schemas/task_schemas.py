@@ -9,3 +9,12 @@ class TaskSubmitRequest(BaseModel):
 class TaskSubmitResponse(BaseModel):
     dialog_id: str
     status: str
+
+
+class QueueStatsResponse(BaseModel):
+    queue_depth: int
+    service_time_avg_sec: float
+    service_time_p90_sec: float
+    workers: int
+    estimated_lag_sec: float
+    samples: int
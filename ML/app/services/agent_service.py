@@ -1,6 +1,6 @@
 import logging
 import time
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Tuple
 
 from .llm_service import LLMService
 from .rag_service import RAGService
@@ -12,6 +12,11 @@ from ..schemas.agent_schemas import SourceNode
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 RAG_CONFIDENCE_THRESHOLD = float(os.getenv("RAG_CONFIDENCE_THRESHOLD", 0.65))
+# Порог для вероятности cross-encoder, когда RAGService переранжирует кандидатов
+RERANK_CONFIDENCE_THRESHOLD = float(os.getenv("RERANK_CONFIDENCE_THRESHOLD", 0.5))
+# Поиск в разделе предсказанной категории, если классификатор в ней уверен
+CATEGORY_ROUTING_ENABLED = os.getenv("CATEGORY_ROUTING_ENABLED", "false").lower() in ("1", "true", "yes")
+ROUTING_MIN_CONFIDENCE = float(os.getenv("ROUTING_MIN_CONFIDENCE", 0.6))
 
 
 class AgentService:
@@ -19,12 +24,14 @@ class AgentService:
         self._llm_service = llm_service
         self._rag_service = rag_service
         self._classifier_service = classifier_service
+        self._confidence_threshold = RERANK_CONFIDENCE_THRESHOLD if rag_service.reranker is not None \
+            else RAG_CONFIDENCE_THRESHOLD
 
     def process_query(self, user_query: str) -> Dict[str, Any]:
         logging.info(f"--- Начало быстрой обработки запроса: '{user_query}' ---")
         start_time = time.time()
 
-        category = self._classifier_service.predict(user_query)
+        category, confidence = self._classify([user_query])[0]
         logging.info(f"Запрос классифицирован как: '{category}'")
 
         if category == "Мусор":
@@ -36,9 +43,69 @@ class AgentService:
                 start_time=start_time
             )
 
-        sources: List[SourceNode] = self._rag_service.query(user_query)
+        sources: List[SourceNode] = self._retrieve([user_query], [(category, confidence)])[0]
 
-        if sources and sources[0].score >= RAG_CONFIDENCE_THRESHOLD:
+        return self._decide(user_query, category, sources, start_time)
+
+    def process_queries(self, user_queries: List[str]) -> List[Dict[str, Any]]:
+        """
+        Пакетная обработка: одна векторизованная классификация и один батч RAG-поиска на весь список.
+        Результаты возвращаются в том же порядке, что и запросы.
+        """
+        if not user_queries:
+            return []
+        logging.info(f"--- Начало пакетной обработки {len(user_queries)} запросов ---")
+        start_time = time.time()
+
+        predictions = self._classify(user_queries)
+        categories = [category for category, _ in predictions]
+
+        rag_positions = [i for i, category in enumerate(categories) if category != "Мусор"]
+        rag_sources = self._retrieve([user_queries[i] for i in rag_positions], [predictions[i] for i in rag_positions])
+        sources_by_position = dict(zip(rag_positions, rag_sources))
+
+        results = []
+        for i, (user_query, category) in enumerate(zip(user_queries, categories)):
+            if i not in sources_by_position:
+                results.append(self._escalate(
+                    user_query=user_query,
+                    reason="Запрос классифицирован как нерелевантный.",
+                    category=category,
+                    start_time=start_time
+                ))
+                continue
+            results.append(self._decide(user_query, category, sources_by_position[i], start_time))
+
+        logging.info(f"Пакет из {len(user_queries)} запросов обработан за {time.time() - start_time:.2f} с.")
+        return results
+
+    def _classify(self, user_queries: List[str]) -> List[Tuple[str, float]]:
+        if CATEGORY_ROUTING_ENABLED:
+            return self._classifier_service.predict_batch_with_confidence(user_queries)
+        return [(category, 0.0) for category in self._classifier_service.predict_batch(user_queries)]
+
+    def _retrieve(self, user_queries: List[str], predictions: List[Tuple[str, float]]) -> List[List[SourceNode]]:
+        """
+        Поиск в разделе предсказанной категории при уверенности классификатора не ниже ROUTING_MIN_CONFIDENCE;
+        если в разделе не нашлось уверенного ответа, запрос повторяется по всему индексу.
+        """
+        if not CATEGORY_ROUTING_ENABLED:
+            return self._rag_service.query_batch(user_queries)
+
+        routes = [self._rag_service.route(category) if confidence >= ROUTING_MIN_CONFIDENCE else None
+                  for category, confidence in predictions]
+        sources = self._rag_service.query_batch(user_queries, routes)
+
+        fallback = [i for i, route in enumerate(routes)
+                    if route is not None and not (sources[i] and sources[i][0].score >= self._confidence_threshold)]
+        if fallback:
+            logging.info(f"В разделе категории нет уверенного ответа, поиск по всему индексу: {len(fallback)} запросов.")
+            for i, found in zip(fallback, self._rag_service.query_batch([user_queries[i] for i in fallback])):
+                sources[i] = found
+        return sources
+
+    def _decide(self, user_query: str, category: str, sources: List[SourceNode], start_time: float) -> Dict[str, Any]:
+        if sources and sources[0].score >= self._confidence_threshold:
             logging.info(f"Найдено релевантное решение в Базе Знаний (score: {sources[0].score:.2f}).")
 
             best_source = sources[0]
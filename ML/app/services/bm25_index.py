@@ -0,0 +1,116 @@
+import json
+import logging
+import math
+import os
+import re
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Tuple
+
+# Коды ошибок, версии и имена вида ERR-1042, 0x80070005, v2.3 остаются одним токеном
+_TOKEN_RE = re.compile(r"\w+(?:[-.:/]\w+)*", re.UNICODE)
+# Грубый стемминг: чисто буквенные слова обрезаются до префикса, чтобы "принтер"/"принтера" совпадали
+STEM_PREFIX = 6
+
+
+def tokenize(text: str) -> List[str]:
+    tokens = []
+    for token in _TOKEN_RE.findall(text.lower()):
+        if token.isalpha() and len(token) > STEM_PREFIX:
+            token = token[:STEM_PREFIX]
+        tokens.append(token)
+    return tokens
+
+
+class BM25Index:
+    """
+    Инвертированный индекс Okapi BM25 по тем же фрагментам, что лежат в Chroma.
+    Строится индексатором из коллекции и сохраняется JSON-файлом рядом с базой Chroma.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.node_ids: List[str] = []
+        self.texts: List[str] = []
+        self.metadatas: List[dict] = []
+        self.doc_len: List[int] = []
+        self.avgdl = 0.0
+        self.postings: Dict[str, List[Tuple[int, int]]] = {}
+        self._idf: Dict[str, float] = {}
+
+    @classmethod
+    def build(cls, node_ids: List[str], texts: List[str], metadatas: List[Optional[dict]],
+              k1: float = 1.5, b: float = 0.75) -> "BM25Index":
+        index = cls(k1, b)
+        postings = defaultdict(list)
+        for doc, (node_id, text, metadata) in enumerate(zip(node_ids, texts, metadatas)):
+            counts = Counter(tokenize(text or ""))
+            for term, tf in counts.items():
+                postings[term].append((doc, tf))
+            index.node_ids.append(node_id)
+            index.texts.append(text or "")
+            index.metadatas.append({"file_name": "N/A", **{key: value for key, value in (metadata or {}).items()
+                                                           if key in ("file_name", "category")}})
+            index.doc_len.append(sum(counts.values()))
+        index.postings = dict(postings)
+        index._finalize()
+        return index
+
+    def _finalize(self):
+        total = len(self.doc_len)
+        self.avgdl = sum(self.doc_len) / total if total else 0.0
+        self._idf = {
+            term: math.log(1 + (total - len(docs) + 0.5) / (len(docs) + 0.5))
+            for term, docs in self.postings.items()
+        }
+
+    def __len__(self) -> int:
+        return len(self.node_ids)
+
+    def search(self, query: str, top_k: int, category: Optional[str] = None) -> List[Tuple[int, float]]:
+        """Возвращает [(номер фрагмента, BM25-скор)] по убыванию скора; с category — только фрагменты категории."""
+        scores: Dict[int, float] = defaultdict(float)
+        for term in set(tokenize(query)):
+            idf = self._idf.get(term)
+            if idf is None:
+                continue
+            for doc, tf in self.postings[term]:
+                if category is not None and self.metadatas[doc].get("category") != category:
+                    continue
+                norm = self.k1 * (1 - self.b + self.b * self.doc_len[doc] / self.avgdl)
+                scores[doc] += idf * tf * (self.k1 + 1) / (tf + norm)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+
+    def save(self, path: str):
+        data = {
+            "k1": self.k1,
+            "b": self.b,
+            "node_ids": self.node_ids,
+            "texts": self.texts,
+            "metadatas": self.metadatas,
+            "doc_len": self.doc_len,
+            "postings": self.postings,
+        }
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> Optional["BM25Index"]:
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Не удалось загрузить BM25-индекс {path}: {e}")
+            return None
+        index = cls(data["k1"], data["b"])
+        index.node_ids = data["node_ids"]
+        index.texts = data["texts"]
+        index.metadatas = data["metadatas"]
+        index.doc_len = data["doc_len"]
+        index.postings = {term: [tuple(p) for p in docs] for term, docs in data["postings"].items()}
+        index._finalize()
+        return index
@@ -2,6 +2,8 @@ import joblib
 import os
 import logging
 
+import numpy as np
+
 
 class ClassifierService:
     def __init__(self, model_path: str = "app/models/classifier.joblib"):
@@ -16,3 +18,28 @@ class ClassifierService:
     def predict(self, text: str) -> str:
         prediction = self.pipeline.predict([text])
         return prediction[0]
+
+    def predict_batch(self, texts: list[str]) -> list[str]:
+        if not texts:
+            return []
+        predictions = self.pipeline.predict(texts)
+        return [str(p) for p in predictions]
+
+    def predict_batch_with_confidence(self, texts: list[str]) -> list[tuple[str, float]]:
+        """
+        Категория и уверенность 0..1: predict_proba, если модель её поддерживает, иначе softmax
+        по decision_function (SGDClassifier с hinge-loss вероятностей не даёт).
+        """
+        if not texts:
+            return []
+        if hasattr(self.pipeline, "predict_proba"):
+            scores = np.asarray(self.pipeline.predict_proba(texts))
+        else:
+            decision = np.asarray(self.pipeline.decision_function(texts), dtype=np.float64)
+            if decision.ndim == 1:
+                decision = np.stack([-decision, decision], axis=1)
+            scores = np.exp(decision - decision.max(axis=1, keepdims=True))
+            scores /= scores.sum(axis=1, keepdims=True)
+        classes = self.pipeline.classes_
+        best = scores.argmax(axis=1)
+        return [(str(classes[i]), float(row[i])) for row, i in zip(scores, best)]
@@ -0,0 +1,247 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from pydantic import PrivateAttr
+
+
+class EmbeddingDiskCache:
+    """
+    Дисковый кэш эмбеддингов одной модели.
+    vectors.<поколение>.f32 — непрерывный массив float32 (строка = вектор), читается через np.memmap;
+    index.<поколение>.tsv — строки "ключ<TAB>номер строки", только дописываются.
+    Запись идёт под эксклюзивным flock, поэтому кэш безопасно делить между процессами
+    и контейнерами, смонтировавшими один том. Вектор пишется раньше строки индекса,
+    так что читатель никогда не увидит ключ без данных.
+    При достижении max_rows кэш начинает новое поколение (номер в meta.json), файлы старого удаляются.
+    """
+
+    def __init__(self, cache_dir: str, namespace: str, max_rows: int = 0):
+        self.path = os.path.join(cache_dir, re.sub(r"[^A-Za-z0-9_.-]+", "_", namespace))
+        os.makedirs(self.path, exist_ok=True)
+        self.max_rows = max_rows
+        self._meta_path = os.path.join(self.path, "meta.json")
+        self._lock_path = os.path.join(self.path, ".lock")
+
+        self._thread_lock = threading.Lock()
+        self._rows: Dict[str, int] = {}
+        self._index_offset = 0
+        self._dim: Optional[int] = None
+        self._generation = 0
+        self._mmap: Optional[np.memmap] = None
+        self._load_meta()
+
+    @staticmethod
+    def make_key(model_name: str, instruction: str, text: str) -> str:
+        return hashlib.sha256(f"{model_name}\0{instruction}\0{text}".encode("utf-8")).hexdigest()
+
+    @property
+    def _vectors_path(self) -> str:
+        return os.path.join(self.path, f"vectors.{self._generation}.f32")
+
+    @property
+    def _index_path(self) -> str:
+        return os.path.join(self.path, f"index.{self._generation}.tsv")
+
+    @contextmanager
+    def _file_lock(self, mode: int):
+        with open(self._lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, mode)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load_meta(self):
+        """Перечитывает meta.json; если другой процесс начал новое поколение — сбрасывает прочитанный индекс."""
+        if not os.path.exists(self._meta_path):
+            return
+        with open(self._meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        self._dim = meta["dim"]
+        generation = meta.get("generation", 0)
+        if generation != self._generation:
+            self._generation = generation
+            self._rows = {}
+            self._index_offset = 0
+            self._mmap = None
+
+    def _write_meta(self):
+        tmp_path = self._meta_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"dim": self._dim, "generation": self._generation}, f)
+        os.replace(tmp_path, self._meta_path)
+
+    def _refresh_index(self):
+        self._load_meta()
+        try:
+            with open(self._index_path, "rb") as f:
+                f.seek(self._index_offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        # Недописанную последнюю строку оставляем до следующего чтения
+        complete = data[:data.rfind(b"\n") + 1]
+        for line in complete.decode("utf-8").splitlines():
+            key, row = line.split("\t")
+            self._rows[key] = int(row)
+        self._index_offset += len(complete)
+
+    def _vectors(self, rows_needed: int) -> np.memmap:
+        if self._mmap is None or self._mmap.shape[0] < rows_needed:
+            rows = os.path.getsize(self._vectors_path) // (4 * self._dim)
+            self._mmap = np.memmap(self._vectors_path, dtype=np.float32, mode="r", shape=(rows, self._dim))
+        return self._mmap
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        with self._thread_lock:
+            if not keys:
+                return {}
+            if all(key in self._rows for key in keys) and self._mmap is not None \
+                    and self._mmap.shape[0] > max(self._rows[key] for key in keys):
+                # Уже открытый memmap переживает удаление файла ротацией, блокировка не нужна
+                return {key: self._mmap[self._rows[key]].tolist() for key in keys}
+            # Обновление индекса и открытие memmap — под разделяемым flock: _rotate() другого процесса
+            # (под эксклюзивным) не удалит файлы поколения между чтением индекса и открытием векторов
+            with self._file_lock(fcntl.LOCK_SH):
+                self._refresh_index()
+                found = {key: self._rows[key] for key in keys if key in self._rows}
+                if not found or self._dim is None:
+                    return {}
+                vectors = self._vectors(max(found.values()) + 1)
+            return {key: vectors[row].tolist() for key, row in found.items()}
+
+    @staticmethod
+    def _truncate_to(path: str, size: int):
+        if os.path.exists(path) and os.path.getsize(path) != size:
+            os.truncate(path, size)
+
+    def _rotate(self):
+        old_files = (self._vectors_path, self._index_path)
+        self._generation += 1
+        self._rows = {}
+        self._index_offset = 0
+        self._mmap = None
+        self._write_meta()
+        for path in old_files:
+            if os.path.exists(path):
+                os.remove(path)
+        logging.info(f"Кэш эмбеддингов {self.path} достиг {self.max_rows} векторов, начато поколение {self._generation}.")
+
+    def put_many(self, items: Dict[str, List[float]]):
+        if not items:
+            return
+        with self._thread_lock, self._file_lock(fcntl.LOCK_EX):
+            self._refresh_index()
+            new_items = {key: vector for key, vector in items.items() if key not in self._rows}
+            if not new_items:
+                return
+
+            matrix = np.asarray(list(new_items.values()), dtype=np.float32)
+            if self._dim is None:
+                self._dim = matrix.shape[1]
+                self._write_meta()
+            elif matrix.shape[1] != self._dim:
+                logging.warning(f"Размерность эмбеддингов ({matrix.shape[1]}) не совпадает с кэшем "
+                                f"({self._dim}) в {self.path}. Запись в кэш пропущена.")
+                return
+
+            # Хвосты прерванной записи (процесс упал посреди write) обрезаются до целых строк,
+            # иначе следующие векторы сместятся относительно номеров строк в индексе
+            row_bytes = 4 * self._dim
+            start_row = os.path.getsize(self._vectors_path) // row_bytes if os.path.exists(self._vectors_path) else 0
+            if self.max_rows and start_row + len(new_items) > self.max_rows:
+                self._rotate()
+                start_row = 0
+            self._truncate_to(self._vectors_path, start_row * row_bytes)
+            self._truncate_to(self._index_path, self._index_offset)
+
+            with open(self._vectors_path, "ab") as f:
+                f.write(matrix.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+
+            lines = []
+            for offset, key in enumerate(new_items):
+                self._rows[key] = start_row + offset
+                lines.append(f"{key}\t{start_row + offset}\n")
+            with open(self._index_path, "ab") as f:
+                f.write("".join(lines).encode("utf-8"))
+            self._index_offset = os.path.getsize(self._index_path)
+
+
+class CachedEmbedding(BaseEmbedding):
+    """
+    Обёртка над embedding-моделью llama_index с дисковым кэшем EmbeddingDiskCache.
+    Ключ кэша — (имя модели, instruction-префикс, хэш текста), поэтому векторы запросов
+    и фрагментов базы знаний не смешиваются. Запросы пользователей почти не повторяются,
+    поэтому по умолчанию (cache_queries=False) их векторы на диск не пишутся и считаются напрямую.
+    """
+
+    _inner: BaseEmbedding = PrivateAttr()
+    _store: EmbeddingDiskCache = PrivateAttr()
+    _query_instruction: str = PrivateAttr()
+    _text_instruction: str = PrivateAttr()
+    _cache_queries: bool = PrivateAttr()
+
+    def __init__(self, inner: BaseEmbedding, cache_dir: str, max_rows: int = 0, cache_queries: bool = False,
+                 **kwargs):
+        super().__init__(model_name=inner.model_name, embed_batch_size=inner.embed_batch_size, **kwargs)
+        self._inner = inner
+        self._store = EmbeddingDiskCache(cache_dir, namespace=inner.model_name, max_rows=max_rows)
+        self._cache_queries = cache_queries
+        self._query_instruction = getattr(inner, "query_instruction", None) or ""
+        self._text_instruction = getattr(inner, "text_instruction", None) or ""
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedEmbedding"
+
+    @property
+    def inner(self) -> BaseEmbedding:
+        return self._inner
+
+    def _cached(self, texts: List[str], instruction: str,
+                compute: Callable[[List[str]], List[List[float]]]) -> List[List[float]]:
+        keys = [EmbeddingDiskCache.make_key(self.model_name, instruction, text) for text in texts]
+        found = self._store.get_many(keys)
+
+        missing = [i for i, key in enumerate(keys) if key not in found]
+        if missing:
+            computed = compute([texts[i] for i in missing])
+            new_items = {keys[i]: vector for i, vector in zip(missing, computed)}
+            self._store.put_many(new_items)
+            found.update(new_items)
+
+        return [found[key] for key in keys]
+
+    def _compute_queries(self, queries: List[str]) -> List[List[float]]:
+        embed = getattr(self._inner, "_embed", None)
+        if embed is not None:
+            return embed(queries, prompt_name="query")
+        return [self._inner.get_query_embedding(q) for q in queries]
+
+    def get_query_embedding_batch(self, queries: List[str]) -> List[List[float]]:
+        if not self._cache_queries:
+            return self._compute_queries(queries)
+        return self._cached(queries, self._query_instruction, self._compute_queries)
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self.get_query_embedding_batch([query])[0]
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return self._get_query_embedding(query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._get_text_embeddings([text])[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return self._cached(texts, self._text_instruction, self._inner.get_text_embedding_batch)
@@ -0,0 +1,136 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable
+
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", 0)) or max(1, min(4, os.cpu_count() or 1))
+INFERENCE_QUEUE_SIZE = int(os.getenv("INFERENCE_QUEUE_SIZE", 32))
+INFERENCE_DEADLINE_SEC = float(os.getenv("INFERENCE_DEADLINE_SEC", 30.0))
+
+
+class InferenceSaturated(Exception):
+    """Все потоки заняты и очередь допуска заполнена."""
+
+
+class InferenceDeadlineExceeded(Exception):
+    """Запрос не уложился в дедлайн (в очереди или во время выполнения)."""
+
+
+@dataclass
+class InferenceTiming:
+    queue_wait_ms: float
+    exec_ms: float
+
+    def server_timing(self) -> str:
+        return f"queue;dur={self.queue_wait_ms:.1f}, exec;dur={self.exec_ms:.1f}"
+
+
+class InferenceExecutor:
+    """
+    Отдельный ограниченный пул потоков для CPU-тяжёлого инференса синхронных API-эндпоинтов.
+    Одновременно допускается не больше workers + queue_size запросов, лишние сразу получают отказ.
+    Запрос, который простоял в очереди дольше дедлайна, не выполняется. Если дедлайн истёк во время выполнения,
+    клиент сразу получает отказ, а работа брошена: поток доделывает её вхолостую, и слот допуска
+    освобождается только когда поток действительно завершится, поэтому брошенная работа не превышает лимит пула.
+    """
+
+    def __init__(self, workers: int, queue_size: int, deadline_sec: float):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.deadline_sec = deadline_sec
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="inference")
+        self._admitted = 0
+        self._admitted_lock = threading.Lock()
+        self._running = 0
+
+        self.completed = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self._queue_wait_ms_total = 0.0
+        self._exec_ms_total = 0.0
+
+    async def run(self, fn: Callable, *args: Any) -> tuple[Any, InferenceTiming]:
+        with self._admitted_lock:
+            if self._admitted >= self.workers + self.queue_size:
+                self.rejected += 1
+                raise InferenceSaturated()
+            self._admitted += 1
+        submitted_at = time.monotonic()
+        deadline = submitted_at + self.deadline_sec
+        timing = {}
+
+        def job():
+            started_at = time.monotonic()
+            timing["queue_wait"] = started_at - submitted_at
+            if started_at > deadline:
+                raise InferenceDeadlineExceeded()
+            self._running += 1
+            try:
+                return fn(*args)
+            finally:
+                self._running -= 1
+                timing["exec"] = time.monotonic() - started_at
+
+        future = self._pool.submit(job)
+        future.add_done_callback(self._release)
+        try:
+            result = await asyncio.wait_for(asyncio.wrap_future(future), timeout=self.deadline_sec)
+        except (asyncio.TimeoutError, InferenceDeadlineExceeded):
+            # Ещё не начатый запрос отменяется; начатый поток дорабатывает, но ответ уже не ждут
+            future.cancel()
+            self.timed_out += 1
+            raise InferenceDeadlineExceeded()
+
+        result_timing = InferenceTiming(queue_wait_ms=timing["queue_wait"] * 1000, exec_ms=timing["exec"] * 1000)
+        self.completed += 1
+        self._queue_wait_ms_total += result_timing.queue_wait_ms
+        self._exec_ms_total += result_timing.exec_ms
+        return result, result_timing
+
+    def _release(self, future):
+        # Вызывается из потока пула по завершении (или при отмене ещё не начатого) запроса
+        with self._admitted_lock:
+            self._admitted -= 1
+
+    def ensure_workers(self, workers: int):
+        """
+        Увеличивает пул до workers потоков. Нужно для micro-batching: каждый запрос пачки держит поток пула,
+        пока ждёт результат, поэтому при пуле меньше пачки пачка никогда не наберётся.
+        """
+        if workers <= self.workers:
+            return
+        logging.warning(f"Пул инференса увеличен с {self.workers} до {workers} потоков (под размер micro-batch).")
+        old_pool = self._pool
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="inference")
+        self.workers = workers
+        # Уже начатые запросы дорабатывают в старом пуле
+        old_pool.shutdown(wait=False)
+
+    def retry_after(self) -> int:
+        """Грубая оценка для Retry-After: один дедлайн на весь пул."""
+        return max(1, int(self.deadline_sec / self.workers))
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "queue_size": self.queue_size,
+            "deadline_sec": self.deadline_sec,
+            "running": self._running,
+            "queued": max(0, self._admitted - self._running),
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "avg_queue_wait_ms": round(self._queue_wait_ms_total / self.completed, 2) if self.completed else 0.0,
+            "avg_exec_ms": round(self._exec_ms_total / self.completed, 2) if self.completed else 0.0,
+        }
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        logging.info("Пул инференса остановлен.")
+
+
+inference_executor = InferenceExecutor(INFERENCE_WORKERS, INFERENCE_QUEUE_SIZE, INFERENCE_DEADLINE_SEC)
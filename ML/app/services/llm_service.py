@@ -1,52 +1,267 @@
-import requests
+import asyncio
+import hashlib
+import json
+import logging
 import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import AsyncIterator, Callable, Iterator
+
+import httpx
 from dotenv import load_dotenv
-from llama_index.llms.openai import OpenAI
 
 load_dotenv()
 
 OLLAMA_URL = os.getenv("OLLAMA_URL")
 MODEL_NAME = os.getenv("MODEL_NAME")
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", 180))
+# Для стриминга таймаут чтения — пауза между соседними чанками, а не вся генерация
+LLM_STREAM_READ_TIMEOUT = float(os.getenv("LLM_STREAM_READ_TIMEOUT", 60))
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", 10))
+LLM_MAX_CONCURRENCY_PER_MODEL = int(os.getenv("LLM_MAX_CONCURRENCY_PER_MODEL", 2))
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", 256))
+LLM_CACHE_TTL_SEC = float(os.getenv("LLM_CACHE_TTL_SEC", 600))
+
+DEFAULT_OPTIONS = {"num_ctx": 2048}
+UNAVAILABLE_ANSWER = "Извините, сервис LLM временно недоступен."
+
+_STREAM_END = object()
 
 
 class LLMService:
-    def __init__(self, llm: OpenAI):
-        self._llm = llm
+    """
+    Клиент Ollama с одним пулом keep-alive соединений (httpx.AsyncClient) на процесс.
+    Клиент живёт в собственном event loop в фоновом потоке, поэтому им пользуются и синхронные
+    вызывающие (потоки инференса, Celery), и async-эндпоинты. Поверх пула:
+      - не больше LLM_MAX_CONCURRENCY_PER_MODEL одновременных генераций на модель;
+      - одинаковые одновременные запросы (модель, промпт, опции) склеиваются в один запрос к Ollama;
+      - LRU-кэш готовых ответов с TTL.
+    """
+
+    def __init__(self, base_url: str | None = OLLAMA_URL, model: str | None = MODEL_NAME):
+        self._base_url = base_url
+        self._model = model
+        self._lock = threading.Lock()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._client: httpx.AsyncClient | None = None
+        self._semaphores: dict[str, asyncio.Semaphore] = {}
+        self._in_flight: dict[str, asyncio.Future] = {}
+        self._cache: "OrderedDict[str, tuple[float, str]]" = OrderedDict()
+
+        self.requests_total = 0
+        self.coalesced = 0
+        self.cache_hits = 0
+        self.errors = 0
 
     def is_available(self) -> bool:
-        return self._llm is not None
+        return bool(self._base_url)
 
-    @staticmethod
-    def _send_request(prompt: str) -> str:
-        if not OLLAMA_URL:
+    # --- event loop клиента ---
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        # Создаётся при первом запросе, т.е. уже в дочернем процессе воркера, а не до fork
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="llm-client", daemon=True).start()
+                self._loop = loop
+            return self._loop
+
+    def _submit(self, coro) -> Future:
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
+
+    def _http(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self._base_url,
+                timeout=httpx.Timeout(LLM_TIMEOUT, connect=10.0),
+                limits=httpx.Limits(max_connections=LLM_MAX_CONNECTIONS,
+                                    max_keepalive_connections=LLM_MAX_CONNECTIONS),
+            )
+        return self._client
+
+    def _semaphore(self, model: str) -> asyncio.Semaphore:
+        if model not in self._semaphores:
+            self._semaphores[model] = asyncio.Semaphore(LLM_MAX_CONCURRENCY_PER_MODEL)
+        return self._semaphores[model]
+
+    def _payload(self, prompt: str, options: dict | None, stream: bool) -> dict:
+        return {
+            "model": self._model,
+            "prompt": prompt,
+            "stream": stream,
+            "options": {**DEFAULT_OPTIONS, **(options or {})},
+        }
+
+    # --- кэш ответов ---
+
+    def _cache_key(self, prompt: str, options: dict | None) -> str:
+        prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        return f"{self._model}|{prompt_hash}|{json.dumps({**DEFAULT_OPTIONS, **(options or {})}, sort_keys=True)}"
+
+    def _cache_get(self, key: str) -> str | None:
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        stored_at, answer = entry
+        if time.monotonic() - stored_at > LLM_CACHE_TTL_SEC:
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)
+        return answer
+
+    def _cache_put(self, key: str, answer: str):
+        if LLM_CACHE_SIZE <= 0:
+            return
+        self._cache[key] = (time.monotonic(), answer)
+        self._cache.move_to_end(key)
+        while len(self._cache) > LLM_CACHE_SIZE:
+            self._cache.popitem(last=False)
+
+    # --- запросы (выполняются в loop клиента) ---
+
+    async def _generate(self, prompt: str, options: dict | None) -> str:
+        key = self._cache_key(prompt, options)
+        cached = self._cache_get(key)
+        if cached is not None:
+            self.cache_hits += 1
+            return cached
+
+        pending = self._in_flight.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            return await asyncio.shield(pending)
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            async with self._semaphore(self._model):
+                self.requests_total += 1
+                response = await self._http().post("/api/generate", json=self._payload(prompt, options, False))
+                response.raise_for_status()
+                answer = response.json().get("response", "").strip()
+            self._cache_put(key, answer)
+            future.set_result(answer)
+            return answer
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            self.errors += 1
+            future.set_exception(e)
+            # Исключение получат склеенные запросы; помечаем его полученным, если их не было
+            future.exception()
+            raise
+        finally:
+            del self._in_flight[key]
+
+    async def _stream(self, prompt: str, options: dict | None, push: Callable):
+        """Отдаёт фрагменты ответа Ollama через push(...) по мере генерации; в конце — _STREAM_END или исключение."""
+        try:
+            async with self._semaphore(self._model):
+                self.requests_total += 1
+                async with self._http().stream(
+                        "POST", "/api/generate", json=self._payload(prompt, options, True),
+                        timeout=httpx.Timeout(LLM_TIMEOUT, connect=10.0, read=LLM_STREAM_READ_TIMEOUT),
+                ) as response:
+                    response.raise_for_status()
+                    async for line in response.aiter_lines():
+                        if not line:
+                            continue
+                        chunk = json.loads(line)
+                        if chunk.get("error"):
+                            raise RuntimeError(chunk["error"])
+                        if chunk.get("response"):
+                            push(chunk["response"])
+                        if chunk.get("done"):
+                            break
+        except Exception as e:
+            self.errors += 1
+            push(e)
+            return
+        push(_STREAM_END)
+
+    # --- публичный API ---
+
+    def _send_request(self, prompt: str, options: dict | None = None) -> str:
+        if not self._base_url:
             raise ValueError("Не задана переменная окружения OLLAMA_URL")
+        try:
+            return self._submit(self._generate(prompt, options)).result()
+        except (httpx.HTTPError, ValueError) as e:
+            logging.error(f"Ошибка при обращении к Ollama: {e}")
+            return UNAVAILABLE_ANSWER
 
+    async def _asend_request(self, prompt: str, options: dict | None = None) -> str:
+        if not self._base_url:
+            raise ValueError("Не задана переменная окружения OLLAMA_URL")
         try:
-            response = requests.post(
-                f"{OLLAMA_URL}/api/generate",
-                json={
-                    "model": MODEL_NAME,
-                    "prompt": prompt,
-                    "stream": False,
-                    "options": {
-                        "num_ctx": 2048
-                    }
-                },
-                timeout=180
-            )
-            response.raise_for_status()
-            return response.json().get("response", "").strip()
-        except requests.RequestException as e:
-            print(f"Ошибка при обращении к Ollama: {e}")
-            return "Извините, сервис LLM временно недоступен."
+            return await asyncio.wrap_future(self._submit(self._generate(prompt, options)))
+        except (httpx.HTTPError, ValueError) as e:
+            logging.error(f"Ошибка при обращении к Ollama: {e}")
+            return UNAVAILABLE_ANSWER
+
+    def _stream_request(self, prompt: str, options: dict | None = None) -> Iterator[str]:
+        if not self._base_url:
+            raise ValueError("Не задана переменная окружения OLLAMA_URL")
+        items: "queue.Queue" = queue.Queue()
+        task = self._submit(self._stream(prompt, options, items.put))
+        try:
+            while True:
+                item = items.get()
+                if item is _STREAM_END:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # Клиент ушёл раньше конца генерации — отменяем запрос к Ollama
+            task.cancel()
+
+    async def _astream_request(self, prompt: str, options: dict | None = None) -> AsyncIterator[str]:
+        if not self._base_url:
+            raise ValueError("Не задана переменная окружения OLLAMA_URL")
+        caller_loop = asyncio.get_running_loop()
+        items: asyncio.Queue = asyncio.Queue()
+        task = self._submit(self._stream(prompt, options,
+                                         lambda item: caller_loop.call_soon_threadsafe(items.put_nowait, item)))
+        try:
+            while True:
+                item = await items.get()
+                if item is _STREAM_END:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            task.cancel()
 
     def get_simple_response(self, prompt: str) -> str:
         if not self.is_available():
             return "LLM сервис не сконфигурирован."
         return self._send_request(prompt)
 
-    def get_rag_based_answer(self, user_query: str, context: str) -> str:
-        prompt = f"""
+    async def aget_simple_response(self, prompt: str) -> str:
+        if not self.is_available():
+            return "LLM сервис не сконфигурирован."
+        return await self._asend_request(prompt)
+
+    def stream_simple_response(self, prompt: str) -> Iterator[str]:
+        if not self.is_available():
+            raise RuntimeError("LLM сервис не сконфигурирован.")
+        return self._stream_request(prompt)
+
+    def astream_simple_response(self, prompt: str) -> AsyncIterator[str]:
+        if not self.is_available():
+            raise RuntimeError("LLM сервис не сконфигурирован.")
+        return self._astream_request(prompt)
+
+    @staticmethod
+    def _rag_prompt(user_query: str, context: str) -> str:
+        return f"""
             Ты — полезный ассистент службы поддержки. Твоя задача — ответить на вопрос пользователя, опираясь ИСКЛЮЧИТЕЛЬНО на предоставленный ниже контекст. Не придумывай ничего от себя. Если в контексте нет прямого ответа, вежливо сообщи об этом. Старайся писать не в общем, а более конкретно по шагам, если информации из базы знаний для этого достаточно.
             
             КОНТЕКСТ:
@@ -59,4 +274,32 @@ class LLMService:
             
             ОТВЕТ:
             """
-        return self._send_request(prompt)
+
+    def get_rag_based_answer(self, user_query: str, context: str) -> str:
+        return self._send_request(self._rag_prompt(user_query, context))
+
+    async def aget_rag_based_answer(self, user_query: str, context: str) -> str:
+        return await self._asend_request(self._rag_prompt(user_query, context))
+
+    def stream_rag_based_answer(self, user_query: str, context: str) -> Iterator[str]:
+        return self._stream_request(self._rag_prompt(user_query, context))
+
+    def stats(self) -> dict:
+        return {
+            "model": self._model,
+            "requests_total": self.requests_total,
+            "coalesced": self.coalesced,
+            "cache_hits": self.cache_hits,
+            "errors": self.errors,
+            "in_flight": len(self._in_flight),
+            "cache_size": len(self._cache),
+            "max_connections": LLM_MAX_CONNECTIONS,
+            "max_concurrency_per_model": LLM_MAX_CONCURRENCY_PER_MODEL,
+        }
+
+    def close(self):
+        if self._loop is None:
+            return
+        if self._client is not None:
+            self._submit(self._client.aclose()).result(timeout=5)
+        self._loop.call_soon_threadsafe(self._loop.stop)
@@ -0,0 +1,156 @@
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+import numpy as np
+
+from app.schemas.agent_schemas import SourceNode
+
+
+def normalize_query(query: str) -> str:
+    return re.sub(r"\s+", " ", query).strip().lower()
+
+
+class QueryResultCache:
+    """
+    Двухуровневый кэш результатов RAG-поиска.
+    1) Точное совпадение нормализованного текста запроса (LRU).
+    2) Семантическое совпадение: косинусное расстояние до эмбеддинга уже обработанного запроса
+       не больше max_distance.
+    Оба уровня ограничены по размеру и TTL. Кэш сбрасывается, когда индексатор
+    переписывает файл-версию индекса (version_path).
+    """
+
+    def __init__(self, max_size: int = 1024, ttl_sec: float = 600.0, max_distance: float = 0.05,
+                 version_path: Optional[str] = None):
+        self.max_size = max_size
+        self.ttl_sec = ttl_sec
+        self.max_distance = max_distance
+        self._version_path = version_path
+        self._version = self._read_version()
+        self._lock = threading.Lock()
+
+        self._exact: "OrderedDict[str, tuple[float, List[SourceNode]]]" = OrderedDict()
+        self._semantic_keys: List[str] = []
+        self._semantic_vectors = np.empty((0, 0), dtype=np.float32)
+        self._semantic_entries: "OrderedDict[str, tuple[float, List[SourceNode]]]" = OrderedDict()
+
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _read_version(self) -> Optional[float]:
+        if not self._version_path:
+            return None
+        try:
+            return os.path.getmtime(self._version_path)
+        except OSError:
+            return None
+
+    def _check_version(self):
+        version = self._read_version()
+        if version != self._version:
+            logging.info("Индекс базы знаний изменился, кэш RAG-запросов сброшен.")
+            self._version = version
+            self._clear()
+            self.invalidations += 1
+
+    def _clear(self):
+        self._exact.clear()
+        self._semantic_entries.clear()
+        self._semantic_keys = []
+        self._semantic_vectors = np.empty((0, 0), dtype=np.float32)
+
+    def invalidate(self):
+        with self._lock:
+            self._clear()
+            self.invalidations += 1
+
+    def get_exact(self, query: str) -> Optional[List[SourceNode]]:
+        key = normalize_query(query)
+        now = time.monotonic()
+        with self._lock:
+            self._check_version()
+            entry = self._exact.get(key)
+            if entry is None:
+                return None
+            stored_at, results = entry
+            if now - stored_at > self.ttl_sec:
+                del self._exact[key]
+                return None
+            self._exact.move_to_end(key)
+            self.exact_hits += 1
+            return results
+
+    def get_similar(self, query: str, embedding: List[float]) -> Optional[List[SourceNode]]:
+        vector = self._normalize(embedding)
+        now = time.monotonic()
+        with self._lock:
+            if not self._semantic_keys:
+                self.misses += 1
+                return None
+            similarities = self._semantic_vectors @ vector
+            best = int(np.argmax(similarities))
+            key = self._semantic_keys[best]
+            stored_at, results = self._semantic_entries[key]
+            if 1.0 - float(similarities[best]) > self.max_distance or now - stored_at > self.ttl_sec:
+                self.misses += 1
+                return None
+            self.semantic_hits += 1
+            self._exact[normalize_query(query)] = (stored_at, results)
+            self._evict(self._exact)
+            return results
+
+    def put(self, query: str, embedding: Optional[List[float]], results: List[SourceNode]):
+        key = normalize_query(query)
+        now = time.monotonic()
+        with self._lock:
+            self._exact[key] = (now, results)
+            self._exact.move_to_end(key)
+            self._evict(self._exact)
+
+            if embedding is None:
+                return
+            self._semantic_entries[key] = (now, results)
+            self._semantic_entries.move_to_end(key)
+            self._evict(self._semantic_entries)
+            self._rebuild_semantic_matrix(key, self._normalize(embedding))
+
+    def _evict(self, entries: OrderedDict):
+        now = time.monotonic()
+        while entries:
+            oldest_key = next(iter(entries))
+            if len(entries) <= self.max_size and now - entries[oldest_key][0] <= self.ttl_sec:
+                break
+            del entries[oldest_key]
+
+    def _rebuild_semantic_matrix(self, new_key: str, new_vector: np.ndarray):
+        vectors = {k: self._semantic_vectors[i] for i, k in enumerate(self._semantic_keys)
+                   if k in self._semantic_entries}
+        vectors[new_key] = new_vector
+        self._semantic_keys = list(self._semantic_entries.keys())
+        self._semantic_vectors = np.stack([vectors[k] for k in self._semantic_keys]).astype(np.float32)
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.exact_hits + self.semantic_hits + self.misses
+            return {
+                "exact_hits": self.exact_hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.exact_hits + self.semantic_hits) / lookups, 4) if lookups else 0.0,
+                "invalidations": self.invalidations,
+                "exact_size": len(self._exact),
+                "semantic_size": len(self._semantic_entries),
+            }
@@ -1,14 +1,22 @@
 import os
+import json
+import math
 import logging
-from typing import List
+import threading
+from collections import defaultdict
+from typing import List, Tuple
 
 from dotenv import load_dotenv
 import chromadb
-from llama_index.core import VectorStoreIndex
+from llama_index.core import VectorStoreIndex, QueryBundle
 from llama_index.vector_stores.chroma import ChromaVectorStore
-from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+from llama_index.core.base.embeddings.base import BaseEmbedding
 
 from app.schemas.agent_schemas import SourceNode
+from app.services.query_cache import QueryResultCache
+from app.services.bm25_index import BM25Index
+from app.services.vector_index import DenseIndex
+from app.services.reranker import CrossEncoderReranker
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 load_dotenv()
@@ -17,43 +25,149 @@ DB_DIR = "./db"
 COLLECTION_NAME = "knowledge_base_main"
 EMBED_MODEL_NAME = os.getenv("EMBED_MODEL_NAME", "sentence-transformers/paraphrase-multilingual-mpnet-base-v2")
 TOP_K_RESULTS = int(os.getenv("TOP_K_RESULTS", 3))
+MANIFEST_PATH = os.path.join(DB_DIR, "index_manifest.json")
+RAG_CACHE_ENABLED = os.getenv("RAG_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+RAG_CACHE_MAX_SIZE = int(os.getenv("RAG_CACHE_MAX_SIZE", 1024))
+RAG_CACHE_TTL_SEC = float(os.getenv("RAG_CACHE_TTL_SEC", 600))
+RAG_CACHE_MAX_DISTANCE = float(os.getenv("RAG_CACHE_MAX_DISTANCE", 0.05))
+# vector — только Chroma; hybrid — слияние рангов Chroma и BM25 (RRF)
+RAG_RETRIEVAL_MODE = os.getenv("RAG_RETRIEVAL_MODE", "vector").lower()
+BM25_INDEX_PATH = os.path.join(DB_DIR, "bm25_index.json")
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", 20))
+RRF_K = int(os.getenv("RRF_K", 60))
+# Сильное ключевое совпадение (скор BM25 не ниже порога и в MARGIN раз выше второго) отвечает без эмбеддинга; 0 — выключено
+BM25_EARLY_EXIT_SCORE = float(os.getenv("BM25_EARLY_EXIT_SCORE", 0))
+BM25_EARLY_EXIT_MARGIN = float(os.getenv("BM25_EARLY_EXIT_MARGIN", 2.0))
+# chroma — поиск через коллекцию Chroma; numpy — по матрице эмбеддингов в памяти (memmap файла индексатора)
+RAG_VECTOR_ENGINE = os.getenv("RAG_VECTOR_ENGINE", "chroma").lower()
+VECTOR_INDEX_PATH = os.path.join(DB_DIR, "vector_index.npy")
+VECTOR_META_PATH = os.path.join(DB_DIR, "vector_index.json")
+# Сколько кандидатов первого этапа получает cross-encoder (при включённом переранжировании)
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", 20))
+# Минимум фрагментов в разделе категории, чтобы искать только в нём
+ROUTING_MIN_PARTITION_SIZE = int(os.getenv("ROUTING_MIN_PARTITION_SIZE", 1))
 
 
 class RAGService:
-    def __init__(self, embed_model: HuggingFaceEmbedding):
+    def __init__(self, embed_model: BaseEmbedding, reranker: CrossEncoderReranker | None = None):
         logging.info("Инициализация RAGService...")
 
-        db = chromadb.PersistentClient(path=DB_DIR)
+        self._db = chromadb.PersistentClient(path=DB_DIR)
+        self._embed_model = embed_model
+        self.reranker = reranker
+        # С переранжированием первый этап возвращает более широкий набор кандидатов
+        self._first_stage_k = max(RERANK_CANDIDATES, TOP_K_RESULTS) if reranker is not None else TOP_K_RESULTS
 
-        try:
-            # Используем get_or_create вместо get для надёжности
-            chroma_collection = db.get_or_create_collection(COLLECTION_NAME)
-            count = chroma_collection.count()
-            logging.info(f"Коллекция '{COLLECTION_NAME}' содержит {count} документов.")
-            
-            if count == 0:
-                logging.warning("Коллекция пуста! Возможно, требуется запустить индексацию.")
-        except Exception as e:
-            logging.error(f"Ошибка при работе с коллекцией '{COLLECTION_NAME}': {e}")
-            raise
-
-        vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
-
-        self.index = VectorStoreIndex.from_vector_store(
-            vector_store=vector_store,
-            embed_model=embed_model,
-        )
+        # Локальные индексы, которые пишет indexer.py: имя -> (mtime файла, индекс)
+        self._local_indexes: dict[str, tuple[float, object]] = {}
+        self._local_lock = threading.Lock()
+        self._collection_name: str | None = None
+        self._sync_collection()
 
-        self.retriever = self.index.as_retriever(
-            similarity_top_k=TOP_K_RESULTS
-        )
+        self.cache: QueryResultCache | None = self._new_cache() if RAG_CACHE_ENABLED else None
+        # Поиск в разделе категории даёт другие результаты, чем глобальный: у каждого раздела свой кэш
+        self._category_caches: dict[str, QueryResultCache] = {}
+
+        if RAG_RETRIEVAL_MODE == "hybrid" and self._bm25_index() is None:
+            logging.warning(f"BM25-индекс {BM25_INDEX_PATH} не найден: гибридный поиск работает как векторный.")
+        if RAG_VECTOR_ENGINE == "numpy" and self._dense_index() is None:
+            logging.warning(f"Векторная матрица {VECTOR_INDEX_PATH} не найдена: поиск идёт через Chroma.")
 
         logging.info("RAGService готов к работе.")
 
-    def query(self, user_query: str) -> List[SourceNode]:
+    @staticmethod
+    def _new_cache() -> QueryResultCache:
+        return QueryResultCache(
+            max_size=RAG_CACHE_MAX_SIZE,
+            ttl_sec=RAG_CACHE_TTL_SEC,
+            max_distance=RAG_CACHE_MAX_DISTANCE,
+            version_path=MANIFEST_PATH,
+        )
+
+    def _cache_for(self, category: str | None) -> QueryResultCache | None:
+        if self.cache is None or category is None:
+            return self.cache
+        with self._local_lock:
+            if category not in self._category_caches:
+                self._category_caches[category] = self._new_cache()
+            return self._category_caches[category]
+
+    def _manifest(self) -> dict:
+        def load():
+            try:
+                with open(MANIFEST_PATH, "r", encoding="utf-8") as f:
+                    return json.load(f)
+            except (OSError, ValueError):
+                return {}
+        return self._local_index("manifest", MANIFEST_PATH, load) or {}
+
+    def _sync_collection(self):
+        """
+        Подключается к коллекции, указанной в манифесте. При смене параметров индексации indexer.py
+        строит новую коллекцию и переключает манифест на неё — сервис переходит на неё при следующем запросе.
+        """
+        name = self._manifest().get("collection", COLLECTION_NAME)
+        if name == self._collection_name:
+            return
+        with self._local_lock:
+            if name == self._collection_name:
+                return
+            try:
+                # Используем get_or_create вместо get для надёжности
+                chroma_collection = self._db.get_or_create_collection(name)
+                count = chroma_collection.count()
+                logging.info(f"Коллекция '{name}' содержит {count} документов.")
+
+                if count == 0:
+                    logging.warning("Коллекция пуста! Возможно, требуется запустить индексацию.")
+            except Exception as e:
+                logging.error(f"Ошибка при работе с коллекцией '{name}': {e}")
+                raise
+
+            vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
+            self.index = VectorStoreIndex.from_vector_store(
+                vector_store=vector_store,
+                embed_model=self._embed_model,
+            )
+            self.retriever = self.index.as_retriever(
+                similarity_top_k=TOP_K_RESULTS
+            )
+            self._collection = chroma_collection
+            self._collection_name = name
+
+    def known_categories(self) -> dict[str, int]:
+        """Категории с числом фрагментов из манифеста индексатора."""
+        return self._manifest().get("categories", {})
+
+    def route(self, category: str | None) -> str | None:
+        """Раздел для поиска; None — глобальный индекс (категория не размечена или раздел слишком мал)."""
+        if category is None or self.known_categories().get(category, 0) < ROUTING_MIN_PARTITION_SIZE:
+            return None
+        return category
+
+    def query(self, user_query: str, category: str | None = None) -> List[SourceNode]:
+        if category is not None or self.reranker is not None or self._bm25_index() is not None \
+                or self._dense_index() is not None:
+            return self.query_batch([user_query], [category])[0]
+
         logging.info(f"Выполняется RAG-поиск по запросу: '{user_query}'")
+        self._sync_collection()
+
+        if self.cache is not None:
+            cached = self.cache.get_exact(user_query)
+            if cached is not None:
+                logging.info("Результат RAG-поиска взят из кэша (точное совпадение).")
+                return cached
+
+        embedding = self._embed_model.get_query_embedding(user_query)
 
-        nodes_with_scores = self.retriever.retrieve(user_query)
+        if self.cache is not None:
+            cached = self.cache.get_similar(user_query, embedding)
+            if cached is not None:
+                logging.info("Результат RAG-поиска взят из кэша (семантическое совпадение).")
+                return cached
+
+        nodes_with_scores = self.retriever.retrieve(QueryBundle(query_str=user_query, embedding=embedding))
 
         if not nodes_with_scores:
             logging.warning("Релевантных документов не найдено.")
@@ -68,5 +182,261 @@ class RAGService:
             )
             results.append(source_node)
 
+        if self.cache is not None:
+            self.cache.put(user_query, embedding, results)
+
         logging.info(f"Найдено {len(results)} релевантных источников.")
         return results
+
+    def query_batch(self, user_queries: List[str],
+                    categories: List[str | None] | None = None) -> List[List[SourceNode]]:
+        """
+        Пакетный RAG-поиск: одно батч-вычисление эмбеддингов и один запрос к Chroma на весь список.
+        Скоры считаются так же, как в ChromaVectorStore, чтобы порог RAG_CONFIDENCE_THRESHOLD оставался применим.
+        В режиме hybrid перед эмбеддингом выполняется поиск BM25, а ранги сливаются через RRF.
+        С reranker первый этап отдаёт RERANK_CANDIDATES кандидатов, а score — вероятность cross-encoder.
+        categories — разделы для поиска по каждому запросу (None — глобальный индекс).
+        """
+        if not user_queries:
+            return []
+        logging.info(f"Выполняется пакетный RAG-поиск по {len(user_queries)} запросам.")
+
+        scopes = [self.route(category) for category in categories] if categories else [None] * len(user_queries)
+        caches = [self._cache_for(scope) for scope in scopes]
+
+        batch_results: List[List[SourceNode] | None] = [None] * len(user_queries)
+        for i, user_query in enumerate(user_queries):
+            if caches[i] is not None:
+                batch_results[i] = caches[i].get_exact(user_query)
+
+        pending = [i for i, result in enumerate(batch_results) if result is None]
+        searched = len(pending)
+
+        bm25 = self._bm25_index()
+        lexical_hits = {}
+        if bm25 is not None:
+            for i in pending:
+                lexical_hits[i] = bm25.search(user_queries[i], HYBRID_CANDIDATES, category=scopes[i])
+                batch_results[i] = self._keyword_match(bm25, lexical_hits[i])
+            pending = [i for i in pending if batch_results[i] is None]
+            if searched > len(pending):
+                logging.info(f"Сильное ключевое совпадение без эмбеддинга: {searched - len(pending)} запросов.")
+
+        if pending:
+            self._sync_collection()
+            embeddings = self._embed_queries([user_queries[i] for i in pending])
+
+            to_search = []
+            for i, embedding in zip(pending, embeddings):
+                if caches[i] is not None:
+                    batch_results[i] = caches[i].get_similar(user_queries[i], embedding)
+                if batch_results[i] is None:
+                    to_search.append((i, embedding))
+
+            if to_search:
+                search_scopes = [scopes[i] for i, _ in to_search]
+                if bm25 is not None:
+                    found = self._hybrid_search(bm25, [lexical_hits[i] for i, _ in to_search],
+                                                [embedding for _, embedding in to_search], self._first_stage_k,
+                                                search_scopes)
+                else:
+                    found = self._search_by_embeddings([embedding for _, embedding in to_search], self._first_stage_k,
+                                                       search_scopes)
+                if self.reranker is not None:
+                    found = self._rerank([user_queries[i] for i, _ in to_search], found)
+                for (i, embedding), results in zip(to_search, found):
+                    batch_results[i] = results
+                    if caches[i] is not None and results:
+                        caches[i].put(user_queries[i], embedding, results)
+
+        routed = sum(scope is not None for scope in scopes)
+        logging.info(f"Пакетный RAG-поиск завершён для {len(user_queries)} запросов "
+                     f"(поиск в индексе: {searched}, в разделах категорий: {routed}).")
+        return [results or [] for results in batch_results]
+
+    def _search_by_embeddings(self, embeddings: List[List[float]], n_results: int = TOP_K_RESULTS,
+                              categories: List[str | None] | None = None) -> List[List[SourceNode]]:
+        return [[node for _, node in hits] for hits in self._dense_candidates(embeddings, n_results, categories)]
+
+    def _dense_candidates(self, embeddings: List[List[float]], n_results: int,
+                          categories: List[str | None] | None = None) -> List[List[Tuple[str, SourceNode]]]:
+        """Векторный поиск; запросы одного раздела ищутся одним вызовом."""
+        groups: dict[str | None, List[int]] = defaultdict(list)
+        for i, category in enumerate(categories or [None] * len(embeddings)):
+            groups[category].append(i)
+
+        batch_results: List[List[Tuple[str, SourceNode]]] = [[] for _ in embeddings]
+        for category, positions in groups.items():
+            found = self._dense_group([embeddings[i] for i in positions], n_results, category)
+            for i, hits in zip(positions, found):
+                batch_results[i] = hits
+        return batch_results
+
+    def _dense_group(self, embeddings: List[List[float]], n_results: int,
+                     category: str | None) -> List[List[Tuple[str, SourceNode]]]:
+        dense = self._dense_index()
+        if dense is not None:
+            return self._matrix_candidates(dense, embeddings, n_results, category)
+
+        response = self._collection.query(
+            query_embeddings=embeddings,
+            n_results=n_results,
+            include=["documents", "metadatas", "distances"],
+            **({"where": {"category": category}} if category is not None else {}),
+        )
+
+        batch_results = []
+        for ids, documents, metadatas, distances in zip(
+                response.get("ids") or [],
+                response.get("documents") or [],
+                response.get("metadatas") or [],
+                response.get("distances") or [],
+        ):
+            results = []
+            for node_id, text, metadata, distance in zip(ids, documents, metadatas, distances):
+                results.append((node_id, SourceNode(
+                    text=text or "",
+                    score=math.exp(-distance),
+                    filename=(metadata or {}).get("file_name", "N/A"),
+                )))
+            batch_results.append(results)
+
+        # Chroma не возвращает строк для пустой коллекции — выравниваем длину ответа
+        while len(batch_results) < len(embeddings):
+            batch_results.append([])
+        return batch_results
+
+    @staticmethod
+    def _cosine_score(cosine: float) -> float:
+        # Для нормированных векторов l2-расстояние Chroma равно 2 - 2cos: скор совпадает с exp(-distance)
+        return math.exp(2.0 * cosine - 2.0)
+
+    def _matrix_candidates(self, dense: DenseIndex, embeddings: List[List[float]], n_results: int,
+                           category: str | None = None) -> List[List[Tuple[str, SourceNode]]]:
+        batch_hits = dense.search(DenseIndex.normalize(embeddings), n_results, category)
+        return [
+            [(dense.node_ids[row], SourceNode(
+                text=dense.texts[row],
+                score=self._cosine_score(cosine),
+                filename=dense.metadatas[row].get("file_name", "N/A"),
+            )) for row, cosine in hits]
+            for hits in batch_hits
+        ]
+
+    def _local_index(self, name: str, version_path: str, loader):
+        """Индекс из файла indexer.py; перечитывается, когда индексатор перезаписал файл."""
+        try:
+            mtime = os.stat(version_path).st_mtime
+        except OSError:
+            return None
+        entry = self._local_indexes.get(name)
+        if entry is None or entry[0] != mtime:
+            with self._local_lock:
+                entry = self._local_indexes.get(name)
+                if entry is None or entry[0] != mtime:
+                    entry = (mtime, loader())
+                    self._local_indexes[name] = entry
+                    if entry[1] is not None:
+                        logging.info(f"Загружен локальный индекс '{name}': {len(entry[1])} записей.")
+        return entry[1]
+
+    def _bm25_index(self) -> BM25Index | None:
+        if RAG_RETRIEVAL_MODE != "hybrid":
+            return None
+        return self._local_index("bm25", BM25_INDEX_PATH, lambda: BM25Index.load(BM25_INDEX_PATH))
+
+    def _dense_index(self) -> DenseIndex | None:
+        if RAG_VECTOR_ENGINE != "numpy":
+            return None
+        return self._local_index("vector", VECTOR_META_PATH,
+                                 lambda: DenseIndex.load(VECTOR_INDEX_PATH, VECTOR_META_PATH))
+
+    @staticmethod
+    def _keyword_match(bm25: BM25Index, hits: List[Tuple[int, float]]) -> List[SourceNode] | None:
+        """
+        Явный лидер BM25 (код ошибки, точное название) возвращается без эмбеддинга и обращения к Chroma.
+        Скоры нормируются на лидера: лидер получает 1.0 и проходит порог уверенности агента.
+        """
+        if BM25_EARLY_EXIT_SCORE <= 0 or not hits or hits[0][1] < BM25_EARLY_EXIT_SCORE:
+            return None
+        if len(hits) > 1 and hits[0][1] < BM25_EARLY_EXIT_MARGIN * hits[1][1]:
+            return None
+        top_score = hits[0][1]
+        return [
+            SourceNode(text=bm25.texts[doc], score=score / top_score,
+                       filename=bm25.metadatas[doc].get("file_name", "N/A"))
+            for doc, score in hits[:TOP_K_RESULTS]
+        ]
+
+    def _rerank(self, user_queries: List[str], candidates: List[List[SourceNode]]) -> List[List[SourceNode]]:
+        results, costs = self.reranker.rerank_batch(user_queries, candidates, TOP_K_RESULTS)
+        for user_query, cost in zip(user_queries, costs):
+            logging.info(f"Переранжирование '{user_query[:50]}': {cost.pairs}/{cost.candidates} пар, "
+                         f"{cost.elapsed_ms:.1f} мс{', ранний выход' if cost.early_exit else ''}.")
+        return results
+
+    def _hybrid_search(self, bm25: BM25Index, lexical_hits: List[List[Tuple[int, float]]],
+                       embeddings: List[List[float]], top_k: int = TOP_K_RESULTS,
+                       categories: List[str | None] | None = None) -> List[List[SourceNode]]:
+        """
+        Reciprocal rank fusion рангов Chroma и BM25: score(d) = sum 1 / (RRF_K + rank).
+        Порядок источников — по RRF, а score остаётся векторным exp(-distance), как в режиме vector,
+        поэтому RAG_CONFIDENCE_THRESHOLD не требует перекалибровки.
+        """
+        dense = self._dense_candidates(embeddings, max(HYBRID_CANDIDATES, top_k), categories)
+
+        batch_results = []
+        for hits, embedding, dense_hits in zip(lexical_hits, embeddings, dense):
+            fused = defaultdict(float)
+            for rank, (node_id, _) in enumerate(dense_hits):
+                fused[node_id] += 1.0 / (RRF_K + rank + 1)
+            for rank, (doc, _) in enumerate(hits):
+                fused[bm25.node_ids[doc]] += 1.0 / (RRF_K + rank + 1)
+            top_ids = sorted(fused, key=fused.get, reverse=True)[:top_k]
+
+            nodes = dict(dense_hits)
+            missing = [node_id for node_id in top_ids if node_id not in nodes]
+            if missing:
+                nodes.update(self._score_nodes(missing, embedding))
+            batch_results.append([nodes[node_id] for node_id in top_ids if node_id in nodes])
+        return batch_results
+
+    def _score_nodes(self, node_ids: List[str], embedding: List[float]) -> dict[str, SourceNode]:
+        """Векторный скор для фрагментов, найденных только BM25: та же метрика l2, что у коллекции Chroma."""
+        dense = self._dense_index()
+        if dense is not None:
+            query = DenseIndex.normalize(embedding)
+            return {
+                node_id: SourceNode(
+                    text=dense.texts[row],
+                    score=self._cosine_score(float(dense.matrix[row] @ query)),
+                    filename=dense.metadatas[row].get("file_name", "N/A"),
+                )
+                for node_id in node_ids
+                if (row := dense.positions.get(node_id)) is not None
+            }
+
+        response = self._collection.get(ids=node_ids, include=["documents", "metadatas", "embeddings"])
+        nodes = {}
+        for node_id, text, metadata, vector in zip(
+                response.get("ids") or [],
+                response.get("documents") or [],
+                response.get("metadatas") or [],
+                response.get("embeddings") if response.get("embeddings") is not None else [],
+        ):
+            distance = sum((float(a) - float(b)) ** 2 for a, b in zip(embedding, vector))
+            nodes[node_id] = SourceNode(
+                text=text or "",
+                score=math.exp(-distance),
+                filename=(metadata or {}).get("file_name", "N/A"),
+            )
+        return nodes
+
+    def _embed_queries(self, user_queries: List[str]) -> List[List[float]]:
+        cached_batch = getattr(self._embed_model, "get_query_embedding_batch", None)
+        if cached_batch is not None:
+            return cached_batch(user_queries)
+        embed_batch = getattr(self._embed_model, "_embed", None)
+        if embed_batch is not None:
+            return embed_batch(user_queries, prompt_name="query")
+        return [self._embed_model.get_query_embedding(q) for q in user_queries]
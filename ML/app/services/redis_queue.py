@@ -0,0 +1,76 @@
+import time
+from typing import Callable, List
+
+import redis
+
+# Забирает до ARGV[1] элементов из головы списка и кладёт их в zset "в обработке" с дедлайном ARGV[2]
+_CLAIM_SCRIPT = """
+local items = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #items == 0 then
+    return items
+end
+redis.call('LTRIM', KEYS[1], #items, -1)
+for _, item in ipairs(items) do
+    redis.call('ZADD', KEYS[2], ARGV[2], item)
+end
+return items
+"""
+
+# Возвращает в конец списка элементы, чей дедлайн обработки истёк (не больше ARGV[2] за вызов)
+_REQUEUE_SCRIPT = """
+local items = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+for _, item in ipairs(items) do
+    redis.call('RPUSH', KEYS[1], item)
+    redis.call('ZREM', KEYS[2], item)
+end
+return #items
+"""
+
+
+class RedisWorkQueue:
+    """
+    Надёжная очередь поверх списка Redis. claim() атомарно переносит элементы в zset "в обработке"
+    с дедлайном visibility_timeout; после успешной обработки вызывающий делает ack().
+    Элементы процесса, упавшего до ack(), возвращаются в очередь requeue_expired() — как
+    in_flight-строки outbox на бэкенде. Обработчики должны быть идемпотентны: элемент может прийти повторно.
+    """
+
+    def __init__(self, client_factory: Callable[[], redis.Redis], key: str, visibility_timeout: float):
+        self._client_factory = client_factory
+        self.key = key
+        self.processing_key = f"{key}:processing"
+        self.visibility_timeout = visibility_timeout
+        self._claim = None
+        self._requeue = None
+
+    def _client(self) -> redis.Redis:
+        client = self._client_factory()
+        if self._claim is None:
+            self._claim = client.register_script(_CLAIM_SCRIPT)
+            self._requeue = client.register_script(_REQUEUE_SCRIPT)
+        return client
+
+    def push(self, *items: str):
+        if items:
+            self._client().rpush(self.key, *items)
+
+    def claim(self, count: int) -> List[bytes]:
+        client = self._client()
+        return self._claim(keys=[self.key, self.processing_key],
+                           args=[count, time.time() + self.visibility_timeout], client=client)
+
+    def ack(self, items: List[bytes]):
+        if items:
+            self._client().zrem(self.processing_key, *items)
+
+    def requeue_expired(self, limit: int = 1000) -> int:
+        client = self._client()
+        return self._requeue(keys=[self.key, self.processing_key], args=[time.time(), limit], client=client)
+
+    def depth(self) -> int:
+        """Элементы в очереди и в обработке."""
+        pipe = self._client().pipeline()
+        pipe.llen(self.key)
+        pipe.zcard(self.processing_key)
+        queued, processing = pipe.execute()
+        return queued + processing
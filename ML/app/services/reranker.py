@@ -0,0 +1,124 @@
+import logging
+import math
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import List
+
+from ..schemas.agent_schemas import SourceNode
+
+RERANK_MODEL_NAME = os.getenv("RERANK_MODEL_NAME", "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1")
+RERANK_BATCH_SIZE = int(os.getenv("RERANK_BATCH_SIZE", 8))
+RERANK_MAX_LENGTH = int(os.getenv("RERANK_MAX_LENGTH", 512))
+# Ранний выход: лидер уверен (вероятность не ниже SCORE) и опережает второго на MARGIN — остальных не оцениваем
+RERANK_EARLY_EXIT_SCORE = float(os.getenv("RERANK_EARLY_EXIT_SCORE", 0.9))
+RERANK_EARLY_EXIT_MARGIN = float(os.getenv("RERANK_EARLY_EXIT_MARGIN", 0.3))
+
+
+@dataclass
+class RerankCost:
+    pairs: int
+    candidates: int
+    elapsed_ms: float
+    early_exit: bool
+
+
+class CrossEncoderReranker:
+    """
+    Второй этап поиска: cross-encoder переоценивает кандидатов первого этапа и выдаёт
+    откалиброванную вероятность релевантности (0..1) вместо скора bi-encoder.
+    Кандидаты оцениваются порциями по RERANK_BATCH_SIZE в порядке первого этапа; порции всех
+    запросов пачки идут в один вызов модели, запросы с явным лидером выбывают досрочно.
+    """
+
+    def __init__(self, model_name: str = RERANK_MODEL_NAME):
+        from sentence_transformers import CrossEncoder
+        from ..core.embeddings import ensure_model_snapshot
+
+        self.model_name = model_name
+        self._model = CrossEncoder(ensure_model_snapshot(model_name), max_length=RERANK_MAX_LENGTH, device="cpu")
+        # Часть моделей (ms-marco, mmarco) отдаёт логиты: приводим к вероятности сами
+        activation = getattr(self._model, "activation_fn", None) or getattr(self._model, "default_activation_function", None)
+        self._apply_sigmoid = type(activation).__name__ == "Identity"
+        self._lock = threading.Lock()
+
+        self.queries = 0
+        self.pairs = 0
+        self.early_exits = 0
+        self.total_ms = 0.0
+        logging.info(f"Cross-encoder для переранжирования загружен: {model_name}")
+
+    def _score(self, pairs: List[tuple]) -> List[float]:
+        scores = self._model.predict(pairs, batch_size=len(pairs), show_progress_bar=False)
+        if self._apply_sigmoid:
+            return [1.0 / (1.0 + math.exp(-float(score))) for score in scores]
+        return [float(score) for score in scores]
+
+    @staticmethod
+    def _is_decided(scores: List[float]) -> bool:
+        ranked = sorted(scores, reverse=True)
+        if not ranked or ranked[0] < RERANK_EARLY_EXIT_SCORE:
+            return False
+        return len(ranked) == 1 or ranked[0] - ranked[1] >= RERANK_EARLY_EXIT_MARGIN
+
+    def rerank_batch(self, queries: List[str], candidates: List[List[SourceNode]],
+                     top_k: int) -> tuple[List[List[SourceNode]], List[RerankCost]]:
+        started = time.perf_counter()
+        scores: List[List[float]] = [[] for _ in queries]
+        active = [i for i, nodes in enumerate(candidates) if nodes]
+        early_exit = set()
+
+        while active:
+            pairs, owners = [], []
+            for i in active:
+                offset = len(scores[i])
+                for node in candidates[i][offset:offset + RERANK_BATCH_SIZE]:
+                    pairs.append((queries[i], node.text))
+                    owners.append(i)
+            for i, score in zip(owners, self._score(pairs)):
+                scores[i].append(score)
+
+            still_active = []
+            for i in active:
+                if len(scores[i]) >= len(candidates[i]):
+                    continue
+                if self._is_decided(scores[i]):
+                    early_exit.add(i)
+                    continue
+                still_active.append(i)
+            active = still_active
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        total_pairs = sum(len(s) for s in scores)
+
+        results, costs = [], []
+        for i, nodes in enumerate(candidates):
+            # Неоценённые кандидаты отбрасываются: шкала их скоров несравнима с вероятностями cross-encoder
+            reranked = sorted(
+                (node.model_copy(update={"score": score}) for node, score in zip(nodes, scores[i])),
+                key=lambda node: node.score, reverse=True,
+            )
+            results.append(reranked[:top_k])
+            # Время вызова модели делится между запросами пачки пропорционально числу оценённых пар
+            share = len(scores[i]) / total_pairs if total_pairs else 0.0
+            costs.append(RerankCost(pairs=len(scores[i]), candidates=len(nodes),
+                                    elapsed_ms=round(elapsed_ms * share, 2), early_exit=i in early_exit))
+
+        with self._lock:
+            self.queries += len(queries)
+            self.pairs += total_pairs
+            self.early_exits += len(early_exit)
+            self.total_ms += elapsed_ms
+        return results, costs
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "model": self.model_name,
+                "queries": self.queries,
+                "pairs_scored": self.pairs,
+                "early_exits": self.early_exits,
+                "avg_pairs_per_query": round(self.pairs / self.queries, 2) if self.queries else 0.0,
+                "avg_ms_per_query": round(self.total_ms / self.queries, 2) if self.queries else 0.0,
+            }
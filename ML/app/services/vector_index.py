@@ -0,0 +1,101 @@
+import json
+import logging
+import os
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+class DenseIndex:
+    """
+    Векторный индекс в памяти: все эмбеддинги фрагментов — одна непрерывная нормированная float32-матрица.
+    Индексатор сохраняет матрицу в .npy (открывается через memmap) и тексты с метаданными в .json рядом.
+    Поиск — одно матричное произведение на пачку запросов и argpartition по каждой строке.
+    Строки упорядочены по категориям: раздел категории — непрерывный срез матрицы (view, без копирования).
+    """
+
+    def __init__(self, matrix: np.ndarray, node_ids: List[str], texts: List[str], metadatas: List[dict],
+                 partitions: Optional[Dict[str, List[int]]] = None):
+        self.matrix = matrix
+        self.node_ids = node_ids
+        self.texts = texts
+        self.metadatas = metadatas
+        self.partitions = partitions or {}
+        self.positions = {node_id: row for row, node_id in enumerate(node_ids)}
+
+    @staticmethod
+    def normalize(vectors) -> np.ndarray:
+        matrix = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+        return np.ascontiguousarray(matrix / np.maximum(norms, 1e-12))
+
+    @classmethod
+    def build(cls, node_ids: List[str], texts: List[str], metadatas: List[Optional[dict]], embeddings) -> "DenseIndex":
+        metadatas = [
+            {key: value for key, value in (metadata or {}).items() if key in ("file_name", "category")}
+            for metadata in metadatas
+        ]
+        # Фрагменты без категории — в конце, вне разделов
+        order = sorted(range(len(node_ids)), key=lambda i: (metadatas[i].get("category") is None,
+                                                            metadatas[i].get("category") or ""))
+        partitions: Dict[str, List[int]] = {}
+        for position, i in enumerate(order):
+            category = metadatas[i].get("category")
+            if category is not None:
+                partitions.setdefault(category, [position, position])[1] = position + 1
+
+        matrix = cls.normalize([embeddings[i] for i in order]) if order else np.zeros((0, 0), dtype=np.float32)
+        return cls(
+            matrix,
+            [node_ids[i] for i in order],
+            [texts[i] or "" for i in order],
+            [{"file_name": "N/A", **metadatas[i]} for i in order],
+            partitions,
+        )
+
+    def __len__(self) -> int:
+        return len(self.node_ids)
+
+    def search(self, queries: np.ndarray, top_k: int, category: Optional[str] = None) -> List[List[Tuple[int, float]]]:
+        """
+        queries — нормированная матрица запросов; возвращает [(номер строки, косинус)] по убыванию.
+        С category поиск идёт только по разделу категории.
+        """
+        start, end = self.partitions.get(category, (0, 0)) if category is not None else (0, len(self.node_ids))
+        if end <= start:
+            return [[] for _ in range(len(queries))]
+        similarities = queries @ self.matrix[start:end].T
+        k = min(top_k, similarities.shape[1])
+        top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        results = []
+        for row, candidates in zip(similarities, top):
+            order = candidates[np.argsort(-row[candidates])]
+            results.append([(start + int(i), float(row[i])) for i in order])
+        return results
+
+    def save(self, matrix_path: str, meta_path: str):
+        """Метаданные пишутся последними: по времени их изменения RAGService понимает, что индекс обновлён."""
+        tmp_matrix = matrix_path + ".tmp.npy"
+        np.save(tmp_matrix, self.matrix)
+        tmp_meta = meta_path + ".tmp"
+        with open(tmp_meta, "w", encoding="utf-8") as f:
+            json.dump({"node_ids": self.node_ids, "texts": self.texts, "metadatas": self.metadatas,
+                       "partitions": self.partitions}, f, ensure_ascii=False)
+        os.replace(tmp_matrix, matrix_path)
+        os.replace(tmp_meta, meta_path)
+
+    @classmethod
+    def load(cls, matrix_path: str, meta_path: str, mmap: bool = True) -> Optional["DenseIndex"]:
+        if not (os.path.exists(matrix_path) and os.path.exists(meta_path)):
+            return None
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            matrix = np.load(matrix_path, mmap_mode="r" if mmap else None)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Не удалось загрузить векторный индекс {matrix_path}: {e}")
+            return None
+        if matrix.shape[0] != len(meta["node_ids"]):
+            logging.warning(f"Векторный индекс {matrix_path} не согласован с метаданными, пропускаю.")
+            return None
+        return cls(matrix, meta["node_ids"], meta["texts"], meta["metadatas"], meta.get("partitions"))
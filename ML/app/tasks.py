@@ -1,20 +1,47 @@
+import json
 import logging
+import threading
+import time
+
+import redis
 import requests
 import os
 from celery import Celery
-from celery.signals import worker_process_init
+from celery.signals import worker_process_init, worker_process_shutdown
 from .core.settings import setup_services
 from .core import settings
+from .core.worker_runtime import configure_child_threads, ML_WORKER_CONCURRENCY
+from .services.redis_queue import RedisWorkQueue
 
 BACKEND_CALLBACK_URL = os.getenv("BACKEND_CALLBACK_URL")
+BACKEND_CALLBACK_BATCH_URL = os.getenv("BACKEND_CALLBACK_BATCH_URL") or (
+    f"{BACKEND_CALLBACK_URL.rstrip('/')}/batch" if BACKEND_CALLBACK_URL else None
+)
+CALLBACK_BATCH_SIZE = int(os.getenv("CALLBACK_BATCH_SIZE", 50))
+CALLBACK_FLUSH_INTERVAL_SEC = float(os.getenv("CALLBACK_FLUSH_INTERVAL_SEC", 1.0))
+# Через сколько секунд неподтверждённая пачка callback'ов (процесс упал при отправке) уходит повторно
+CALLBACK_VISIBILITY_TIMEOUT_SEC = float(os.getenv("CALLBACK_VISIBILITY_TIMEOUT_SEC", 120))
+CALLBACK_BUFFER_KEY = "ml:callback_buffer"
 MAX_RETRIES = int(os.getenv("CELERY_MAX_RETRIES", 3))
 RETRY_DELAY_SEC = int(os.getenv("CELERY_RETRY_DELAY_SEC", 300))
 
+REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
+TICKET_BATCH_ENABLED = os.getenv("TICKET_BATCH_ENABLED", "false").lower() in ("1", "true", "yes")
+TICKET_BATCH_SIZE = int(os.getenv("TICKET_BATCH_SIZE", 32))
+TICKET_BATCH_MAX_WAIT_MS = int(os.getenv("TICKET_BATCH_MAX_WAIT_MS", 200))
+TICKET_BUFFER_KEY = "ml:ticket_buffer"
+# Через сколько секунд тикеты сборщика, не дошедшего до ack (упал процесс), возвращаются в буфер
+TICKET_VISIBILITY_TIMEOUT_SEC = float(os.getenv("TICKET_VISIBILITY_TIMEOUT_SEC", 600))
+CELERY_QUEUE_NAME = "celery"
+SERVICE_TIME_KEY = "ml:service_times"
+SERVICE_TIME_WINDOW = int(os.getenv("SERVICE_TIME_WINDOW", 200))
+
 celery_app = Celery("ml_worker", broker="redis://redis:6379/0", backend="redis://redis:6379/0")
 
 
 @worker_process_init.connect
 def init_worker(**kwargs):
+    configure_child_threads()
     try:
         settings.ensure_services_ready()
         logging.info("Celery worker: сервисы инициализированы.")
@@ -22,19 +49,25 @@ def init_worker(**kwargs):
         logging.error(f"Celery worker: ошибка инициализации сервисов: {e}", exc_info=True)
 
 
-def send_callback_to_backend(dialog_id: str, status: str, ml_result: dict | None = None,
-                             error_message: str | None = None):
-    if not BACKEND_CALLBACK_URL:
-        logging.error("Переменная BACKEND_CALLBACK_URL не задана! Не могу отправить результат.")
-        return
-
-    callback_payload = {
+def _callback_payload(dialog_id: str, status: str, ml_result: dict | None = None,
+                      error_message: str | None = None) -> dict:
+    return {
         "dialog_id": dialog_id,
         "status": status,
         "ml_result": ml_result,
         "error_message": error_message
     }
 
+
+def send_callback_to_backend(dialog_id: str, status: str, ml_result: dict | None = None,
+                             error_message: str | None = None) -> bool:
+    """Возвращает True, если бэкенд получил результат (в том числе отклонил его с 4xx — повтор не поможет)."""
+    if not BACKEND_CALLBACK_URL:
+        logging.error("Переменная BACKEND_CALLBACK_URL не задана! Не могу отправить результат.")
+        return False
+
+    callback_payload = _callback_payload(dialog_id, status, ml_result, error_message)
+
     from fastapi.encoders import jsonable_encoder
 
     try:
@@ -42,8 +75,116 @@ def send_callback_to_backend(dialog_id: str, status: str, ml_result: dict | None
         response = requests.post(BACKEND_CALLBACK_URL, json=jsonable_encoder(callback_payload), timeout=30)
         response.raise_for_status()
         logging.info(f"Callback для тикета [{dialog_id}] успешно отправлен.")
+        return True
+    except requests.HTTPError as e:
+        logging.error(f"Бэкенд отклонил callback для тикета [{dialog_id}]: {e}")
+        return e.response is not None and e.response.status_code < 500
     except requests.RequestException as e:
         logging.error(f"Не удалось отправить callback для тикета [{dialog_id}]: {e}")
+        return False
+
+
+def send_callbacks_batch(payloads: list[dict]) -> list[dict]:
+    """
+    Отправляет пачку результатов одним запросом; при ошибке — поштучно через send_callback_to_backend.
+    Бэкенд применяет результаты идемпотентно, поэтому повтор после таймаута уже применённой пачки не создаёт дублей.
+    Возвращает результаты, которые доставить не удалось.
+    """
+    if not payloads:
+        return []
+    if not BACKEND_CALLBACK_BATCH_URL:
+        logging.error("Переменная BACKEND_CALLBACK_URL не задана! Не могу отправить результаты.")
+        return payloads
+
+    from fastapi.encoders import jsonable_encoder
+
+    try:
+        logging.info(f"Отправка пакетного callback на бэкенд ({len(payloads)} результатов)...")
+        response = requests.post(BACKEND_CALLBACK_BATCH_URL, json=jsonable_encoder(payloads), timeout=30)
+        response.raise_for_status()
+        logging.info(f"Пакетный callback успешно отправлен ({len(payloads)} результатов).")
+        return []
+    except requests.RequestException as e:
+        logging.error(f"Не удалось отправить пакетный callback, отправляю поштучно: {e}")
+        return [payload for payload in payloads if not send_callback_to_backend(**payload)]
+
+
+class CallbackBuffer:
+    """
+    Буфер результатов для пакетной отправки на бэкенд. Сбрасывается при наборе max_size элементов
+    или не реже чем раз в flush_interval секунд (фоновый поток процесса воркера).
+    Результаты хранятся в Redis (RedisWorkQueue), а не в памяти процесса: add() возвращается после RPUSH,
+    поэтому задача подтверждается только когда результат уже сохранён. Пачку, которую процесс забрал
+    и не успел доставить (SIGKILL, OOM), отправит любой процесс после CALLBACK_VISIBILITY_TIMEOUT_SEC.
+    """
+
+    def __init__(self, max_size: int, flush_interval: float):
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self._queue = RedisWorkQueue(_get_redis, CALLBACK_BUFFER_KEY, CALLBACK_VISIBILITY_TIMEOUT_SEC)
+        self._added = 0
+        self._lock = threading.Lock()
+        self._flusher: threading.Thread | None = None
+
+    def add(self, payload: dict):
+        self.add_many([payload])
+
+    def add_many(self, payloads: list[dict]):
+        from fastapi.encoders import jsonable_encoder
+
+        try:
+            self._queue.push(*(json.dumps(jsonable_encoder(payload)) for payload in payloads))
+        except redis.RedisError as e:
+            logging.error(f"Не удалось сохранить результаты в буфер callback'ов, отправляю сразу: {e}")
+            send_callbacks_batch(payloads)
+            return
+        with self._lock:
+            self._added += len(payloads)
+            full = self._added >= self.max_size
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._run, name="callback-flusher", daemon=True)
+                self._flusher.start()
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            self._added = 0
+        try:
+            self._queue.requeue_expired()
+            while items := self._queue.claim(self.max_size):
+                payloads = [json.loads(item) for item in items]
+                undelivered = send_callbacks_batch(payloads)
+                # Недоставленные остаются "в обработке" и вернутся в буфер по visibility timeout
+                self._queue.ack([item for item, payload in zip(items, payloads) if payload not in undelivered])
+                if undelivered:
+                    break
+        except redis.RedisError as e:
+            logging.error(f"Ошибка буфера callback'ов в Redis: {e}")
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+
+_redis_client: redis.Redis | None = None
+
+
+def _get_redis() -> redis.Redis:
+    global _redis_client
+    if _redis_client is None:
+        _redis_client = redis.Redis.from_url(REDIS_URL)
+    return _redis_client
+
+
+callback_buffer = CallbackBuffer(CALLBACK_BATCH_SIZE, CALLBACK_FLUSH_INTERVAL_SEC)
+ticket_buffer = RedisWorkQueue(_get_redis, TICKET_BUFFER_KEY, TICKET_VISIBILITY_TIMEOUT_SEC)
+
+
+@worker_process_shutdown.connect
+def flush_callbacks(**kwargs):
+    callback_buffer.flush()
 
 
 @celery_app.task(name="process_ticket_query", bind=True)
@@ -57,12 +198,14 @@ def process_ticket_query(self, user_query: str, dialog_id: str):
         if settings.agent_service_instance is None:
             raise RuntimeError("Agent service is not initialized")
 
+        started = time.monotonic()
         result = settings.agent_service_instance.process_query(user_query)
+        record_service_time(time.monotonic() - started, 1)
 
         result_with_query = result.copy()
         result_with_query['user_query'] = user_query
 
-        send_callback_to_backend(dialog_id, "processed", ml_result=result_with_query)
+        callback_buffer.add(_callback_payload(dialog_id, "processed", ml_result=result_with_query))
 
         return {"status": "success"}
 
@@ -78,3 +221,143 @@ def process_ticket_query(self, user_query: str, dialog_id: str):
             error_msg = f"Задача не выполнена после {MAX_RETRIES + 1} попыток. Последняя ошибка: {type(e).__name__}"
             send_callback_to_backend(dialog_id, "error", error_message=error_msg)
             raise
+
+
+def record_service_time(seconds_per_ticket: float, count: int):
+    """Сохраняет время обработки одного тикета в скользящее окно последних SERVICE_TIME_WINDOW значений."""
+    try:
+        pipe = _get_redis().pipeline()
+        pipe.lpush(SERVICE_TIME_KEY, *[f"{seconds_per_ticket:.4f}"] * min(count, SERVICE_TIME_WINDOW))
+        pipe.ltrim(SERVICE_TIME_KEY, 0, SERVICE_TIME_WINDOW - 1)
+        pipe.execute()
+    except redis.RedisError as e:
+        logging.warning(f"Не удалось записать время обработки тикета: {e}")
+
+
+def get_queue_stats() -> dict:
+    """
+    Нагрузка на ML-воркеры для бэкенда: глубина очереди (буфер пакетного режима + очередь Celery),
+    время обработки тикета по последним SERVICE_TIME_WINDOW тикетам и оценка задержки очереди в секундах.
+    """
+    client = _get_redis()
+    pipe = client.pipeline()
+    pipe.llen(TICKET_BUFFER_KEY)
+    pipe.zcard(ticket_buffer.processing_key)
+    pipe.llen(CELERY_QUEUE_NAME)
+    pipe.lrange(SERVICE_TIME_KEY, 0, -1)
+    buffered, processing, queued, samples = pipe.execute()
+    buffered += processing
+
+    # В пакетном режиме задачи Celery — только триггеры сборщиков, тикеты лежат в буфере
+    queue_depth = buffered if TICKET_BATCH_ENABLED else queued
+    times = sorted(float(sample) for sample in samples)
+    avg = sum(times) / len(times) if times else 0.0
+    p90 = times[min(len(times) - 1, int(len(times) * 0.9))] if times else 0.0
+
+    return {
+        "queue_depth": queue_depth,
+        "service_time_avg_sec": round(avg, 4),
+        "service_time_p90_sec": round(p90, 4),
+        "workers": ML_WORKER_CONCURRENCY,
+        "estimated_lag_sec": round(queue_depth * avg / max(ML_WORKER_CONCURRENCY, 1), 3),
+        "samples": len(times),
+    }
+
+
+def enqueue_ticket(user_query: str, dialog_id: str) -> str:
+    """
+    Ставит тикет в обработку и возвращает его dialog_id (в обоих режимах).
+    В пакетном режиме тикет кладётся в буфер Redis, а задача process_ticket_batch забирает из него сразу пачку тикетов.
+    """
+    return enqueue_tickets([{"user_query": user_query, "dialog_id": dialog_id}])[0]
+
+
+def enqueue_tickets(tickets: list[dict]) -> list[str]:
+    """
+    Пакетная версия enqueue_ticket для {"user_query", "dialog_id"}: в пакетном режиме
+    все тикеты кладутся в буфер одним RPUSH, а сборщиков запускается столько, сколько нужно пачек.
+    """
+    if not TICKET_BATCH_ENABLED:
+        for t in tickets:
+            process_ticket_query.delay(user_query=t["user_query"], dialog_id=t["dialog_id"])
+        return [t["dialog_id"] for t in tickets]
+    if not tickets:
+        return []
+
+    ticket_buffer.push(*(json.dumps(t) for t in tickets))
+    _start_collectors(len(tickets))
+    _requeue_expired_tickets()
+    return [t["dialog_id"] for t in tickets]
+
+
+def _start_collectors(count: int):
+    for _ in range(-(-count // TICKET_BATCH_SIZE)):
+        process_ticket_batch.delay()
+
+
+def _requeue_expired_tickets():
+    """Возвращает в буфер тикеты упавших сборщиков и запускает для них новых сборщиков."""
+    try:
+        requeued = ticket_buffer.requeue_expired()
+    except redis.RedisError as e:
+        logging.warning(f"Не удалось вернуть просроченные тикеты в буфер: {e}")
+        return
+    if requeued:
+        logging.warning(f"Возвращено в буфер {requeued} тикетов, не подтверждённых сборщиками.")
+        _start_collectors(requeued)
+
+
+def _collect_ticket_batch() -> tuple[list[bytes], list[dict]]:
+    """Забирает тикеты в обработку (claim); до ack() они остаются в Redis и вернутся в буфер по таймауту."""
+    deadline = time.monotonic() + TICKET_BATCH_MAX_WAIT_MS / 1000
+    claimed: list[bytes] = []
+
+    while len(claimed) < TICKET_BATCH_SIZE:
+        items = ticket_buffer.claim(TICKET_BATCH_SIZE - len(claimed))
+        if items:
+            claimed.extend(items)
+            continue
+        # Пустой буфер на старте означает, что тикеты уже забрал другой сборщик
+        if not claimed or time.monotonic() >= deadline:
+            break
+        time.sleep(0.01)
+
+    return claimed, [json.loads(item) for item in claimed]
+
+
+@celery_app.task(name="process_ticket_batch")
+def process_ticket_batch():
+    _requeue_expired_tickets()
+    claimed, tickets = _collect_ticket_batch()
+    if not tickets:
+        return {"status": "empty"}
+
+    logging.info(f"Воркер собрал пакет из {len(tickets)} тикетов.")
+    try:
+        settings.ensure_services_ready()
+
+        if settings.agent_service_instance is None:
+            raise RuntimeError("Agent service is not initialized")
+
+        started = time.monotonic()
+        results = settings.agent_service_instance.process_queries([t["user_query"] for t in tickets])
+        record_service_time((time.monotonic() - started) / len(tickets), len(tickets))
+    except Exception as e:
+        logging.error(f"Ошибка пакетной обработки ({len(tickets)} тикетов), переход на поштучную обработку: {e}",
+                      exc_info=True)
+        for ticket in tickets:
+            process_ticket_query.delay(user_query=ticket["user_query"], dialog_id=ticket["dialog_id"])
+        ticket_buffer.ack(claimed)
+        return {"status": "fallback", "count": len(tickets)}
+
+    payloads = []
+    for ticket, result in zip(tickets, results):
+        result_with_query = result.copy()
+        result_with_query['user_query'] = ticket["user_query"]
+        payloads.append(_callback_payload(ticket["dialog_id"], "processed", ml_result=result_with_query))
+    # Тикеты подтверждаются только после того, как результаты сохранены в буфере callback'ов
+    callback_buffer.add_many(payloads)
+    ticket_buffer.ack(claimed)
+    callback_buffer.flush()
+
+    return {"status": "success", "count": len(tickets)}
@@ -0,0 +1,105 @@
+"""
+Сравнение embedding-бэкендов: torch (HuggingFaceEmbedding) против onnx / onnx-int8.
+
+Паритет: косинусное сходство векторов ONNX-бэкенда с векторами torch-модели на одних и тех же
+текстах (фрагменты базы знаний и запросы). Скорость: задержка одиночного запроса (p50/p95)
+и пропускная способность батч-векторизации фрагментов. Кэш эмбеддингов отключается.
+
+    python -m benchmarks.embedding_backends --backends onnx onnx-int8 --min-cosine 0.99 0.97
+
+Код выхода 1, если минимальное сходство какого-либо бэкенда ниже его порога --min-cosine.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import numpy as np
+
+from app.core.embeddings import build_embed_model
+
+KB_DIR = os.getenv("KB_DIR", "./knowledge_base")
+EMBED_MODEL_NAME = os.getenv("EMBED_MODEL_NAME", "intfloat/multilingual-e5-large")
+
+QUERIES = [
+    "Не могу войти в личный кабинет, пишет неверный пароль",
+    "Как оформить отпуск за свой счёт?",
+    "Принтер на третьем этаже не печатает",
+    "Когда придёт расчётный листок за прошлый месяц?",
+    "Нужен доступ к общей папке отдела",
+    "VPN отключается каждые пять минут",
+]
+
+
+def _load_passages(limit: int) -> list[str]:
+    from llama_index.core import SimpleDirectoryReader
+    from llama_index.core.node_parser import SentenceSplitter
+
+    documents = SimpleDirectoryReader(KB_DIR, recursive=True).load_data()
+    nodes = SentenceSplitter(chunk_size=512, chunk_overlap=50).get_nodes_from_documents(documents)
+    return [node.get_content() for node in nodes[:limit]]
+
+
+def _embed_all(model, queries: list[str], passages: list[str]) -> np.ndarray:
+    vectors = [model.get_query_embedding(q) for q in queries] + model.get_text_embedding_batch(passages)
+    matrix = np.asarray(vectors, dtype=np.float32)
+    return matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+
+
+def _latency_ms(model, queries: list[str], repeats: int) -> tuple[float, float]:
+    model.get_query_embedding(queries[0])  # прогрев
+    timings = []
+    for _ in range(repeats):
+        for query in queries:
+            started = time.perf_counter()
+            model.get_query_embedding(query)
+            timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.95) - 1]
+
+
+def _throughput(model, passages: list[str]) -> float:
+    started = time.perf_counter()
+    model.get_text_embedding_batch(passages)
+    return len(passages) / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backends", nargs="+", default=["onnx", "onnx-int8"])
+    parser.add_argument("--min-cosine", type=float, nargs="+", default=[0.99, 0.97],
+                        help="порог минимального сходства с torch, по одному на бэкенд")
+    parser.add_argument("--passages", type=int, default=256)
+    parser.add_argument("--repeats", type=int, default=10)
+    args = parser.parse_args()
+    thresholds = dict(zip(args.backends, args.min_cosine + args.min_cosine[-1:] * len(args.backends)))
+
+    passages = _load_passages(args.passages)
+    print(f"Модель: {EMBED_MODEL_NAME}; запросов: {len(QUERIES)}, фрагментов: {len(passages)}")
+
+    reference_model = build_embed_model(EMBED_MODEL_NAME, backend="torch", use_cache=False)
+    reference = _embed_all(reference_model, QUERIES, passages)
+
+    rows = {"torch": (1.0, 1.0, *_latency_ms(reference_model, QUERIES, args.repeats),
+                      _throughput(reference_model, passages))}
+    failed = []
+    for backend in args.backends:
+        model = build_embed_model(EMBED_MODEL_NAME, backend=backend, use_cache=False)
+        similarity = np.sum(_embed_all(model, QUERIES, passages) * reference, axis=1)
+        rows[backend] = (float(similarity.mean()), float(similarity.min()),
+                         *_latency_ms(model, QUERIES, args.repeats), _throughput(model, passages))
+        if similarity.min() < thresholds[backend]:
+            failed.append(backend)
+
+    print(f"\n{'бэкенд':<12}{'cos сред.':>11}{'cos мин.':>10}{'p50, мс':>10}{'p95, мс':>10}{'фрагм./с':>11}")
+    for backend, (cos_mean, cos_min, p50, p95, throughput) in rows.items():
+        print(f"{backend:<12}{cos_mean:>11.4f}{cos_min:>10.4f}{p50:>10.2f}{p95:>10.2f}{throughput:>11.1f}")
+
+    if failed:
+        print(f"\nПаритет не пройден: {', '.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
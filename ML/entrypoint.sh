@@ -1,25 +1,37 @@
 #!/bin/bash
 set -e
 
-echo "Проверка наличия индекса ChromaDB..."
+run_indexer() {
+    echo "Проверка индекса ChromaDB..."
 
-# Создаём директорию, если её нет
-mkdir -p /app/db
+    # Создаём директорию, если её нет
+    mkdir -p /app/db
 
-if [ ! -f "/app/db/.initialized" ]; then
-    echo "Индекс не найден. Запуск индексации базы знаний..."
-    
+    # Индексация инкрементальная: при неизменной базе знаний она занимает секунды
+    # и не загружает embedding-модель.
     if python /app/indexer.py; then
-        # Создаём маркер успешной индексации
+        # Маркер успешной индексации
         touch /app/db/.initialized
         echo "Индексация завершена успешно."
+    elif [ -f "/app/db/.initialized" ]; then
+        echo "ПРЕДУПРЕЖДЕНИЕ: обновление индекса не удалось, продолжаю работу с существующим индексом."
     else
         echo "ОШИБКА: Индексация не удалась!"
         exit 1
     fi
-else
-    echo "Индекс уже существует (найден файл .initialized), пропускаю индексацию."
+}
+
+# "index" — одноразовый запуск индексатора (сервис ml-indexer в docker-compose)
+if [ "$1" = "index" ]; then
+    run_indexer
+    exit 0
+fi
+
+# Без отдельного индексатора (одиночный контейнер) индексация выполняется перед запуском сервиса;
+# ml-api и ml-worker в docker-compose её пропускают (ML_RUN_INDEXER=false)
+if [ "${ML_RUN_INDEXER:-true}" = "true" ]; then
+    run_indexer
 fi
 
-echo "Запуск ML API сервиса..."
+echo "Запуск ML сервиса..."
 exec "$@"
@@ -1,18 +1,23 @@
 import os
+import json
+import hashlib
 import logging
+import argparse
 
 from dotenv import load_dotenv
 from llama_index.core import (
     VectorStoreIndex,
     SimpleDirectoryReader,
-    StorageContext,
 )
 from llama_index.core.node_parser import SentenceSplitter
-from llama_index.embeddings.huggingface import HuggingFaceEmbedding
 from llama_index.vector_stores.chroma import ChromaVectorStore
 import chromadb
 from llama_index.readers.file import PyMuPDFReader
 
+from app.core.embeddings import build_embed_model, EMBED_BACKEND
+from app.services.bm25_index import BM25Index
+from app.services.vector_index import DenseIndex
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 load_dotenv()
 
@@ -20,68 +25,231 @@ SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 KB_DIR = os.path.join(SCRIPT_DIR, "knowledge_base")
 DB_DIR = "/app/db"
 COLLECTION_NAME = "knowledge_base_main"
+MANIFEST_PATH = os.path.join(DB_DIR, "index_manifest.json")
+BM25_INDEX_PATH = os.path.join(DB_DIR, "bm25_index.json")
+VECTOR_INDEX_PATH = os.path.join(DB_DIR, "vector_index.npy")
+VECTOR_META_PATH = os.path.join(DB_DIR, "vector_index.json")
 EMBED_MODEL_NAME = os.getenv("EMBED_MODEL_NAME", "intfloat/multilingual-e5-large")
 CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", 512))
 CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", 64))
+# Соответствие "файл или каталог базы знаний -> категория классификатора"
+KB_CATEGORY_MAP = os.getenv("KB_CATEGORY_MAP", os.path.join(SCRIPT_DIR, "kb_categories.json"))
+
+
+def _file_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _scan_knowledge_base() -> dict[str, str]:
+    hashes = {}
+    for root, _, files in os.walk(KB_DIR):
+        for name in sorted(files):
+            if name.startswith("."):
+                continue
+            path = os.path.join(root, name)
+            hashes[os.path.relpath(path, KB_DIR)] = _file_hash(path)
+    return hashes
+
+
+def _load_category_map() -> dict[str, str]:
+    if not os.path.exists(KB_CATEGORY_MAP):
+        return {}
+    with open(KB_CATEGORY_MAP, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _category_for(rel_path: str, category_map: dict[str, str]) -> str | None:
+    """Категория файла: точное совпадение пути или самый длинный совпавший каталог (ключ с '/' на конце)."""
+    rel_path = rel_path.replace(os.sep, "/")
+    if rel_path in category_map:
+        return category_map[rel_path]
+    prefixes = [prefix for prefix in category_map if prefix.endswith("/") and rel_path.startswith(prefix)]
+    return category_map[max(prefixes, key=len)] if prefixes else None
+
+
+def _index_settings() -> dict:
+    return {
+        "embed_model": EMBED_MODEL_NAME,
+        "embed_backend": EMBED_BACKEND,
+        "chunk_size": CHUNK_SIZE,
+        "chunk_overlap": CHUNK_OVERLAP,
+        "category_map": _load_category_map(),
+    }
 
 
-def create_or_update_index():
+def _collection_for(settings: dict) -> str:
+    """Своя коллекция на каждый набор параметров: векторы разных моделей и разбиений не смешиваются."""
+    digest = hashlib.sha256(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+    return f"{COLLECTION_NAME}_{digest}"
+
+
+def _load_manifest() -> dict:
+    if not os.path.exists(MANIFEST_PATH):
+        return {}
+    try:
+        with open(MANIFEST_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logging.warning(f"не удалось прочитать манифест индекса {MANIFEST_PATH}: {e}. будет выполнена полная переиндексация.")
+        return {}
+
+
+def _save_manifest(manifest: dict):
+    tmp_path = MANIFEST_PATH + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, MANIFEST_PATH)
+
+
+def _export_local_indexes(chroma_collection):
+    """
+    Локальные индексы строятся по фрагментам из коллекции целиком: тексты и эмбеддинги уже лежат в Chroma,
+    поэтому пересборка после инкрементального обновления не требует ни чтения файлов, ни эмбеддингов.
+    """
+    data = chroma_collection.get(include=["documents", "metadatas", "embeddings"])
+    bm25 = BM25Index.build(data["ids"], data["documents"], data["metadatas"])
+    bm25.save(BM25_INDEX_PATH)
+    logging.info(f"bm25-индекс сохранён: {BM25_INDEX_PATH} ({len(bm25)} фрагментов, {len(bm25.postings)} термов)")
+
+    embeddings = data["embeddings"] if data["embeddings"] is not None else []
+    dense = DenseIndex.build(data["ids"], data["documents"], data["metadatas"], embeddings)
+    dense.save(VECTOR_INDEX_PATH, VECTOR_META_PATH)
+    logging.info(f"векторная матрица сохранена: {VECTOR_INDEX_PATH} {dense.matrix.shape}")
+
+
+def create_or_update_index(full: bool = False):
+    """
+    Инкрементальная индексация: переэмбеддятся только новые и изменённые файлы, узлы удалённых файлов
+    вычищаются из коллекции. Новые узлы файла добавляются до удаления старых, поэтому
+    коллекция не пустеет во время обновления. full=True переиндексирует все файлы тем же способом.
+    При смене параметров индексации база строится в новую коллекцию; сервисы переходят на неё после
+    записи манифеста, а коллекция позапрошлых параметров удаляется (прошлую ещё могут читать запущенные процессы).
+    """
     logging.info("запуск процесса индексации базы знаний...")
 
-    file_extractor = {
-        ".pdf": PyMuPDFReader()
-    }
-    reader = SimpleDirectoryReader(
-        KB_DIR,
-        recursive=True,
-        file_extractor=file_extractor
-    )
-
-    documents = reader.load_data()
-
-    if not documents:
+    current_hashes = _scan_knowledge_base()
+    if not current_hashes:
         logging.warning("в папке knowledge_base не найдено документов. индексация прервана.")
         return
-    logging.info(f"загружено документов: {len(documents)}")
 
-    logging.info(f"загрузка embedding-модели: {EMBED_MODEL_NAME}")
-    embed_model = HuggingFaceEmbedding(
-        model_name=EMBED_MODEL_NAME,
-        query_instruction="query: ",
-        text_instruction="passage: "
-    )
+    manifest = _load_manifest()
+    settings = _index_settings()
+    active_collection = manifest.get("collection", COLLECTION_NAME)
+    collection_name = _collection_for(settings)
+    if full or manifest.get("settings") != settings:
+        if manifest:
+            logging.info("параметры индексации изменились или запрошена полная переиндексация.")
+        previous_files = {}
+    else:
+        previous_files = manifest.get("files", {})
+        # Манифест до появления коллекций по параметрам: продолжаем в старой
+        collection_name = active_collection
 
-    splitter = SentenceSplitter(
-        chunk_size=CHUNK_SIZE,
-        chunk_overlap=CHUNK_OVERLAP
-    )
+    changed = [path for path, digest in current_hashes.items()
+               if previous_files.get(path, {}).get("hash") != digest]
+    removed = [path for path in previous_files if path not in current_hashes]
+    logging.info(f"файлов в базе знаний: {len(current_hashes)}, новых/изменённых: {len(changed)}, удалённых: {len(removed)}")
 
     logging.info(f"инициализация/подключение к chromadb в папке: {DB_DIR}")
     db_client = chromadb.PersistentClient(path=DB_DIR)
-
-    existing_collections = [c.name for c in db_client.list_collections()]
-    if COLLECTION_NAME in existing_collections:
-        logging.info(f"Найдена существующая коллекция '{COLLECTION_NAME}'. Удаляю её для переиндексации...")
-        db_client.delete_collection(name=COLLECTION_NAME)
-        logging.info("Коллекция успешно удалена.")
+    if collection_name != active_collection and not previous_files:
+        # Остатки прерванной сборки с теми же параметрами не описаны манифестом — начинаем с пустой коллекции
+        try:
+            db_client.delete_collection(collection_name)
+        except Exception:
+            pass
+    logging.info(f"коллекция: {collection_name}")
+    chroma_collection = db_client.get_or_create_collection(collection_name)
+
+    files_manifest = {path: entry for path, entry in previous_files.items() if path in current_hashes}
+
+    if changed:
+        logging.info(f"загрузка embedding-модели: {EMBED_MODEL_NAME}")
+        embed_model = build_embed_model(EMBED_MODEL_NAME)
+        splitter = SentenceSplitter(
+            chunk_size=CHUNK_SIZE,
+            chunk_overlap=CHUNK_OVERLAP
+        )
+        vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
+        index = VectorStoreIndex.from_vector_store(vector_store=vector_store, embed_model=embed_model)
+
+        reader = SimpleDirectoryReader(
+            input_files=[os.path.join(KB_DIR, path) for path in changed],
+            file_extractor={".pdf": PyMuPDFReader()}
+        )
+        documents = reader.load_data()
+        logging.info(f"загружено документов: {len(documents)}")
+
+        nodes = splitter.get_nodes_from_documents(documents, show_progress=True)
+        category_map = _load_category_map()
+        for node in nodes:
+            category = _category_for(os.path.relpath(node.metadata.get("file_path", ""), KB_DIR), category_map)
+            if category is None:
+                continue
+            # Категория нужна только для фильтрации: в текст эмбеддинга и промпт LLM она не попадает
+            node.metadata["category"] = category
+            node.excluded_embed_metadata_keys.append("category")
+            node.excluded_llm_metadata_keys.append("category")
+        logging.info(f"эмбеддинг {len(nodes)} фрагментов... этот процесс может занять некоторое время.")
+        index.insert_nodes(nodes, show_progress=True)
+
+        new_node_ids: dict[str, list[str]] = {path: [] for path in changed}
+        for node in nodes:
+            rel_path = os.path.relpath(node.metadata.get("file_path", ""), KB_DIR)
+            new_node_ids.setdefault(rel_path, []).append(node.node_id)
+
+        for path in changed:
+            stale_ids = files_manifest.get(path, {}).get("node_ids", [])
+            if stale_ids:
+                chroma_collection.delete(ids=stale_ids)
+            files_manifest[path] = {"hash": current_hashes[path], "node_ids": new_node_ids.get(path, []),
+                                    "category": _category_for(path, category_map)}
+
+    for path in removed:
+        stale_ids = previous_files[path].get("node_ids", [])
+        if stale_ids:
+            chroma_collection.delete(ids=stale_ids)
+        logging.info(f"удалены узлы файла {path} ({len(stale_ids)} шт.)")
+
+    # Узлы, не описанные манифестом (старые полные индексации, прерванные запуски), считаем осиротевшими
+    known_ids = {node_id for entry in files_manifest.values() for node_id in entry.get("node_ids", [])}
+    orphan_ids = [node_id for node_id in chroma_collection.get(include=[])["ids"] if node_id not in known_ids]
+    if orphan_ids:
+        chroma_collection.delete(ids=orphan_ids)
+        logging.info(f"удалено осиротевших узлов: {len(orphan_ids)}")
+
+    if changed or removed or orphan_ids or not (os.path.exists(BM25_INDEX_PATH) and os.path.exists(VECTOR_META_PATH)):
+        _export_local_indexes(chroma_collection)
+
+    # Число фрагментов по категориям: RAGService маршрутизирует поиск только в непустые разделы
+    categories: dict[str, int] = {}
+    for entry in files_manifest.values():
+        if entry.get("category"):
+            categories[entry["category"]] = categories.get(entry["category"], 0) + len(entry.get("node_ids", []))
+
+    previous_collection = manifest.get("previous_collection")
+    if collection_name != active_collection:
+        previous_collection, stale_collection = active_collection, previous_collection
     else:
-        logging.info("Существующая коллекция не найдена, будет создана новая.")
-
-    chroma_collection = db_client.get_or_create_collection(COLLECTION_NAME)
-    vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
-    storage_context = StorageContext.from_defaults(vector_store=vector_store)
-
-    logging.info("создание индекса... этот процесс может занять некоторое время.")
-    index = VectorStoreIndex.from_documents(
-        documents,
-        transformations=[splitter],
-        embed_model=embed_model,
-        storage_context=storage_context,
-        show_progress=True,
-    )
-    logging.info(f"индексация успешно завершена. коллекция '{COLLECTION_NAME}' готова к работе.")
-    return index
+        stale_collection = None
+    _save_manifest({"settings": settings, "collection": collection_name, "previous_collection": previous_collection,
+                    "files": files_manifest, "categories": categories})
+    if stale_collection and stale_collection != collection_name:
+        try:
+            db_client.delete_collection(stale_collection)
+            logging.info(f"удалена устаревшая коллекция '{stale_collection}'.")
+        except Exception as e:
+            logging.warning(f"не удалось удалить устаревшую коллекцию '{stale_collection}': {e}")
+    logging.info(f"индексация успешно завершена. коллекция '{collection_name}' содержит {chroma_collection.count()} узлов.")
+    return chroma_collection
 
 
 if __name__ == "__main__":
-    create_or_update_index()
+    parser = argparse.ArgumentParser(description="Индексация базы знаний в ChromaDB")
+    parser.add_argument("--full", action="store_true", help="переиндексировать все файлы, игнорируя манифест")
+    args = parser.parse_args()
+    create_or_update_index(full=args.full)